@@ -0,0 +1,274 @@
+# --- Analysis Pipeline Benchmark ---
+# Runs synthetic uploads through main.analyze_and_store and reports the time of each
+# stage (parse, severity_filter, control_matching, prompt_build, generation,
+# persistence) as rows per second, plus the peak RSS of the run. Generation uses a
+# stub pipeline by default, or a small local model with --model (e.g. sshleifer/tiny-gpt2).
+# Persistence goes to a storage backend that discards rows, so it measures building
+# and batching the records rather than the network.
+#
+# Each size runs in a fresh process so peak memory is per size. Results are compared
+# with baseline.json; a stage whose throughput drops, or a peak RSS that grows, by
+# more than the tolerance is reported as a regression and the exit code is 1.
+# Baselines are machine specific: refresh them with --update-baseline on the machine
+# that runs the comparison.
+#
+#   python bench_pipeline.py                      # 1k, 10k and 100k rows against the baseline
+#   python bench_pipeline.py --sizes 1000000      # 1M rows
+#   python bench_pipeline.py --update-baseline
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RAG_BACKEND_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_DATA_DIR = os.path.join(BENCH_DIR, "data")
+DEFAULT_SIZES = "1000,10000,100000"
+STAGES = ("parse", "severity_filter", "control_matching", "prompt_build", "generation", "persistence")
+# Stages faster than this are too noisy to compare against the baseline
+MIN_COMPARABLE_SECONDS = 0.05
+STUB_RECOMMENDATION = " Enforce the control on every affected resource and verify it in the next scan."
+
+
+class StubPipeline:
+    """Stands in for the text-generation pipeline: echoes each prompt with a fixed recommendation."""
+
+    tokenizer = None
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+
+    def __call__(self, prompts, **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [[{"generated_text": prompt + STUB_RECOMMENDATION}] for prompt in prompts]
+
+
+class NullStorage:
+    name = "null"
+
+    def insert_analysis(self, record):
+        return 1
+
+    def insert_findings(self, rows):
+        return len(rows)
+
+
+def data_paths(data_dir, rows, seed):
+    """Synthetic schema and findings CSV paths for this size, generated on first use."""
+    from generate_data import generate_findings, generate_schema
+
+    os.makedirs(data_dir, exist_ok=True)
+    schema_path = os.path.join(data_dir, "CMMCSchema.csv")
+    findings_path = os.path.join(data_dir, f"findings_{rows}_{seed}.csv")
+    if not os.path.exists(schema_path):
+        generate_schema(schema_path)
+    if not os.path.exists(findings_path):
+        generate_findings(findings_path, rows, seed)
+    return schema_path, findings_path
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_worker(args):
+    """Benchmark one upload in this process and print the result as JSON."""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, RAG_BACKEND_DIR)
+    import main
+    from cmmc_schema import load_schema
+
+    schema_path, findings_path = data_paths(args.data_dir, args.rows, args.seed)
+    main.MATCHING_MODE = args.matching
+    schema = load_schema(schema_path)
+    if args.model:
+        from model_loader import ModelLoader
+        loader = ModelLoader(args.model, max_attempts=1)
+        loader.start()
+        if not loader.wait_ready(timeout=600):
+            raise RuntimeError(f"Could not load model {args.model}: {loader.last_error}")
+        pipe = loader.pipeline
+    else:
+        pipe = StubPipeline(args.stub_latency_ms / 1000.0)
+
+    timings = {}
+    started = time.perf_counter()
+    with open(findings_path, "rb") as file_obj:
+        results = main.analyze_and_store(
+            file_obj, os.path.basename(findings_path), "benchmark", schema, pipe, NullStorage(), timings=timings,
+        )
+    print(json.dumps({
+        "rows": args.rows,
+        "total_seconds": time.perf_counter() - started,
+        "stage_seconds": timings,
+        "peak_rss_mb": peak_rss_mb(),
+        "non_compliant_controls": len(results["non_compliant_controls"]),
+    }))
+
+
+def run_size(args, rows):
+    """Best (fastest stage times, lowest peak) of args.repeat fresh-process runs for one size."""
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker", "--rows", str(rows),
+        "--data-dir", args.data_dir, "--seed", str(args.seed), "--matching", args.matching,
+        "--stub-latency-ms", str(args.stub_latency_ms),
+    ]
+    if args.model:
+        command += ["--model", args.model]
+    best = None
+    for _ in range(args.repeat):
+        completed = subprocess.run(command, capture_output=True, text=True, cwd=BENCH_DIR)
+        if completed.returncode != 0:
+            sys.stderr.write(completed.stderr)
+            raise RuntimeError(f"Benchmark worker for {rows} rows failed")
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        if best is None:
+            best = run
+            continue
+        for stage, seconds in run["stage_seconds"].items():
+            best["stage_seconds"][stage] = min(seconds, best["stage_seconds"].get(stage, seconds))
+        best["total_seconds"] = min(run["total_seconds"], best["total_seconds"])
+        if run["peak_rss_mb"] is not None:
+            best["peak_rss_mb"] = min(run["peak_rss_mb"], best["peak_rss_mb"])
+    return summarize(best)
+
+
+def summarize(run):
+    rows = run["rows"]
+    stages = {}
+    for stage in STAGES:
+        seconds = run["stage_seconds"].get(stage)
+        if seconds is None:
+            continue
+        stages[stage] = {
+            "seconds": round(seconds, 6),
+            "rows_per_second": round(rows / seconds, 1) if seconds > 0 else None,
+        }
+    return {
+        "total_seconds": round(run["total_seconds"], 4),
+        "rows_per_second": round(rows / run["total_seconds"], 1),
+        "peak_rss_mb": None if run["peak_rss_mb"] is None else round(run["peak_rss_mb"], 1),
+        "non_compliant_controls": run["non_compliant_controls"],
+        "stages": stages,
+    }
+
+
+def compare(results, baseline, throughput_tolerance, memory_tolerance):
+    """Regression messages for results that fall outside the tolerances of the baseline."""
+    regressions = []
+    for size, result in results.items():
+        expected = baseline.get("sizes", {}).get(size)
+        if expected is None:
+            continue
+        for stage, measured in result["stages"].items():
+            reference = expected["stages"].get(stage)
+            if not reference or not reference.get("rows_per_second") or not measured["rows_per_second"]:
+                continue
+            if max(reference["seconds"], measured["seconds"]) < MIN_COMPARABLE_SECONDS:
+                continue
+            floor = reference["rows_per_second"] * (1 - throughput_tolerance)
+            if measured["rows_per_second"] < floor:
+                regressions.append(
+                    f"{size} rows, {stage}: {measured['rows_per_second']:.0f} rows/s "
+                    f"< baseline {reference['rows_per_second']:.0f} rows/s (-{throughput_tolerance:.0%} allowed)"
+                )
+        if result["peak_rss_mb"] is not None and expected.get("peak_rss_mb"):
+            ceiling = expected["peak_rss_mb"] * (1 + memory_tolerance)
+            if result["peak_rss_mb"] > ceiling:
+                regressions.append(
+                    f"{size} rows, peak RSS: {result['peak_rss_mb']:.1f} MB "
+                    f"> baseline {expected['peak_rss_mb']:.1f} MB (+{memory_tolerance:.0%} allowed)"
+                )
+    return regressions
+
+
+def print_table(results):
+    header = f"{'rows':>9}  {'stage':<17}{'seconds':>10}{'rows/s':>14}"
+    print(header)
+    print("-" * len(header))
+    for size, result in results.items():
+        for stage, measured in result["stages"].items():
+            rate = f"{measured['rows_per_second']:.0f}" if measured["rows_per_second"] else "-"
+            print(f"{size:>9}  {stage:<17}{measured['seconds']:>10.4f}{rate:>14}")
+        peak = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f} MB"
+        print(f"{size:>9}  {'total':<17}{result['total_seconds']:>10.4f}{result['rows_per_second']:>14.0f}  peak RSS {peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline stage by stage.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma-separated row counts (e.g. 1000,10000,100000,1000000)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size; the best result is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="Where synthetic CSVs are generated and reused")
+    parser.add_argument("--matching", choices=("retrieval", "keyword"), default="retrieval")
+    parser.add_argument("--model", help="Local or Hub text-generation model instead of the stub")
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0, help="Simulated latency per stub generation batch")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Write these results as the new baseline")
+    parser.add_argument("--throughput-tolerance", type=float, default=0.25, help="Allowed fractional drop in rows/s")
+    parser.add_argument("--memory-tolerance", type=float, default=0.20, help="Allowed fractional growth in peak RSS")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    results = {}
+    for rows in (int(size) for size in args.sizes.split(",") if size.strip()):
+        data_paths(args.data_dir, rows, args.seed) # Generate outside the timed worker
+        results[str(rows)] = run_size(args, rows)
+    print_table(results)
+
+    report = {
+        "matching": args.matching,
+        "generation": args.model or "stub",
+        "sizes": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        sizes = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                sizes = json.load(f).get("sizes", {})
+        sizes.update(results)
+        baseline = dict(report, sizes=sizes)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if (baseline.get("matching"), baseline.get("generation")) != (report["matching"], report["generation"]):
+        print(f"Baseline was recorded with matching={baseline.get('matching')}, generation={baseline.get('generation')}; not comparing.")
+        return 0
+    regressions = compare(results, baseline, args.throughput_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    if not regressions:
+        print("No regressions against the baseline.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# --- Synthetic Benchmark Data ---
+# Generates Security Command Center style findings CSVs in the column layout
+# /upload_csv/ expects, and a CMMCSchema.csv whose requirement statements share
+# vocabulary with the finding descriptions, so matching does realistic work.
+#
+#   python generate_data.py --rows 100000 --out findings_100k.csv
+#   python generate_data.py --schema-out CMMCSchema.csv
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# (domain, family number, requirement statements)
+CMMC_DOMAINS = [
+    ("AC", 1, [
+        "Limit system access to authorized users, processes acting on behalf of authorized users, and devices.",
+        "Limit system access to the types of transactions and functions that authorized users are permitted to execute.",
+        "Control the flow of CUI in accordance with approved authorizations.",
+        "Employ the principle of least privilege, including for specific security functions and privileged accounts.",
+        "Use non-privileged accounts or roles when accessing nonsecurity functions.",
+        "Limit unsuccessful logon attempts.",
+        "Terminate (automatically) a user session after a defined condition.",
+        "Monitor and control remote access sessions.",
+        "Employ cryptographic mechanisms to protect the confidentiality of remote access sessions.",
+        "Control connection of mobile devices.",
+        "Control CUI posted or processed on publicly accessible systems.",
+    ]),
+    ("AU", 3, [
+        "Create and retain system audit logs and records to enable monitoring, analysis, investigation, and reporting of unlawful or unauthorized system activity.",
+        "Ensure that the actions of individual system users can be uniquely traced to those users.",
+        "Review and update logged events.",
+        "Alert in the event of an audit logging process failure.",
+        "Protect audit information and audit logging tools from unauthorized access, modification, and deletion.",
+        "Limit management of audit logging functionality to a subset of privileged users.",
+    ]),
+    ("CM", 4, [
+        "Establish and maintain baseline configurations and inventories of organizational systems.",
+        "Establish and enforce security configuration settings for information technology products.",
+        "Track, review, approve or disapprove, and log changes to organizational systems.",
+        "Employ the principle of least functionality by configuring systems to provide only essential capabilities.",
+        "Restrict, disable, or prevent the use of nonessential programs, functions, ports, protocols, and services.",
+        "Control and monitor user-installed software.",
+    ]),
+    ("IA", 5, [
+        "Identify system users, processes acting on behalf of users, and devices.",
+        "Authenticate the identities of users, processes, or devices, as a prerequisite to allowing access.",
+        "Use multifactor authentication for local and network access to privileged accounts and for network access to non-privileged accounts.",
+        "Enforce a minimum password complexity and change of characters when new passwords are created.",
+        "Store and transmit only cryptographically-protected passwords.",
+        "Disable identifiers after a defined period of inactivity.",
+    ]),
+    ("SC", 13, [
+        "Monitor, control, and protect communications at the external boundaries and key internal boundaries of organizational systems.",
+        "Implement subnetworks for publicly accessible system components that are physically or logically separated from internal networks.",
+        "Deny network communications traffic by default and allow network communications traffic by exception.",
+        "Implement cryptographic mechanisms to prevent unauthorized disclosure of CUI during transmission.",
+        "Establish and manage cryptographic keys for cryptography employed in organizational systems.",
+        "Protect the confidentiality of CUI at rest.",
+    ]),
+    ("SI", 14, [
+        "Identify, report, and correct system flaws in a timely manner.",
+        "Provide protection from malicious code at designated locations within organizational systems.",
+        "Monitor system security alerts and advisories and take action in response.",
+        "Perform periodic scans of organizational systems and real-time scans of files from external sources.",
+        "Monitor organizational systems, including inbound and outbound communications traffic, to detect attacks.",
+    ]),
+]
+
+# (finding.category, description templates); {n} is filled with a small number for variety
+FINDING_TEMPLATES = [
+    ("MFA_NOT_ENFORCED", [
+        "Multi-factor authentication is not enforced for {n} privileged accounts",
+        "Multifactor authentication is disabled for network access by {n} users",
+    ]),
+    ("OPEN_FIREWALL", [
+        "Firewall rule allows ingress traffic from 0.0.0.0/0 on {n} ports",
+        "Network traffic is allowed by default at the external boundary firewall",
+    ]),
+    ("PUBLIC_BUCKET_ACL", [
+        "Storage bucket is publicly accessible and may expose CUI",
+        "Bucket ACL grants allUsers read access to {n} objects",
+    ]),
+    ("AUDIT_LOGGING_DISABLED", [
+        "Audit logging is disabled for {n} services",
+        "Audit logs are not retained long enough to support investigation",
+    ]),
+    ("KMS_KEY_NOT_ROTATED", [
+        "Cryptographic key has not been rotated in {n} days",
+        "Encryption key management does not follow the key rotation policy",
+    ]),
+    ("OS_VULNERABILITY", [
+        "System flaws reported {n} days ago have not been corrected",
+        "Instance is missing {n} security patches for known vulnerabilities",
+    ]),
+    ("ADMIN_SERVICE_ACCOUNT", [
+        "Service account has owner privileges, violating least privilege",
+        "User-managed service account holds {n} privileged roles",
+    ]),
+    ("WEAK_PASSWORD_POLICY", [
+        "Password policy does not enforce minimum complexity",
+        "Passwords for {n} database users are stored without cryptographic protection",
+    ]),
+    ("SSL_NOT_ENFORCED", [
+        "Database instance does not require encrypted connections during transmission",
+        "Load balancer accepts unencrypted HTTP traffic on {n} listeners",
+    ]),
+    ("NONESSENTIAL_PORT_OPEN", [
+        "Nonessential services and ports are enabled on {n} instances",
+        "Legacy protocol is enabled on the instance and should be disabled",
+    ]),
+]
+
+SEVERITIES = np.array(["CRITICAL", "HIGH", "MEDIUM", "LOW"])
+SEVERITY_WEIGHTS = np.array([0.05, 0.25, 0.40, 0.30])
+RESOURCE_TYPES = np.array([
+    "google.compute.Instance", "google.compute.Firewall", "google.cloud.storage.Bucket",
+    "google.cloud.sql.Instance", "google.iam.ServiceAccount", "google.cloud.resourcemanager.Project",
+])
+DESCRIPTION_VARIANTS = 8 # Values of {n} per template; bounds the number of distinct descriptions
+
+
+def generate_schema(path):
+    """Write a synthetic CMMCSchema.csv and return it as a DataFrame."""
+    rows = []
+    for domain, family, statements in CMMC_DOMAINS:
+        for number, statement in enumerate(statements, start=1):
+            rows.append({
+                "Domain": domain,
+                "Requirement ID": f"{domain}.L2-3.{family}.{number}",
+                "Requirement Statement": statement,
+            })
+    schema_df = pd.DataFrame(rows)
+    schema_df.to_csv(path, index=False)
+    return schema_df
+
+
+def generate_findings(path, rows, seed=0):
+    """Write a findings CSV with rows rows and return it as a DataFrame."""
+    rng = np.random.default_rng(seed)
+    categories = []
+    descriptions = []
+    for category, templates in FINDING_TEMPLATES:
+        for template in templates:
+            for n in range(1, DESCRIPTION_VARIANTS + 1):
+                categories.append(category)
+                descriptions.append(template.format(n=n * 3))
+    categories = np.array(categories)
+    descriptions = np.array(descriptions)
+
+    picks = rng.integers(0, len(descriptions), size=rows)
+    resource_ids = rng.integers(0, max(1, rows // 20), size=rows)
+    findings_df = pd.DataFrame({
+        "finding.severity": SEVERITIES[rng.choice(len(SEVERITIES), size=rows, p=SEVERITY_WEIGHTS)],
+        "finding.category": categories[picks],
+        "finding.description": descriptions[picks],
+        "resource.display_name": pd.Series(resource_ids).map("resource-{:06d}".format).to_numpy(),
+        "resource.type": RESOURCE_TYPES[rng.integers(0, len(RESOURCE_TYPES), size=rows)],
+    })
+    findings_df.to_csv(path, index=False)
+    return findings_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic findings and CMMC schema CSVs.")
+    parser.add_argument("--rows", type=int, default=1000, help="Number of findings rows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Findings CSV path")
+    parser.add_argument("--schema-out", help="CMMCSchema.csv path")
+    args = parser.parse_args()
+    if args.out:
+        generate_findings(args.out, args.rows, args.seed)
+        print(f"Wrote {args.rows} findings to {args.out}")
+    if args.schema_out:
+        schema_df = generate_schema(args.schema_out)
+        print(f"Wrote {len(schema_df)} requirements to {args.schema_out}")
+
+
+if __name__ == "__main__":
+    main()
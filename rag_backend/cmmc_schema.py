@@ -0,0 +1,110 @@
+# --- CMMC Schema Snapshot ---
+# Everything the analysis derives from CMMCSchema.csv, precomputed once and shared
+# read-only by all requests. A new snapshot is built whenever the file changes on
+# disk and swapped in with a single reference assignment, so in-flight requests
+# keep using the snapshot they started with.
+import logging
+import os
+from types import MappingProxyType
+
+import pandas as pd
+
+from control_matcher import ControlMatcher
+from retrieval_index import RetrievalIndex
+
+CONTROL_ID_COLUMN = 'Requirement ID'
+REQUIREMENT_COLUMN = 'Requirement Statement'
+
+logger = logging.getLogger(__name__)
+
+STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "but", "by",
+    "for", "if", "in", "into", "is", "it", "no", "not", "of",
+    "on", "or", "such", "that", "the", "their", "then", "there",
+    "these", "they", "this", "to", "was", "will", "with", "you",
+    "your", "all", "any", "has", "have", "from", "out", "use",
+    "ensure", "implement", "provide", "define", "control", "system",
+    "information", "security", "access", "organizational", "organization"
+})
+
+
+def extract_keywords(req_statement):
+    """Keywords for a requirement statement: words longer than four characters that are not stop words."""
+    keywords = set()
+    for word in str(req_statement).lower().split():
+        word = word.strip('.,:;()[]{}')
+        if len(word) > 4 and word not in STOP_WORDS:
+            keywords.add(word)
+    return frozenset(keywords)
+
+
+class CMMCSchema:
+    """Immutable snapshot of the CMMC schema and the lookups built from it."""
+
+    __slots__ = ("df", "path", "mtime", "control_keywords", "requirements", "matcher", "retrieval_index")
+
+    def __init__(self, df, path=None, mtime=None, retrieval_index_dir=None):
+        control_keywords = {}
+        requirements = {}
+        statements = {}
+        if CONTROL_ID_COLUMN in df.columns:
+            # Keep the first row per control ID (what .iloc[0] on the filtered frame returned)
+            for row in df.to_dict('records'):
+                requirements.setdefault(row[CONTROL_ID_COLUMN], MappingProxyType(row))
+            if REQUIREMENT_COLUMN in df.columns:
+                for control_id, req_statement in zip(df[CONTROL_ID_COLUMN], df[REQUIREMENT_COLUMN]):
+                    control_keywords[control_id] = extract_keywords(req_statement)
+                    if pd.notna(req_statement):
+                        statements.setdefault(control_id, []).append(str(req_statement))
+            else:
+                logger.warning("CMMC Schema DF or required columns not available for keyword generation.")
+        else:
+            logger.warning("CMMC Schema DF or required columns not available for keyword generation.")
+
+        object.__setattr__(self, "df", df)
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "mtime", mtime)
+        object.__setattr__(self, "control_keywords", MappingProxyType(control_keywords))
+        object.__setattr__(self, "requirements", MappingProxyType(requirements))
+        object.__setattr__(self, "matcher", ControlMatcher(control_keywords))
+        retrieval_index = None
+        if statements:
+            retrieval_index = RetrievalIndex.load_or_build(
+                list(statements), [" ".join(texts) for texts in statements.values()],
+                STOP_WORDS, cache_dir=retrieval_index_dir,
+            )
+        object.__setattr__(self, "retrieval_index", retrieval_index)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CMMCSchema is immutable")
+
+    @property
+    def has_control_ids(self):
+        return CONTROL_ID_COLUMN in self.df.columns
+
+
+def schema_mtime(path):
+    """Modification time of the schema file, or None if it is missing."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def load_schema(path, retrieval_index_dir=None):
+    """
+    Read CMMCSchema.csv and build a snapshot. Returns None if the file is missing or unreadable.
+    The retrieval index is loaded from / saved to retrieval_index_dir when given.
+    """
+    mtime = schema_mtime(path)
+    if mtime is None:
+        logger.warning("CMMC Schema file not found at %s", path)
+        return None
+    try:
+        df = pd.read_csv(path)
+    except Exception as e:
+        logger.error("Error loading CMMC Schema CSV (%s): %s", path, e)
+        return None
+    schema = CMMCSchema(df, path=path, mtime=mtime, retrieval_index_dir=retrieval_index_dir)
+    logger.info("Successfully loaded CMMC Schema from %s (%d controls)", path, len(schema.requirements))
+    return schema
@@ -0,0 +1,127 @@
+# --- Control Keyword Matcher ---
+# Maps a finding description to every CMMC control whose keywords appear in it,
+# using an inverted token index that is built once instead of running one
+# regex per (finding, control, keyword) combination.
+#
+# Matching semantics are identical to the original per-keyword check:
+#     re.search(r'\b' + re.escape(keyword) + r'\b', finding_desc)
+# A keyword made only of word characters matches exactly when it is one of the
+# maximal \w+ runs of the description, so a set lookup is enough. Keywords that
+# contain other characters (e.g. "multi-factor") are pre-filtered on their word
+# runs and confirmed with a regex compiled once at build time.
+import re
+
+WORD_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """Return the set of maximal word runs in already-lowercased text."""
+    return set(WORD_RE.findall(str(text)))
+
+
+def normalize_descriptions(descriptions):
+    """Lowercase a Series of finding descriptions and collapse whitespace; missing descriptions become ""."""
+    return descriptions.fillna("").astype(str).str.lower().str.replace(r"\s+", " ", regex=True).str.strip()
+
+
+class ControlMatcher:
+    def __init__(self, control_keywords):
+        # control_keywords: {control_id: set_of_keywords}, in schema order
+        self.control_ids = list(control_keywords.keys())
+        self._order = {control_id: position for position, control_id in enumerate(self.control_ids)}
+        # token -> control ids that have that token as a plain keyword
+        self._token_index = {}
+        # (compiled pattern, required word runs, control ids) for keywords with non-word characters
+        self._complex_keywords = []
+
+        complex_map = {}
+        for control_id, keywords in control_keywords.items():
+            for keyword in keywords:
+                if WORD_RE.fullmatch(keyword):
+                    self._token_index.setdefault(keyword, set()).add(control_id)
+                else:
+                    complex_map.setdefault(keyword, set()).add(control_id)
+
+        for keyword, control_ids in complex_map.items():
+            pattern = re.compile(r'\b' + re.escape(keyword) + r'\b')
+            self._complex_keywords.append((pattern, frozenset(WORD_RE.findall(keyword)), control_ids))
+
+    def match(self, finding_desc):
+        """Return the control IDs matched by a lowercased finding description, in schema order."""
+        finding_desc = str(finding_desc)
+        tokens = tokenize(finding_desc)
+        matched = set()
+        for token in tokens:
+            control_ids = self._token_index.get(token)
+            if control_ids:
+                matched.update(control_ids)
+        for pattern, required_tokens, control_ids in self._complex_keywords:
+            if control_ids <= matched:
+                continue
+            if required_tokens <= tokens and pattern.search(finding_desc):
+                matched.update(control_ids)
+        return sorted(matched, key=self._order.__getitem__)
+
+    def match_many(self, finding_descs):
+        return [self.match(finding_desc) for finding_desc in finding_descs]
+
+    def build_gap_map(self, findings, gap_to_findings_map=None):
+        """
+        Build {control_id: [finding_index, ...]} from (finding_index, finding_desc) pairs.
+        Key and index ordering match the original nested loop. Pass an existing map to
+        extend it in place, e.g. when findings arrive in chunks.
+
+        The analysis goes through DeduplicatingMatcher instead; this is kept as the
+        reference that test_control_matcher.py checks against the original loop.
+        """
+        if gap_to_findings_map is None:
+            gap_to_findings_map = {}
+        seen = {}
+        for finding_index, finding_desc in findings:
+            if not finding_desc:
+                continue
+            for control_id in self.match(finding_desc):
+                control_seen = seen.get(control_id)
+                if control_seen is None:
+                    control_seen = seen[control_id] = set(gap_to_findings_map.get(control_id, ()))
+                if finding_index not in control_seen:
+                    control_seen.add(finding_index)
+                    gap_to_findings_map.setdefault(control_id, []).append(finding_index)
+        return gap_to_findings_map
+
+
+class DeduplicatingMatcher:
+    """
+    Matches each distinct normalized finding description only once and expands the
+    matches back to every row that shares it. SCC exports repeat the same description
+    across hundreds of resources, so this cuts matching work to the number of unique
+    descriptions. Matches are remembered across calls, e.g. across upload chunks.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self._matches = {} # normalized description -> tuple of control ids
+
+    @property
+    def unique_descriptions(self):
+        return len(self._matches)
+
+    def match(self, desc):
+        """The control IDs matched by a normalized description, in the wrapped matcher's order."""
+        if desc not in self._matches:
+            self._matches[desc] = tuple(self.matcher.match_many([desc])[0])
+        return self._matches[desc]
+
+    def build_gap_map(self, findings, gap_to_findings_map=None):
+        """Same contract as ControlMatcher.build_gap_map, for (finding_index, normalized_desc) pairs."""
+        if gap_to_findings_map is None:
+            gap_to_findings_map = {}
+        findings = list(findings)
+        new_descs = [desc for desc in dict.fromkeys(desc for _, desc in findings) if desc and desc not in self._matches]
+        if new_descs:
+            for desc, matched in zip(new_descs, self.matcher.match_many(new_descs)):
+                self._matches[desc] = tuple(matched)
+        for finding_index, desc in findings:
+            for control_id in self._matches.get(desc, ()):
+                gap_to_findings_map.setdefault(control_id, []).append(finding_index)
+        return gap_to_findings_map
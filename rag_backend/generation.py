@@ -0,0 +1,152 @@
+# --- Recommendation Generation ---
+# Prompt construction, batched calls to the text-generation pipeline, and
+# extraction of the recommendation text from the generated output.
+import logging
+import time
+
+from cmmc_schema import CONTROL_ID_COLUMN, REQUIREMENT_COLUMN
+from metrics import GENERATION_SECONDS, GENERATED_TOKENS
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATION_MARKER = "Recommendation:"
+MAX_NEW_TOKENS = 100
+MAX_CONTEXT_LEN = 1000 # Limit context length for the prompt
+MAX_RELATED_STATEMENT_LEN = 300 # Limit each retrieved requirement added to the prompt
+
+
+def build_prompt(control_info, finding_context, related_requirements=()):
+    """
+    Build the generation prompt for one control from its requirement row and the finding context.
+    related_requirements are (control_id, statement) pairs retrieved for the finding, added as extra context.
+    """
+    if len(finding_context) > MAX_CONTEXT_LEN:
+        finding_context = finding_context[:MAX_CONTEXT_LEN] + "..."
+    req_statement_for_prompt = control_info.get(REQUIREMENT_COLUMN, 'N/A')
+    if req_statement_for_prompt == 'N/A':
+        logger.warning("Requirement statement not found for Control ID %s", control_info.get(CONTROL_ID_COLUMN, 'N/A'))
+    related_context = ""
+    if related_requirements:
+        related_lines = "\n".join(
+            f"- {related_id}: {statement[:MAX_RELATED_STATEMENT_LEN]}" for related_id, statement in related_requirements
+        )
+        related_context = f"Related CMMC Requirements:\n{related_lines}\n"
+    return (
+        f"Context:\nCMMC Control Requirement ({control_info.get(CONTROL_ID_COLUMN, 'N/A')}): {req_statement_for_prompt}\n"
+        f"{related_context}"
+        f"Related Finding Detail:\n{finding_context}\n\n"
+        f"Question: Based on the finding detail, provide a brief, actionable recommendation to meet the CMMC control requirement.\n\n{RECOMMENDATION_MARKER}"
+    )
+
+
+def summarize_findings(findings, columns, description_column, max_values=5):
+    """
+    Finding context for a control's prompt, summarizing every HIGH finding that triggered it:
+    the number of findings, the first description, and the most common values of the other columns.
+    """
+    lines = [f"Affected findings: {len(findings)}"]
+    for col in columns:
+        values = findings[col].dropna().astype(str)
+        if col == description_column:
+            line = f"{col}: {values.iloc[0] if len(values) else 'N/A'}"
+            other_descriptions = values.nunique() - 1
+            if other_descriptions > 0:
+                line += f" (+{other_descriptions} other descriptions)"
+            lines.append(line)
+            continue
+        counts = values.value_counts()
+        if counts.empty:
+            lines.append(f"{col}: N/A")
+            continue
+        if counts.iloc[0] == 1: # All distinct (e.g. resource names): list a few
+            shown = ", ".join(counts.index[:max_values])
+            line = f"{col}: {len(counts)} distinct - {shown}"
+        else:
+            shown = ", ".join(f"{value} ({count})" for value, count in counts.head(max_values).items())
+            line = f"{col}: {shown}"
+        if len(counts) > max_values:
+            line += f", +{len(counts) - max_values} more"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def extract_recommendation(prompt, output):
+    """
+    Isolate the recommendation text from one pipeline output (a list of generated sequences).
+    Returns (text, ok); ok is False when text is an error or placeholder message.
+    """
+    if not (output and isinstance(output, list) and output[0] and 'generated_text' in output[0]):
+        return "Failed to generate recommendation (invalid output format).", False
+
+    full_text = output[0]['generated_text']
+    rec_start_index = full_text.rfind(RECOMMENDATION_MARKER) # Find the last occurrence
+    if rec_start_index != -1:
+        recommendation_text = full_text[rec_start_index + len(RECOMMENDATION_MARKER):].strip()
+        if not recommendation_text: # Handle case where marker is present but text is empty
+            return "Generated recommendation was empty.", False
+        return recommendation_text, True
+
+    # Fallback if marker not found - maybe model didn't follow format.
+    # Try to remove the prompt part if possible.
+    prompt_end_index = prompt.rfind(RECOMMENDATION_MARKER)
+    if prompt_end_index == -1:
+        return "Failed to isolate recommendation (marker not found).", False
+    potential_answer = full_text[prompt_end_index + len(RECOMMENDATION_MARKER):].strip()
+    if not potential_answer:
+        return "Failed to isolate recommendation from model output.", False
+    return potential_answer, True
+
+
+def count_generated_tokens(pipe, prompt, output):
+    """Tokens the model generated after the prompt, counted with the pipeline's tokenizer (words if it has none)."""
+    try:
+        full_text = output[0]['generated_text']
+    except (IndexError, KeyError, TypeError):
+        return 0
+    generated = full_text[len(prompt):] if full_text.startswith(prompt) else full_text
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if tokenizer is None:
+        return len(generated.split())
+    return len(tokenizer.encode(generated, add_special_tokens=False))
+
+
+def prepare_for_batching(tokenizer, model):
+    """Decoder-only models like GPT-2 need a pad token and left padding to generate in padded batches."""
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+
+
+def generate_batched(pipe, prompts, batch_size, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Run prompts through the text-generation pipeline in padded batches.
+    Yields (position, recommendation_text, ok) as each batch completes, so callers can
+    report results progressively. A failing batch yields an error text for each of its prompts.
+    """
+    batch_size = max(1, batch_size)
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        started = time.perf_counter()
+        try:
+            # Add truncation=True to prevent overly long inputs potentially causing issues
+            outputs = pipe(
+                batch, batch_size=len(batch), max_new_tokens=max_new_tokens,
+                num_return_sequences=1, truncation=True
+            )
+        except Exception as e:
+            GENERATION_SECONDS.observe(time.perf_counter() - started)
+            logger.exception("Error during RAG pipeline call for batch starting at %d: %s", start, e)
+            for offset in range(len(batch)):
+                yield start + offset, f"Error generating recommendation: {e}", False
+            continue
+        GENERATION_SECONDS.observe(time.perf_counter() - started)
+        GENERATED_TOKENS.observe(sum(count_generated_tokens(pipe, prompt, output) for prompt, output in zip(batch, outputs)))
+
+        for offset, (prompt, output) in enumerate(zip(batch, outputs)):
+            try:
+                recommendation_text, ok = extract_recommendation(prompt, output)
+            except Exception as e:
+                logger.error("Error processing RAG pipeline output: %s", e)
+                recommendation_text, ok = f"Error generating recommendation: {e}", False
+            yield start + offset, recommendation_text, ok
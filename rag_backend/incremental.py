@@ -0,0 +1,269 @@
+# --- Incremental Re-analysis ---
+# Scanners re-export mostly unchanged findings for the same user every few hours.
+# In incremental mode each finding row is fingerprinted (a hash of its contents) and
+# compared with the previous analysis for that user, kept in a local SQLite store:
+#   - rows whose fingerprint was seen before reuse their stored control matches and
+#     are not persisted again;
+#   - added or changed rows are matched and persisted (tagged with their fingerprint);
+#   - fingerprints that disappeared are reported to storage as resolved;
+#   - a control whose triggering findings are identical to last time reuses its
+#     previous recommendation without building a prompt, as long as the prompt
+#     version (schema, matcher settings and requirement statement) is unchanged too.
+# A row is "changed" rather than "added" when its row key (resource and category)
+# belonged to a row that disappeared. Stored matches are only reused while the
+# match version (schema and matcher settings) is the same as when they were made.
+#
+# Each user's state is updated by one analysis at a time: an analysis takes the user's
+# lease (a row in the store, so it holds across processes sharing the file), and a
+# second incremental analysis of that user is rejected with UserBusy while it runs.
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from ingest import CATEGORY_COLUMN, RESOURCE_NAME_COLUMN
+
+ROW_KEY_COLUMNS = (RESOURCE_NAME_COLUMN, CATEGORY_COLUMN)
+
+
+def hash_rows(df, columns):
+    """uint64 hash of each row's values in columns (as strings), indexed like df."""
+    columns = [column for column in columns if column in df.columns]
+    if not columns:
+        return pd.Series(np.zeros(len(df), dtype=np.uint64), index=df.index)
+    return pd.util.hash_pandas_object(df[columns].astype(str), index=False)
+
+
+def fingerprint_rows(df, columns):
+    """Content fingerprint per row; columns are sorted so the file's column order doesn't matter."""
+    return hash_rows(df, sorted(columns))
+
+
+def row_keys(df):
+    return hash_rows(df, ROW_KEY_COLUMNS)
+
+
+def fingerprint_hex(fingerprints):
+    """Fingerprints as 16-digit hex strings, the form stored with each persisted finding."""
+    return [f"{int(fingerprint):016x}" for fingerprint in fingerprints]
+
+
+def context_hash(model_name, control_id, fingerprints, prompt_version=""):
+    """
+    Identifies the findings that triggered a control and everything else its prompt was built from
+    (prompt_version); equal hashes mean the recommendation can be reused.
+    """
+    digest = hashlib.sha256(f"{model_name}\x00{control_id}\x00{prompt_version}\x00".encode("utf-8"))
+    digest.update(np.sort(np.asarray(fingerprints, dtype=np.uint64)).tobytes())
+    return digest.hexdigest()
+
+
+def row_controls(gap_to_findings_map, index):
+    """The sorted control IDs matched by each row label in index (empty for rows that matched none)."""
+    controls = {}
+    for control_id, finding_indices in gap_to_findings_map.items():
+        for finding_index in finding_indices:
+            controls.setdefault(finding_index, []).append(control_id)
+    return [tuple(sorted(controls.get(label, ()))) for label in index]
+
+
+def isin_sorted(values, sorted_values):
+    """np.isin for a sorted (deduplicated) array that is reused across calls, without re-sorting it each time."""
+    values = np.asarray(values, dtype=np.uint64)
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def _to_db(values):
+    # SQLite integers are signed 64-bit
+    return np.asarray(values, dtype=np.uint64).view(np.int64).tolist()
+
+
+def _from_db(values):
+    return np.asarray(values, dtype=np.int64).view(np.uint64)
+
+
+class Baseline:
+    """The previous analysis of one user: what each fingerprint matched, and the gaps it produced."""
+
+    def __init__(self, fingerprints, row_keys, controls, gaps, match_version=None):
+        order = np.argsort(fingerprints)
+        self.fingerprints = fingerprints[order] # Sorted uint64 array, for isin_sorted()
+        self.row_keys = row_keys[order] # uint64 array aligned with fingerprints
+        self.matches = dict(zip(fingerprints.tolist(), controls)) # fingerprint -> tuple of control IDs
+        self.gaps = gaps # control_id -> (context_hash, recommendation)
+        self.match_version = match_version
+
+    def known(self, fingerprints):
+        """Boolean mask of the fingerprints that were in the previous analysis."""
+        return isin_sorted(fingerprints, self.fingerprints)
+
+
+class FindingDelta:
+    """How this upload's rows differ from the baseline."""
+
+    def __init__(self, baseline, fingerprints, keys):
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+        keys = np.asarray(keys, dtype=np.uint64)
+        self.new_mask = ~baseline.known(fingerprints)
+        removed_mask = ~isin_sorted(baseline.fingerprints, np.unique(fingerprints))
+        self.removed_fingerprints = baseline.fingerprints[removed_mask]
+        changed_mask = self.new_mask & isin_sorted(keys, np.unique(baseline.row_keys[removed_mask]))
+        self.counts = {
+            "added": int(self.new_mask.sum() - changed_mask.sum()),
+            "changed": int(changed_mask.sum()),
+            "unchanged": int((~self.new_mask).sum()),
+            "resolved": int(removed_mask.sum()),
+        }
+
+
+def gap_delta(baseline, context_hashes):
+    """New, changed, unchanged and resolved gaps given this upload's {control_id: context_hash}."""
+    previous = baseline.gaps
+    return {
+        "new": sorted(control_id for control_id in context_hashes if control_id not in previous),
+        "changed": sorted(
+            control_id for control_id, digest in context_hashes.items()
+            if control_id in previous and previous[control_id][0] != digest
+        ),
+        "unchanged": sorted(
+            control_id for control_id, digest in context_hashes.items()
+            if control_id in previous and previous[control_id][0] == digest
+        ),
+        "resolved": sorted(control_id for control_id in previous if control_id not in context_hashes),
+    }
+
+
+class UserBusy(Exception):
+    """Another incremental analysis of the same user is in progress."""
+
+
+class FindingStateStore:
+    def __init__(self, path, lease_seconds=900.0):
+        self.path = path
+        self.lease_seconds = lease_seconds # A lease left behind by a crashed process expires after this
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS findings ("
+            "user_id TEXT NOT NULL, fingerprint INTEGER NOT NULL, row_key INTEGER NOT NULL, "
+            "controls TEXT NOT NULL, first_seen REAL NOT NULL, PRIMARY KEY (user_id, fingerprint))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS gaps ("
+            "user_id TEXT NOT NULL, control_id TEXT NOT NULL, context_hash TEXT NOT NULL, "
+            "recommendation TEXT, updated_at REAL NOT NULL, PRIMARY KEY (user_id, control_id))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "user_id TEXT PRIMARY KEY, match_version TEXT, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "user_id TEXT PRIMARY KEY, owner TEXT NOT NULL, lease_until REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @contextmanager
+    def user_lease(self, user_id):
+        """
+        Hold the user's lease for one incremental analysis, so it sees the previous analysis's state
+        and nothing else changes it meanwhile. Yields the lease owner to pass to commit(). Raises
+        UserBusy, rather than waiting, while another analysis holds an unexpired lease.
+        """
+        owner = f"{self.owner}:{uuid.uuid4().hex[:8]}"
+        now = time.time()
+        with self._lock:
+            # A single upsert is atomic across processes, so only one claim succeeds
+            cursor = self._db.execute(
+                "INSERT INTO leases (user_id, owner, lease_until) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until "
+                "WHERE leases.lease_until < ?",
+                (user_id, owner, now + self.lease_seconds, now),
+            )
+            self._db.commit()
+        if cursor.rowcount != 1:
+            raise UserBusy(f"An incremental analysis of user {user_id} is already in progress.")
+        try:
+            yield owner
+        finally:
+            with self._lock:
+                self._db.execute("DELETE FROM leases WHERE user_id = ? AND owner = ?", (user_id, owner))
+                self._db.commit()
+
+    def load(self, user_id):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT fingerprint, row_key, controls FROM findings WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            gap_rows = self._db.execute(
+                "SELECT control_id, context_hash, recommendation FROM gaps WHERE user_id = ?", (user_id,)
+            ).fetchall()
+            user_row = self._db.execute(
+                "SELECT match_version FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        parsed = {} # Most rows share a handful of control lists
+        return Baseline(
+            _from_db([row[0] for row in rows]),
+            _from_db([row[1] for row in rows]),
+            [parsed[row[2]] if row[2] in parsed else parsed.setdefault(row[2], tuple(json.loads(row[2]))) for row in rows],
+            {control_id: (digest, recommendation) for control_id, digest, recommendation in gap_rows},
+            match_version=user_row[0] if user_row else None,
+        )
+
+    def commit(self, user_id, new_fingerprints, new_row_keys, new_controls, removed_fingerprints, gaps, match_version,
+               owner=None):
+        """
+        Record an analysis as the user's new baseline: add (or replace) the new fingerprints with
+        their matched controls, drop the removed ones, and replace the gaps ({control_id: (hash, recommendation)}).
+        With the owner from user_lease(), nothing is written (and False is returned) if the lease was lost.
+        """
+        now = time.time()
+        with self._lock:
+            if owner is not None:
+                # Checked in the same transaction as the writes below
+                cursor = self._db.execute(
+                    "UPDATE leases SET lease_until = ? WHERE user_id = ? AND owner = ?",
+                    (now + self.lease_seconds, user_id, owner),
+                )
+                if cursor.rowcount != 1:
+                    self._db.rollback()
+                    return False
+            self._db.executemany(
+                "INSERT OR REPLACE INTO findings (user_id, fingerprint, row_key, controls, first_seen) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (user_id, fingerprint, row_key, json.dumps(list(controls)), now)
+                    for fingerprint, row_key, controls in zip(_to_db(new_fingerprints), _to_db(new_row_keys), new_controls)
+                ],
+            )
+            self._db.executemany(
+                "DELETE FROM findings WHERE user_id = ? AND fingerprint = ?",
+                [(user_id, fingerprint) for fingerprint in _to_db(removed_fingerprints)],
+            )
+            self._db.execute("DELETE FROM gaps WHERE user_id = ?", (user_id,))
+            self._db.executemany(
+                "INSERT INTO gaps (user_id, control_id, context_hash, recommendation, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, control_id, digest, recommendation, now) for control_id, (digest, recommendation) in gaps.items()],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO users (user_id, match_version, updated_at) VALUES (?, ?, ?)",
+                (user_id, match_version, now),
+            )
+            self._db.commit()
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
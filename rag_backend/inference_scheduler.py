@@ -0,0 +1,306 @@
+# --- Fair Inference Scheduler ---
+# Orders recommendation batches from concurrent analyses so that one tenant (user_id)
+# with a large upload can't monopolize the model while others wait behind it.
+# Each analysis queues all of its batches under its tenant up front, so the tenant's whole
+# remaining demand competes for turns, and runs a batch only when the scheduler grants it one.
+# An analysis's batches run one after another (a batch becomes eligible when the previous
+# one finishes), so:
+#   - at most max_concurrency batches run at once, and at most tenant_max_concurrency
+#     of them for any one tenant (which matters once a tenant has several analyses running);
+#   - "round_robin" rotates over the tenants with queued batches; "weighted" is
+#     weighted-fair (stride) scheduling: the next turn goes to the tenant with the fewest
+#     prompts served per unit of weight;
+#   - with a token_budget, each tenant may request at most that many tokens
+#     (prompts x max_new_tokens) per budget window; the budget refills continuously and
+#     a tenant over budget waits while other tenants are served.
+# A turn covers one padded batch, so a big upload is interleaved with others batch by batch.
+# Waiting and generation happen on the caller's (analysis worker) thread; the scheduler
+# has no thread of its own.
+#
+# A tenant is forgotten once it has nothing queued or running and its token budget has
+# refilled, so state doesn't grow with the number of users ever seen. Metrics and stats
+# are reported per tenant group: each tenant with a configured weight is its own group,
+# and all other tenants share the "other" group, so user IDs don't become metric labels.
+import logging
+import threading
+import time
+from collections import deque
+
+from generation import MAX_NEW_TOKENS, generate_batched
+from metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("round_robin", "weighted")
+OTHER_GROUP = "other"
+
+
+def parse_weights(spec):
+    """Tenant weights from 'user_a=3,user_b=0.5' (tenants not listed weigh 1)."""
+    weights = {}
+    for item in (spec or "").split(","):
+        tenant, sep, weight = item.strip().rpartition("=")
+        if not sep or not tenant:
+            continue
+        try:
+            weights[tenant] = max(float(weight), 0.01)
+        except ValueError:
+            logger.warning("Ignoring invalid tenant weight %r", item)
+    return weights
+
+
+class _Turn:
+    __slots__ = ("tenant", "prompts", "tokens", "enqueued_at", "granted", "blocked", "state", "next")
+
+    def __init__(self, tenant, prompts, tokens, blocked=False):
+        self.tenant = tenant
+        self.prompts = prompts
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic() # Reset when the turn is unblocked, so waits count from then
+        self.granted = threading.Event()
+        self.blocked = blocked # True until the previous batch of the same analysis finishes
+        self.state = "queued" # "queued", "running" or "done"
+        self.next = None # The following batch of the same analysis
+
+
+class _Tenant:
+    def __init__(self, name, group, weight, token_budget):
+        self.name = name
+        self.group = group
+        self.weight = weight
+        self.queue = deque()
+        self.running = 0
+        self.pass_value = 0.0 # Prompts served / weight, for weighted dispatch
+        self.tokens_available = float(token_budget)
+        self.refilled_at = time.monotonic()
+
+
+class _GroupStats:
+    def __init__(self):
+        self.batches = 0
+        self.prompts = 0
+        self.tokens = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+
+class InferenceScheduler:
+    def __init__(self, max_concurrency=1, tenant_max_concurrency=1, policy="round_robin", weights=None,
+                 token_budget=0, budget_window_seconds=60.0, max_new_tokens=MAX_NEW_TOKENS, poll_seconds=0.5):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy '{policy}'. Expected one of {POLICIES}.")
+        self.max_concurrency = max(1, max_concurrency)
+        self.tenant_max_concurrency = max(1, tenant_max_concurrency)
+        self.policy = policy
+        self.weights = dict(weights or {})
+        self.token_budget = max(0, token_budget) # 0 means unlimited
+        self.budget_window_seconds = max(budget_window_seconds, 0.001)
+        self.max_new_tokens = max_new_tokens
+        self.poll_seconds = poll_seconds # How often waiting turns re-check budgets that have refilled
+        self._lock = threading.Lock()
+        self._tenants = {} # Only tenants with queued or running batches, or a budget still refilling
+        self._refilling = set() # Idle tenants kept until their budget is full again
+        self._groups = {} # group -> _GroupStats
+        self._active = deque() # Tenants with queued batches, in round-robin order
+        self._running = 0
+        self._virtual_time = 0.0
+
+    def generate(self, tenant, pipe, prompts, batch_size):
+        """generate_batched() with every batch waiting for the tenant's turn. Yields (position, text, ok)."""
+        batch_size = max(1, batch_size)
+        starts = range(0, len(prompts), batch_size)
+        turns = self._enqueue(tenant, [len(prompts[start:start + batch_size]) for start in starts])
+        try:
+            for start, turn in zip(starts, turns):
+                self._wait(turn)
+                try:
+                    results = list(generate_batched(pipe, prompts[start:start + batch_size], batch_size, self.max_new_tokens))
+                finally:
+                    self._release(turn)
+                # The next batch is dispatched as this turn ends, with the tenant competing on its
+                # remaining demand; its results are reported while that batch waits or runs
+                for offset, recommendation_text, ok in results:
+                    yield start + offset, recommendation_text, ok
+        finally:
+            self._abandon(turns) # Batches not run because the caller stopped early or failed
+
+    def _wait(self, turn):
+        while not turn.granted.wait(self.poll_seconds):
+            with self._lock:
+                self._dispatch_locked() # Token budgets refill over time
+
+    # --- Dispatch ---
+    def _group_of(self, name):
+        """The metrics and stats group of a tenant: its own name if it has a configured weight, else "other"."""
+        return name if name in self.weights else OTHER_GROUP
+
+    def _tenant_locked(self, name):
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            tenant = self._tenants[name] = _Tenant(name, self._group_of(name), self.weights.get(name, 1.0), self.token_budget)
+        self._refilling.discard(name)
+        return tenant
+
+    def _group_locked(self, group):
+        stats = self._groups.get(group)
+        if stats is None:
+            stats = self._groups[group] = _GroupStats()
+        return stats
+
+    def _retire_locked(self, tenant, now):
+        """Forget an idle tenant, or remember to once its token budget has refilled."""
+        if tenant.queue or tenant.running or self._tenants.get(tenant.name) is not tenant:
+            return
+        self._refill_locked(tenant, now)
+        if self.token_budget and tenant.tokens_available < self.token_budget:
+            self._refilling.add(tenant.name)
+            return
+        self._refilling.discard(tenant.name)
+        del self._tenants[tenant.name]
+
+    def _sweep_locked(self, now):
+        for name in list(self._refilling):
+            self._retire_locked(self._tenants[name], now)
+
+    def _enqueue(self, name, batch_prompts):
+        """Queue the batches of one analysis (their prompt counts, in order); returns their turns."""
+        turns = [
+            _Turn(name, prompts, prompts * self.max_new_tokens, blocked=position > 0)
+            for position, prompts in enumerate(batch_prompts)
+        ]
+        for turn, following in zip(turns, turns[1:]):
+            turn.next = following
+        if not turns:
+            return turns
+        with self._lock:
+            self._sweep_locked(time.monotonic())
+            tenant = self._tenant_locked(name)
+            if not tenant.queue and not tenant.running:
+                # A tenant returning from idle starts at the current virtual time, not with banked credit
+                tenant.pass_value = max(tenant.pass_value, self._virtual_time)
+            if not tenant.queue:
+                self._active.append(tenant)
+            tenant.queue.extend(turns)
+            SCHEDULER_QUEUE_DEPTH.inc(len(turns), tenant=tenant.group)
+            self._dispatch_locked()
+        return turns
+
+    def _refill_locked(self, tenant, now):
+        if not self.token_budget:
+            return
+        rate = self.token_budget / self.budget_window_seconds
+        tenant.tokens_available = min(self.token_budget, tenant.tokens_available + (now - tenant.refilled_at) * rate)
+        tenant.refilled_at = now
+
+    def _next_turn_locked(self, tenant, now):
+        """The tenant's first queued batch that may run now, or None."""
+        if tenant.running >= self.tenant_max_concurrency:
+            return None
+        turn = next((turn for turn in tenant.queue if not turn.blocked), None)
+        if turn is None or not self.token_budget:
+            return turn
+        self._refill_locked(tenant, now)
+        # A batch bigger than the whole budget may still run once the budget is full
+        return turn if tenant.tokens_available >= min(turn.tokens, self.token_budget) else None
+
+    def _dispatch_locked(self):
+        now = time.monotonic()
+        while self._running < self.max_concurrency:
+            eligible = []
+            for tenant in self._active:
+                turn = self._next_turn_locked(tenant, now)
+                if turn is not None:
+                    eligible.append((tenant, turn))
+            if not eligible:
+                return
+            if self.policy == "weighted":
+                tenant, turn = min(eligible, key=lambda candidate: candidate[0].pass_value)
+            else:
+                tenant, turn = eligible[0] # _active is kept in rotation order
+            tenant.queue.remove(turn)
+            self._active.remove(tenant)
+            if tenant.queue:
+                self._active.append(tenant) # Back of the rotation
+            self._virtual_time = tenant.pass_value
+            tenant.pass_value += turn.prompts / tenant.weight
+            tenant.tokens_available -= turn.tokens if self.token_budget else 0
+            tenant.running += 1
+            self._running += 1
+            turn.state = "running"
+
+            waited = now - turn.enqueued_at
+            group = self._group_locked(tenant.group)
+            group.batches += 1
+            group.prompts += turn.prompts
+            group.tokens += turn.tokens
+            group.wait_seconds_total += waited
+            group.wait_seconds_max = max(group.wait_seconds_max, waited)
+            SCHEDULER_QUEUE_DEPTH.dec(tenant=tenant.group)
+            SCHEDULER_WAIT_SECONDS.observe(waited, tenant=tenant.group)
+            turn.granted.set()
+
+    def _finish_locked(self, turn):
+        tenant = self._tenants[turn.tenant]
+        tenant.running -= 1
+        self._running -= 1
+        turn.state = "done"
+        if turn.next is not None and turn.next.blocked:
+            turn.next.blocked = False
+            turn.next.enqueued_at = time.monotonic()
+        self._retire_locked(tenant, time.monotonic())
+
+    def _release(self, turn):
+        with self._lock:
+            self._finish_locked(turn)
+            self._dispatch_locked()
+
+    def _abandon(self, turns):
+        """Give up the turns that haven't finished: release running ones and dequeue the rest."""
+        with self._lock:
+            for turn in turns:
+                if turn.state == "running":
+                    self._finish_locked(turn)
+                elif turn.state == "queued":
+                    tenant = self._tenants[turn.tenant]
+                    tenant.queue.remove(turn)
+                    turn.state = "done"
+                    if not tenant.queue and tenant in self._active:
+                        self._active.remove(tenant)
+                    SCHEDULER_QUEUE_DEPTH.dec(tenant=tenant.group)
+                    self._retire_locked(tenant, time.monotonic())
+            self._dispatch_locked()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._sweep_locked(now)
+            groups = {}
+            for group in sorted(set(self._groups) | {tenant.group for tenant in self._tenants.values()}):
+                members = [tenant for tenant in self._tenants.values() if tenant.group == group]
+                totals = self._groups.get(group) or _GroupStats()
+                groups[group] = {
+                    "weight": self.weights.get(group, 1.0),
+                    "active_tenants": sum(1 for tenant in members if tenant.queue or tenant.running),
+                    "queued_batches": sum(len(tenant.queue) for tenant in members),
+                    "running_batches": sum(tenant.running for tenant in members),
+                    "oldest_wait_seconds": round(max(
+                        (now - turn.enqueued_at for tenant in members for turn in tenant.queue if not turn.blocked),
+                        default=0.0,
+                    ), 3),
+                    "batches": totals.batches,
+                    "prompts": totals.prompts,
+                    "requested_tokens": totals.tokens,
+                    "mean_wait_seconds": round(totals.wait_seconds_total / totals.batches, 3) if totals.batches else 0.0,
+                    "max_wait_seconds": round(totals.wait_seconds_max, 3),
+                }
+            return {
+                "policy": self.policy,
+                "max_concurrency": self.max_concurrency,
+                "tenant_max_concurrency": self.tenant_max_concurrency,
+                "token_budget": self.token_budget or None,
+                "budget_window_seconds": self.budget_window_seconds,
+                "running_batches": self._running,
+                "queued_batches": sum(len(tenant.queue) for tenant in self._tenants.values()),
+                "tracked_tenants": len(self._tenants),
+                "groups": groups,
+            }
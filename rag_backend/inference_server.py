@@ -0,0 +1,431 @@
+# --- Shared Inference Server ---
+# One process owns the model and serves generation requests to every uvicorn worker
+# over a local multiprocessing.connection socket, so N HTTP workers share a single
+# model copy instead of loading N. Requests arriving from different workers within
+# max_wait_ms are merged into one padded batch (dynamic micro-batching) of up to
+# max_batch_size prompts.
+#
+#   python inference_server.py          # loads MODEL_NAME, listens on INFERENCE_SERVER_ADDRESS
+#   INFERENCE_MODE=shared uvicorn main:app --workers 4
+#
+# The HTTP side uses InferenceClient, which is called like the transformers
+# pipeline (client(prompts, max_new_tokens=..., ...)) and also stands in for
+# ModelLoader (ready, status(), pipeline) in main.py.
+#
+# Messages are pickles, so a connection is only accepted after both sides prove they
+# know the shared secret INFERENCE_SERVER_AUTHKEY. There is no default: the server
+# and shared-mode workers refuse to start without one. Connecting and the authkey
+# handshake are bounded by timeouts on both sides, and the server runs each handshake
+# on the connection's own thread, so a stalled client can't block the accept loop.
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Connection, Listener, answer_challenge, deliver_challenge
+
+from model_loader import ModelLoader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+
+
+def parse_address(address):
+    """'host:port' for TCP, anything else is a Unix socket path (or a Windows named pipe)."""
+    host, sep, port = address.rpartition(":")
+    if sep and host and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def encode_authkey(authkey):
+    if not authkey:
+        raise ValueError("An authkey is required for the inference server; set INFERENCE_SERVER_AUTHKEY to a long random secret.")
+    return authkey.encode("utf-8") if isinstance(authkey, str) else bytes(authkey)
+
+
+def set_socket_timeouts(sock, seconds):
+    """Bound blocking I/O on sock with SO_RCVTIMEO/SO_SNDTIMEO; a call that times out raises BlockingIOError."""
+    seconds = seconds or 0.0 # A zero timeval means no timeout
+    if os.name == "nt":
+        value = struct.pack("L", int(seconds * 1000))
+    else:
+        value = struct.pack("ll", int(seconds), int((seconds % 1) * 1_000_000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+
+def set_io_timeout(conn, seconds):
+    """
+    Bound blocking reads and writes on a socket-backed Connection (None clears the bound).
+    Connection bypasses Python's socket timeouts, so this works on the fd's socket options.
+    Has no effect on Windows named pipes.
+    """
+    try:
+        sock = socket.socket(fileno=conn.fileno())
+    except OSError:
+        return # Not a socket
+    try:
+        set_socket_timeouts(sock, seconds)
+    finally:
+        sock.detach() # The Connection still owns the fd
+
+
+def handshake(conn, authkey, timeout, server_side):
+    """The mutual authkey challenge of Listener.accept()/Client(), failing after timeout seconds."""
+    set_io_timeout(conn, timeout)
+    try:
+        if server_side:
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+        else:
+            answer_challenge(conn, authkey)
+            deliver_challenge(conn, authkey)
+    except BlockingIOError: # SO_RCVTIMEO/SO_SNDTIMEO expired
+        raise TimeoutError(f"Authkey handshake not completed within {timeout:.1f}s") from None
+    set_io_timeout(conn, None)
+
+
+def connect(address, authkey, timeout):
+    """multiprocessing.connection.Client() with a timeout on connecting and on the authkey handshake."""
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout=timeout)
+    elif hasattr(socket, "AF_UNIX"):
+        # A non-blocking Unix socket fails at once when the listen backlog is full,
+        # while a blocking connect waits for room, bounded by SO_SNDTIMEO
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            set_socket_timeouts(sock, timeout)
+            sock.connect(address)
+        except BlockingIOError:
+            sock.close()
+            raise TimeoutError(f"Could not connect to the inference server within {timeout:.1f}s") from None
+        except BaseException:
+            sock.close()
+            raise
+    else:
+        return Client(address, authkey=authkey) # Windows named pipe
+    sock.setblocking(True)
+    conn = Connection(sock.detach())
+    try:
+        handshake(conn, authkey, timeout, server_side=False)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+class _Request:
+    __slots__ = ("connection", "request_id", "prompts", "kwargs", "options")
+
+    def __init__(self, connection, request_id, prompts, kwargs):
+        self.connection = connection
+        self.request_id = request_id
+        self.prompts = prompts
+        self.kwargs = kwargs
+        # Only requests with the same generation options can share a batch
+        self.options = tuple(sorted((key, repr(value)) for key, value in kwargs.items() if key != "batch_size"))
+
+
+class _Connection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class InferenceServer:
+    def __init__(self, loader, address=DEFAULT_ADDRESS, authkey=None,
+                 max_batch_size=16, max_wait_ms=10.0, handshake_timeout_seconds=5.0):
+        self.loader = loader
+        self.address = parse_address(address)
+        self.authkey = encode_authkey(authkey)
+        self.handshake_timeout_seconds = handshake_timeout_seconds
+        self.backlog = 64 # Connections from every worker may arrive at once
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_seconds = max_wait_ms / 1000.0
+        self._pending = queue.Queue()
+        self._deferred = deque() # Requests taken off the queue that didn't fit the last batch
+        self._stopping = threading.Event()
+        self._counts_lock = threading.Lock()
+        self._counts = {"requests": 0, "prompts": 0, "batches": 0, "errors": 0}
+
+    # --- Serving ---
+    def serve_forever(self):
+        self.loader.start()
+        threading.Thread(target=self._batch_loop, name="inference-batcher", daemon=True).start()
+        # No authkey on the Listener: accept() would run the handshake inline, so one client that
+        # never answers would stall every other connection. Each connection thread authenticates instead.
+        with Listener(self.address, backlog=self.backlog) as listener:
+            logger.info("Inference server listening on %s for model %s.", self.address, self.loader.model_name)
+            while not self._stopping.is_set():
+                try:
+                    conn = listener.accept()
+                except OSError as e:
+                    logger.warning("Error accepting inference client: %s", e)
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+        self.loader.stop()
+
+    def _serve_connection(self, conn):
+        try:
+            handshake(conn, self.authkey, self.handshake_timeout_seconds, server_side=True)
+        except Exception as e: # Wrong authkey, or no handshake within the timeout
+            logger.warning("Rejected inference client: %s", e)
+            conn.close()
+            return
+        self._read_loop(_Connection(conn))
+
+    def _read_loop(self, connection):
+        try:
+            while True:
+                message = connection.conn.recv()
+                kind = message[0]
+                if kind == "status":
+                    connection.send(("status", self.status()))
+                elif kind == "generate":
+                    _, request_id, prompts, kwargs = message
+                    if not self.loader.ready:
+                        connection.send(("error", request_id, f"Model {self.loader.model_name} is {self.loader.state}"))
+                        continue
+                    self._pending.put(_Request(connection, request_id, prompts, kwargs))
+                else:
+                    connection.send(("error", None, f"Unknown request type {kind!r}"))
+        except (EOFError, OSError):
+            pass # Client went away
+        finally:
+            connection.conn.close()
+
+    def _next_request(self, timeout):
+        if self._deferred:
+            return self._deferred.popleft()
+        try:
+            return self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self):
+        """Block for one request, then add compatible requests until the batch is full or max_wait passes."""
+        first = None
+        while first is None and not self._stopping.is_set():
+            first = self._next_request(timeout=0.5)
+        if first is None:
+            return []
+        batch = [first]
+        prompt_count = len(first.prompts)
+        deadline = time.monotonic() + self.max_wait_seconds
+        skipped = []
+        while prompt_count < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            request = self._next_request(timeout=remaining)
+            if request is None:
+                break
+            if request.options != first.options or prompt_count + len(request.prompts) > self.max_batch_size:
+                skipped.append(request)
+                continue
+            batch.append(request)
+            prompt_count += len(request.prompts)
+        self._deferred.extendleft(reversed(skipped)) # Keep arrival order for the next batch
+        return batch
+
+    def _batch_loop(self):
+        while not self._stopping.is_set():
+            batch = self._collect_batch()
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        prompts = [prompt for request in batch for prompt in request.prompts]
+        kwargs = dict(batch[0].kwargs, batch_size=len(prompts))
+        started = time.perf_counter()
+        try:
+            outputs = self.loader.pipeline(prompts, **kwargs)
+        except Exception as e:
+            logger.exception("Error generating batch of %d prompts: %s", len(prompts), e)
+            with self._counts_lock:
+                self._counts["errors"] += 1
+            for request in batch:
+                self._reply(request, ("error", request.request_id, str(e)))
+            return
+        logger.debug(
+            "Generated %d prompts from %d requests in %.2fs", len(prompts), len(batch), time.perf_counter() - started,
+        )
+        with self._counts_lock:
+            self._counts["requests"] += len(batch)
+            self._counts["prompts"] += len(prompts)
+            self._counts["batches"] += 1
+        position = 0
+        for request in batch:
+            self._reply(request, ("result", request.request_id, outputs[position:position + len(request.prompts)]))
+            position += len(request.prompts)
+
+    def _reply(self, request, message):
+        try:
+            request.connection.send(message)
+        except (EOFError, OSError) as e:
+            logger.warning("Could not return results for request %s: %s", request.request_id, e)
+
+    def status(self):
+        with self._counts_lock:
+            counts = dict(self._counts)
+        counts["mean_batch_prompts"] = round(counts["prompts"] / counts["batches"], 2) if counts["batches"] else 0.0
+        return dict(self.loader.status(), ready=self.loader.ready, queued_requests=self._pending.qsize(), **counts)
+
+
+class InferenceClient:
+    """
+    Pipeline-compatible client for the shared inference server. Thread-safe: each
+    call borrows a connection from a small pool, so concurrent analyses are batched
+    together on the server. Also exposes the ModelLoader interface main.py uses.
+    """
+
+    tokenizer = None # Generated tokens are counted by words on this side
+
+    def __init__(self, model_name, address=DEFAULT_ADDRESS, authkey=None, timeout_seconds=300.0,
+                 connect_timeout_seconds=5.0, status_timeout_seconds=2.0, status_ttl_seconds=1.0):
+        self.model_name = model_name
+        self.address = parse_address(address)
+        self.authkey = encode_authkey(authkey)
+        self.timeout_seconds = timeout_seconds
+        self.connect_timeout_seconds = connect_timeout_seconds
+        self.status_timeout_seconds = status_timeout_seconds
+        self.status_ttl_seconds = status_ttl_seconds
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._request_ids = 0
+        self._status = None
+        self._status_at = 0.0
+
+    # --- Pipeline interface ---
+    def __call__(self, prompts, **kwargs):
+        prompts = [prompts] if isinstance(prompts, str) else list(prompts)
+        with self._lock:
+            self._request_ids += 1
+            request_id = self._request_ids
+        kind, _, payload = self._exchange(("generate", request_id, prompts, kwargs), self.timeout_seconds)
+        if kind == "error":
+            raise RuntimeError(f"Inference server error: {payload}")
+        return payload
+
+    def _exchange(self, message, timeout):
+        # A pooled connection may have been closed by a server restart; retry once on a fresh one
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.send(message)
+                if not conn.poll(timeout):
+                    # The late reply would be read by the next caller, so this connection can't be reused
+                    conn.close()
+                    raise TimeoutError(f"No reply from the inference server within {timeout:.0f}s")
+                reply = conn.recv()
+            except (EOFError, ConnectionError, BrokenPipeError):
+                conn.close()
+                if attempt:
+                    raise
+                continue
+            self._idle.put(conn)
+            return reply
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.address, self.authkey, self.connect_timeout_seconds)
+
+    # --- ModelLoader interface ---
+    @property
+    def pipeline(self):
+        return self
+
+    @property
+    def ready(self):
+        status = self.status()
+        return bool(status.get("ready")) and status.get("model_name") == self.model_name
+
+    @property
+    def state(self):
+        status = self.status()
+        if status.get("state") == "ready" and status.get("model_name") != self.model_name:
+            return "serving a different model"
+        return status.get("state", "unavailable")
+
+    def status(self):
+        """The server's status, cached for status_ttl_seconds; state 'unavailable' if it can't be reached."""
+        now = time.monotonic()
+        if self._status is not None and now - self._status_at < self.status_ttl_seconds:
+            return self._status
+        try:
+            _, status = self._exchange(("status",), self.status_timeout_seconds)
+            status = dict(status, mode="shared", server=str(self.address))
+        except Exception as e:
+            status = {"model_name": None, "state": "unavailable", "ready": False, "mode": "shared",
+                      "server": str(self.address), "last_error": str(e)}
+        self._status, self._status_at = status, now
+        return status
+
+    def start(self):
+        pass # The server owns loading
+
+    def stop(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.status_ttl_seconds)
+        return True
+
+
+def main():
+    from dotenv import load_dotenv
+    from logging_setup import configure_logging
+
+    load_dotenv()
+    configure_logging(os.environ.get("LOG_LEVEL", "INFO"), os.environ.get("LOG_FORMAT", "text"))
+    authkey = os.environ.get("INFERENCE_SERVER_AUTHKEY", "")
+    if not authkey:
+        raise SystemExit("INFERENCE_SERVER_AUTHKEY is not set; refusing to serve the model without an authkey.")
+    # Model settings are read from the same environment variables as main.py
+    loader = ModelLoader(
+        os.environ.get("MODEL_NAME", "gpt2"),
+        token=os.environ.get("HF_TOKEN", ""),
+        model_dir=os.environ.get("MODEL_DIR") or None,
+        snapshot_path=os.environ.get("MODEL_SNAPSHOT_PATH") or None,
+        retry_seconds=float(os.environ.get("MODEL_LOAD_RETRY_SECONDS", "10")),
+        max_attempts=int(os.environ.get("MODEL_LOAD_MAX_ATTEMPTS", "0")),
+        warmup=os.environ.get("MODEL_WARMUP", "1") != "0",
+    )
+    server = InferenceServer(
+        loader,
+        address=os.environ.get("INFERENCE_SERVER_ADDRESS", DEFAULT_ADDRESS),
+        authkey=authkey,
+        max_batch_size=int(os.environ.get("INFERENCE_MAX_BATCH_SIZE", "16")),
+        max_wait_ms=float(os.environ.get("INFERENCE_MAX_WAIT_MS", "10")),
+        handshake_timeout_seconds=float(os.environ.get("INFERENCE_CONNECT_TIMEOUT_SECONDS", "5")),
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# --- Streaming Findings Ingest ---
+# Reads an uploaded findings file in chunks, loading only the columns the analysis
+# and persistence actually use. The delimiter is sniffed from the first few KB
+# instead of re-parsing the whole file with each candidate delimiter.
+#
+# Besides plain CSV, uploads may be gzip- or zstd-compressed CSV (decompressed as a
+# stream), Parquet or Arrow IPC (file or stream format). The format is detected from
+# the magic bytes at the start of the file, not the filename. Columnar formats are read
+# through pyarrow, column-projected to the needed columns and memory-mapped when the
+# upload is backed by a file on disk. pyarrow (and zstandard before Python 3.14) are
+# optional: without them those formats raise UnsupportedUploadFormat.
+import csv
+import gzip
+import io
+import mmap
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Columns read from the upload (adjust based on your actual CSVs)
+SEVERITY_COLUMN = 'finding.severity'
+ALT_SEVERITY_COLUMNS = ('Severity',) # Alternative common names for the severity column
+CATEGORY_COLUMN = 'finding.category'
+DESCRIPTION_COLUMN = 'finding.description'
+RESOURCE_NAME_COLUMN = 'resource.display_name'
+RESOURCE_TYPE_COLUMN = 'resource.type'
+FINDING_COLUMNS = (
+    CATEGORY_COLUMN, SEVERITY_COLUMN, DESCRIPTION_COLUMN,
+    RESOURCE_NAME_COLUMN, RESOURCE_TYPE_COLUMN,
+)
+
+CANDIDATE_DELIMITERS = ",;\t|"
+SNIFF_BYTES = 64 * 1024
+
+# Upload formats, detected by detect_format()
+CSV = "csv"
+GZIP_CSV = "csv+gzip"
+ZSTD_CSV = "csv+zstd"
+PARQUET = "parquet"
+ARROW_FILE = "arrow"
+ARROW_STREAM = "arrow_stream"
+COLUMNAR_FORMATS = (PARQUET, ARROW_FILE, ARROW_STREAM)
+FORMAT_NAMES = {
+    CSV: "CSV", GZIP_CSV: "gzip-compressed CSV", ZSTD_CSV: "zstd-compressed CSV",
+    PARQUET: "Parquet", ARROW_FILE: "Arrow IPC", ARROW_STREAM: "Arrow IPC stream",
+}
+MAGIC_BYTES = (
+    (b"PAR1", PARQUET),
+    (b"ARROW1", ARROW_FILE),
+    (b"\xff\xff\xff\xff", ARROW_STREAM), # Continuation marker before the first stream message
+    (b"\x1f\x8b", GZIP_CSV),
+    (b"\x28\xb5\x2f\xfd", ZSTD_CSV),
+)
+
+
+class UnsupportedUploadFormat(Exception):
+    """The upload's format was recognized but can't be read with the installed libraries."""
+
+
+def detect_format(file_obj):
+    """The upload format according to the file's first bytes; anything unrecognized is CSV. Leaves the file at offset 0."""
+    file_obj.seek(0)
+    head = file_obj.read(8)
+    file_obj.seek(0)
+    for magic, upload_format in MAGIC_BYTES:
+        if head.startswith(magic):
+            return upload_format
+    return CSV
+
+
+def sniff_delimiter(file_obj, sample_bytes=SNIFF_BYTES):
+    """Guess the delimiter from the start of the file, falling back to a comma. Leaves the file at offset 0."""
+    file_obj.seek(0)
+    sample = file_obj.read(sample_bytes)
+    file_obj.seek(0)
+    return delimiter_from_sample(sample, sample_bytes)
+
+
+def delimiter_from_sample(sample, sample_bytes=SNIFF_BYTES):
+    """Guess the delimiter from the first sample_bytes of a CSV, falling back to a comma."""
+    if isinstance(sample, bytes):
+        sample = sample.decode("utf-8", errors="replace")
+    # Only sniff complete lines so a row cut off mid-way doesn't confuse the sniffer
+    if len(sample) >= sample_bytes and "\n" in sample:
+        sample = sample[:sample.rfind("\n")]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=CANDIDATE_DELIMITERS).delimiter
+    except csv.Error:
+        header = sample.split("\n", 1)[0]
+        counts = {delimiter: header.count(delimiter) for delimiter in CANDIDATE_DELIMITERS}
+        best = max(counts, key=counts.get)
+        return best if counts[best] else ","
+
+
+def read_header(file_obj, delimiter):
+    """Return the column names of the CSV without reading its rows. Leaves the file at offset 0."""
+    file_obj.seek(0)
+    columns = pd.read_csv(file_obj, sep=delimiter, nrows=0).columns.tolist()
+    file_obj.seek(0)
+    return columns
+
+
+def resolve_severity_column(columns):
+    """Return the severity column present in the header, or None."""
+    for column in (SEVERITY_COLUMN,) + ALT_SEVERITY_COLUMNS:
+        if column in columns:
+            return column
+    return None
+
+
+def select_columns(columns, severity_column):
+    """The subset of the header the analysis needs, in file order."""
+    wanted = set(FINDING_COLUMNS) | {severity_column}
+    return [column for column in columns if column in wanted]
+
+
+def iter_finding_chunks(file_obj, delimiter, usecols, chunk_rows):
+    """
+    Yield DataFrame chunks of at most chunk_rows rows holding only usecols.
+    Row indexes continue across chunks, so they match a single full read.
+    """
+    if file_obj.seekable():
+        file_obj.seek(0)
+    with pd.read_csv(file_obj, sep=delimiter, usecols=usecols, chunksize=max(1, chunk_rows)) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def open_decompressed(file_obj, upload_format):
+    """A new stream of the decompressed CSV, read from the start of the compressed upload."""
+    file_obj.seek(0)
+    if upload_format == GZIP_CSV:
+        return gzip.GzipFile(fileobj=file_obj, mode="rb")
+    try:
+        from compression import zstd # Python 3.14+
+        return zstd.ZstdFile(file_obj, mode="rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise UnsupportedUploadFormat("Reading zstd-compressed CSV uploads requires the 'zstandard' package.")
+    return zstandard.ZstdDecompressor().stream_reader(file_obj, closefd=False)
+
+
+def arrow_source(file_obj):
+    """
+    A pyarrow input for the upload. Uploads backed by a file on disk are memory-mapped, so
+    pyarrow reads the needed column pages in place instead of copying the whole file.
+    """
+    try:
+        file_obj.flush() # Buffered writes must reach the file before it is mapped
+        mapped = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        file_obj.seek(0)
+        return pa.PythonFile(file_obj, mode="r")
+    return pa.BufferReader(pa.py_buffer(mapped))
+
+
+class ColumnarReader:
+    """Column names and projected record batches of a Parquet or Arrow IPC upload."""
+
+    def __init__(self, file_obj, upload_format):
+        if pa is None:
+            raise UnsupportedUploadFormat(f"Reading {FORMAT_NAMES[upload_format]} uploads requires the 'pyarrow' package.")
+        self.file_obj = file_obj
+        self.upload_format = upload_format
+        self.columns = self._open().schema_arrow.names if upload_format == PARQUET else self._open().schema.names
+
+    def _open(self):
+        source = arrow_source(self.file_obj)
+        if self.upload_format == PARQUET:
+            return pq.ParquetFile(source)
+        if self.upload_format == ARROW_FILE:
+            return pa.ipc.open_file(source)
+        return pa.ipc.open_stream(source)
+
+    def iter_batches(self, usecols, chunk_rows):
+        reader = self._open()
+        if self.upload_format == PARQUET:
+            # Only the pages of usecols are read
+            yield from reader.iter_batches(batch_size=chunk_rows, columns=usecols)
+            return
+        batches = (
+            (reader.get_batch(i) for i in range(reader.num_record_batches))
+            if self.upload_format == ARROW_FILE else reader
+        )
+        for batch in batches:
+            batch = batch.select(usecols)
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield batch.slice(start, chunk_rows)
+
+    def iter_chunks(self, usecols, chunk_rows):
+        """Like iter_finding_chunks: DataFrame chunks of usecols with row indexes continuing across chunks."""
+        chunk_rows = max(1, chunk_rows)
+        start = 0
+        for batch in self.iter_batches(usecols, chunk_rows):
+            if not batch.num_rows:
+                continue
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+
+
+class FindingsUpload:
+    """
+    An uploaded findings file of any supported format: its format, header columns and
+    (for CSV) delimiter, and chunked reads of the selected columns.
+    Raises UnsupportedUploadFormat if a needed optional library is missing.
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.format = detect_format(file_obj)
+        self.delimiter = None
+        self._columnar = None
+        if self.format in COLUMNAR_FORMATS:
+            self._columnar = ColumnarReader(file_obj, self.format)
+            self.columns = self._columnar.columns
+        elif self.format == CSV:
+            self.delimiter = sniff_delimiter(file_obj)
+            self.columns = read_header(file_obj, self.delimiter)
+        else:
+            with open_decompressed(file_obj, self.format) as stream:
+                self.delimiter = delimiter_from_sample(stream.read(SNIFF_BYTES))
+            with open_decompressed(file_obj, self.format) as stream:
+                self.columns = pd.read_csv(stream, sep=self.delimiter, nrows=0).columns.tolist()
+
+    @property
+    def format_name(self):
+        return FORMAT_NAMES[self.format]
+
+    def iter_chunks(self, usecols, chunk_rows):
+        if self._columnar is not None:
+            yield from self._columnar.iter_chunks(usecols, chunk_rows)
+        elif self.format == CSV:
+            yield from iter_finding_chunks(self.file_obj, self.delimiter, usecols, chunk_rows)
+        else:
+            with open_decompressed(self.file_obj, self.format) as stream:
+                yield from iter_finding_chunks(stream, self.delimiter, usecols, chunk_rows)
@@ -0,0 +1,134 @@
+# --- Asynchronous Analysis Jobs ---
+# An AnalysisJob records the progress events published by the analysis worker
+# (a plain thread) and fans them out to any number of event-stream subscribers
+# running on the asyncio loop. Late subscribers replay the events they missed,
+# so a client can reconnect with Last-Event-ID and continue where it left off.
+import asyncio
+import threading
+import time
+import uuid
+
+# Event names that end a job's event stream
+TERMINAL_EVENTS = frozenset({"result", "error"})
+
+
+class AnalysisJob:
+    def __init__(self, user_id, filename):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.filename = filename
+        self.status = "queued" # queued -> running -> completed | failed
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._lock = threading.Lock()
+        self._events = [] # (sequence, event, data)
+        self._subscribers = [] # (loop, asyncio.Queue)
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed")
+
+    def mark_running(self):
+        with self._lock:
+            self.status = "running"
+            self.started_at = time.time()
+
+    def publish(self, event, data):
+        """Record an event and deliver it to current subscribers. Safe to call from any thread."""
+        with self._lock:
+            entry = (len(self._events) + 1, event, data)
+            self._events.append(entry)
+            if event == "result":
+                self.status, self.result, self.finished_at = "completed", data, time.time()
+            elif event == "error":
+                self.status, self.error, self.finished_at = "failed", data, time.time()
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, entry)
+            except RuntimeError:
+                pass # Subscriber's loop has closed
+
+    async def stream(self, after=0, keepalive_seconds=15.0):
+        """
+        Yield (sequence, event, data) for every event after the given sequence number,
+        ending after the terminal event. Yields None when keepalive_seconds pass without an event.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        subscriber = (loop, queue)
+        with self._lock:
+            backlog = [entry for entry in self._events if entry[0] > after]
+            done = self.finished
+            if not done:
+                self._subscribers.append(subscriber)
+        try:
+            for entry in backlog:
+                yield entry
+            if done:
+                return
+            while True:
+                try:
+                    entry = await asyncio.wait_for(queue.get(), keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if entry[0] > after:
+                    yield entry
+                if entry[1] in TERMINAL_EVENTS:
+                    return
+        finally:
+            with self._lock:
+                if subscriber in self._subscribers:
+                    self._subscribers.remove(subscriber)
+
+    def describe(self):
+        with self._lock:
+            description = {
+                "job_id": self.id,
+                "status": self.status,
+                "user_id": self.user_id,
+                "filename": self.filename,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "events": len(self._events),
+            }
+            if self.status == "completed":
+                description["result"] = self.result
+            elif self.status == "failed":
+                description["error"] = self.error
+        return description
+
+
+class JobStore:
+    """In-memory job registry. Finished jobs are dropped ttl_seconds after they finish."""
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def create(self, user_id, filename):
+        job = AnalysisJob(user_id, filename)
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -1,13 +1,45 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException # Added HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header # Added HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import pandas as pd
+import numpy as np
 import os
+import asyncio
+import logging
+import json
+import shutil
+import tempfile
 from contextlib import asynccontextmanager
 # --- Add Supabase imports ---
 from supabase import create_client, Client
-import traceback # For detailed error logging
 
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+from cmmc_schema import REQUIREMENT_COLUMN, load_schema, schema_mtime
+from retrieval_index import RetrievalMatcher
+from control_matcher import DeduplicatingMatcher, normalize_descriptions
+from generation import build_prompt, summarize_findings
+from model_loader import ModelLoader
+from inference_server import InferenceClient, DEFAULT_ADDRESS as DEFAULT_INFERENCE_SERVER_ADDRESS
+from worker_pool import AnalysisPool, PoolSaturated
+from inference_scheduler import InferenceScheduler, parse_weights
+from jobs import JobStore
+from recommendation_cache import RecommendationCache, cache_key
+from persistence import (
+    INDIVIDUAL_FINDINGS_COLUMN_MAPPING, iter_finding_records, store_analysis, create_storage,
+)
+from write_behind import WriteBehindQueue
+from incremental import (
+    FindingStateStore, FindingDelta, UserBusy, fingerprint_rows, row_keys, row_controls, fingerprint_hex, context_hash, gap_delta,
+)
+from logging_setup import configure_logging
+from metrics import (
+    REGISTRY, STAGE_SECONDS, ROWS_TOTAL, HIGH_FINDINGS_TOTAL, MATCHED_CONTROLS_TOTAL,
+    RECOMMENDATIONS_TOTAL, ANALYSES_TOTAL, ANALYSES_IN_FLIGHT, timed,
+)
+from ingest import (
+    FindingsUpload, UnsupportedUploadFormat, resolve_severity_column, select_columns,
+    SEVERITY_COLUMN, CATEGORY_COLUMN, DESCRIPTION_COLUMN, RESOURCE_NAME_COLUMN, RESOURCE_TYPE_COLUMN,
+)
 
 # --- Add dotenv import ---
 from dotenv import load_dotenv
@@ -15,13 +47,23 @@ from dotenv import load_dotenv
 # --- Load environment variables from .env file ---
 load_dotenv() # This will load variables from .env into os.environ
 
+# --- Logging ---
+# LOG_LEVEL: DEBUG, INFO (default), WARNING or ERROR. LOG_FORMAT: "text" (default) or "json".
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+configure_logging(LOG_LEVEL, LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
 # --- Global Variables ---
 # Paths to reference CSV files
 CMMC_SCHEMA_PATH = "/Users/rajbehera/Downloads/docs/CMMCSchema.csv"
 USERS_ROWS_PATH = "/Users/rajbehera/Downloads//docs/users_rows.csv"
+# How often (seconds) to check CMMC_SCHEMA_PATH for changes; 0 disables hot reload
+CMMC_SCHEMA_POLL_SECONDS = float(os.environ.get("CMMC_SCHEMA_POLL_SECONDS", "30"))
 
-# Global DataFrames for reference data
-cmmc_schema_df = None
+# Global reference data. cmmc_schema is an immutable CMMCSchema snapshot that is
+# replaced as a whole when the schema file changes; handlers read it once per request.
+cmmc_schema = None
 users_df = None
 
 # --- Supabase Configuration (Reads VITE_ prefixed variables from environment) ---
@@ -31,71 +73,301 @@ SUPABASE_URL = os.environ.get("VITE_SUPABASE_URL", "NOT_SET")
 SUPABASE_KEY = os.environ.get("VITE_SUPABASE_KEY", "NOT_SET") # Use the service key
 supabase: Client = None
 
+# --- Storage Configuration ---
+# STORAGE_BACKEND selects where results go: "supabase" (default), or "sqlite"/"jsonl" to keep
+# them in a local file at STORAGE_PATH (useful for tests and benchmarks without network access).
+# With PERSISTENCE_MODE "write_behind" (default) results are journaled locally and flushed to the
+# backend in the background; "sync" stores them before the response is returned.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+STORAGE_PATH = os.environ.get("STORAGE_PATH") or None
+PERSISTENCE_MODE = os.environ.get("PERSISTENCE_MODE", "write_behind")
+WRITE_BEHIND_JOURNAL_PATH = os.environ.get("WRITE_BEHIND_JOURNAL_PATH", "write_behind_journal.sqlite3")
+# Workers sharing a journal lease the entries they flush; an entry whose flusher died is retried after this long
+WRITE_BEHIND_LEASE_SECONDS = float(os.environ.get("WRITE_BEHIND_LEASE_SECONDS", "60"))
+# An entry that fails this many times is parked in the journal (listed in /storage/stats) instead of retried; 0 = retry forever
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+storage_backend = None
+write_behind_queue = None
+
 # Function to load CSV safely
 def load_csv(path, description):
     if os.path.exists(path):
         try:
             df = pd.read_csv(path)
-            print(f"Successfully loaded {description} from {path}")
+            logger.info("Successfully loaded %s from %s", description, path)
             return df
         except Exception as e:
-            print(f"Error loading {description} CSV ({path}): {e}")
+            logger.error("Error loading %s CSV (%s): %s", description, path, e)
             return None
     else:
-        print(f"Warning: {description} file not found at {path}")
+        logger.warning("%s file not found at %s", description, path)
         return None
 
+# --- Finding-to-Control Matching ---
+# MATCHING_MODE "retrieval" (default) scores findings against a TF-IDF index of the Requirement
+# Statements and keeps the top RETRIEVAL_TOP_K controls scoring at least RETRIEVAL_THRESHOLD;
+# "keyword" uses the original keyword-overlap matcher. The index is cached in RETRIEVAL_INDEX_DIR.
+MATCHING_MODE = os.environ.get("MATCHING_MODE", "retrieval")
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_THRESHOLD = float(os.environ.get("RETRIEVAL_THRESHOLD", "0.2"))
+RETRIEVAL_INDEX_DIR = os.environ.get("RETRIEVAL_INDEX_DIR", "retrieval_index_cache")
+# Number of other retrieved requirements added to each prompt as extra context
+RETRIEVAL_PROMPT_RELATED = int(os.environ.get("RETRIEVAL_PROMPT_RELATED", "2"))
+
+def select_matcher(schema):
+    # The matcher for this schema snapshot according to MATCHING_MODE
+    if MATCHING_MODE == "retrieval" and schema.retrieval_index is not None:
+        return RetrievalMatcher(schema.retrieval_index, RETRIEVAL_TOP_K, RETRIEVAL_THRESHOLD)
+    return schema.matcher
+
+def related_requirements_for(schema, control_id, finding_desc):
+    # Requirements retrieved for the finding other than control_id itself, as (control_id, statement) pairs
+    if MATCHING_MODE != "retrieval" or schema.retrieval_index is None or not finding_desc or RETRIEVAL_PROMPT_RELATED <= 0:
+        return []
+    retrieved = schema.retrieval_index.search(
+        [finding_desc.lower()], RETRIEVAL_PROMPT_RELATED + 1, RETRIEVAL_THRESHOLD
+    )[0]
+    related = [
+        (related_id, schema.retrieval_index.statement(related_id))
+        for related_id, _ in retrieved if related_id != control_id
+    ]
+    return related[:RETRIEVAL_PROMPT_RELATED]
+
+# --- CMMC schema hot reload ---
+async def watch_cmmc_schema():
+    # Poll the schema file's mtime and rebuild the snapshot off the event loop when it changes.
+    global cmmc_schema
+    while True:
+        await asyncio.sleep(CMMC_SCHEMA_POLL_SECONDS)
+        try:
+            mtime = schema_mtime(CMMC_SCHEMA_PATH)
+            current = cmmc_schema
+            if mtime is None or (current is not None and current.mtime == mtime):
+                continue
+            logger.info("CMMC Schema at %s changed, rebuilding...", CMMC_SCHEMA_PATH)
+            new_schema = await asyncio.to_thread(load_schema, CMMC_SCHEMA_PATH, RETRIEVAL_INDEX_DIR)
+            if new_schema is not None:
+                cmmc_schema = new_schema # Atomic swap; in-flight requests keep their snapshot
+        except Exception as e:
+            logger.error("Error reloading CMMC Schema: %s", e)
+
+# --- Analysis Worker Pool ---
+# Parsing, matching, inference and Supabase writes run on this pool instead of the event loop.
+# ANALYSIS_WORKERS analyses run at once and up to ANALYSIS_QUEUE_SIZE more wait; beyond that uploads get a 503.
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "2"))
+ANALYSIS_QUEUE_SIZE = int(os.environ.get("ANALYSIS_QUEUE_SIZE", "8"))
+ANALYSIS_RETRY_AFTER_SECONDS = int(os.environ.get("ANALYSIS_RETRY_AFTER_SECONDS", "30"))
+# On shutdown, accepted analyses get this long to finish (and journal their results) before queued ones are cancelled
+ANALYSIS_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("ANALYSIS_SHUTDOWN_TIMEOUT_SECONDS", "120"))
+analysis_pool = None
+
+# --- Analysis Jobs ---
+# Jobs submitted through /analysis_jobs/ are kept in memory this long after they finish.
+ANALYSIS_JOB_TTL_SECONDS = float(os.environ.get("ANALYSIS_JOB_TTL_SECONDS", "3600"))
+# Seconds between keep-alive comments on an idle event stream, so proxies don't close it
+ANALYSIS_JOB_KEEPALIVE_SECONDS = float(os.environ.get("ANALYSIS_JOB_KEEPALIVE_SECONDS", "15"))
+job_store = JobStore(ANALYSIS_JOB_TTL_SECONDS)
+
+# --- Recommendation Cache ---
+# Generated recommendations are cached by (MODEL_NAME, control ID, prompt) in memory and in SQLite.
+# Set RECOMMENDATION_CACHE_PATH to an empty string to keep the cache in memory only.
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get("RECOMMENDATION_CACHE_SIZE", "1024"))
+RECOMMENDATION_CACHE_TTL_SECONDS = float(os.environ.get("RECOMMENDATION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+RECOMMENDATION_CACHE_PATH = os.environ.get("RECOMMENDATION_CACHE_PATH", "recommendation_cache.sqlite3")
+RECOMMENDATION_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("RECOMMENDATION_CACHE_MAX_DISK_ENTRIES", "100000"))
+recommendation_cache = None
+
+# --- Upload Ingest ---
+# Uploads are read in chunks of this many rows; HIGH findings are matched as each chunk arrives.
+INGEST_CHUNK_ROWS = int(os.environ.get("INGEST_CHUNK_ROWS", "50000"))
+
+# --- Individual Findings Bulk Insert ---
+FINDINGS_INSERT_BATCH_SIZE = int(os.environ.get("FINDINGS_INSERT_BATCH_SIZE", "1000"))
+FINDINGS_INSERT_CONCURRENCY = int(os.environ.get("FINDINGS_INSERT_CONCURRENCY", "4"))
+FINDINGS_INSERT_RETRIES = int(os.environ.get("FINDINGS_INSERT_RETRIES", "3"))
+
+# --- Incremental Re-analysis ---
+# Uploads submitted with incremental=true are compared with the user's previous incremental analysis,
+# kept in this SQLite file: only added or changed findings are matched and stored, findings that
+# disappeared are marked resolved, and unchanged gaps reuse their previous recommendation.
+# A user has one incremental analysis at a time (across workers); a second one gets a 409. A lease left
+# by a crashed worker expires after INCREMENTAL_LEASE_SECONDS.
+INCREMENTAL_STATE_PATH = os.environ.get("INCREMENTAL_STATE_PATH", "incremental_state.sqlite3")
+INCREMENTAL_LEASE_SECONDS = float(os.environ.get("INCREMENTAL_LEASE_SECONDS", "900"))
+finding_state = None
+
 # --- REMOVE In-memory store ---
 # data_store = {}
 
 # --- Model Loading Variables ---
 # Load HF token from env if desired, otherwise use the hardcoded one
 HF_TOKEN = os.environ.get("HF_TOKEN", "")
-MODEL_NAME = "gpt2"
-tokenizer = None
-model = None
-rag_pipeline = None
+MODEL_NAME = os.environ.get("MODEL_NAME", "gpt2")
+# Number of prompts sent to the text-generation pipeline per padded batch
+RAG_BATCH_SIZE = int(os.environ.get("RAG_BATCH_SIZE", "8"))
+# The model loads in the background so the server starts immediately; /readyz reports when it's ready.
+# MODEL_LOADING "background" (default) starts loading at startup, "lazy" on the first analysis or /readyz.
+# MODEL_DIR: local save_pretrained() directory to load from (filled from the Hub on first start if missing).
+# MODEL_SNAPSHOT_PATH: torch.save() snapshot of the loaded model, written after the first load; fastest start.
+MODEL_LOADING = os.environ.get("MODEL_LOADING", "background")
+MODEL_DIR = os.environ.get("MODEL_DIR") or None
+MODEL_SNAPSHOT_PATH = os.environ.get("MODEL_SNAPSHOT_PATH") or None
+MODEL_LOAD_RETRY_SECONDS = float(os.environ.get("MODEL_LOAD_RETRY_SECONDS", "10"))
+MODEL_LOAD_MAX_ATTEMPTS = int(os.environ.get("MODEL_LOAD_MAX_ATTEMPTS", "0")) # 0 retries forever
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "1") != "0"
+# INFERENCE_MODE "in_process" (default) loads the model in this process. "shared" sends generation to
+# the inference server (python inference_server.py, which reads the same MODEL_* settings), so several
+# uvicorn workers share one model copy and their requests are batched together. Shared mode requires
+# INFERENCE_SERVER_AUTHKEY, the secret the server was started with.
+INFERENCE_MODE = os.environ.get("INFERENCE_MODE", "in_process")
+INFERENCE_SERVER_ADDRESS = os.environ.get("INFERENCE_SERVER_ADDRESS", DEFAULT_INFERENCE_SERVER_ADDRESS)
+INFERENCE_SERVER_AUTHKEY = os.environ.get("INFERENCE_SERVER_AUTHKEY", "")
+INFERENCE_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_TIMEOUT_SECONDS", "300"))
+INFERENCE_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("INFERENCE_CONNECT_TIMEOUT_SECONDS", "5"))
+model_loader = None # ModelLoader, or the InferenceClient in shared mode
+
+# --- Fair Inference Scheduling ---
+# Recommendation batches from concurrent analyses take turns on the model per tenant (user_id), so a
+# large upload can't hold it while other users wait (see inference_scheduler.py).
+# INFERENCE_SCHEDULER_POLICY: "round_robin" (default) or "weighted" by INFERENCE_TENANT_WEIGHTS ("alice=3,bob=0.5").
+# Metrics and /inference_scheduler/stats report the tenants in INFERENCE_TENANT_WEIGHTS by name and everyone else as "other".
+# INFERENCE_MAX_CONCURRENT_BATCHES batches run at once, at most INFERENCE_TENANT_MAX_CONCURRENT_BATCHES per tenant
+# (an analysis runs its batches one at a time, so the per-tenant limit applies across a tenant's concurrent uploads).
+# INFERENCE_TENANT_TOKEN_BUDGET: tokens (prompts x max_new_tokens) a tenant may request per
+# INFERENCE_TENANT_BUDGET_WINDOW_SECONDS; 0 disables the budget.
+INFERENCE_SCHEDULER_POLICY = os.environ.get("INFERENCE_SCHEDULER_POLICY", "round_robin")
+INFERENCE_MAX_CONCURRENT_BATCHES = int(os.environ.get("INFERENCE_MAX_CONCURRENT_BATCHES", "1"))
+INFERENCE_TENANT_MAX_CONCURRENT_BATCHES = int(os.environ.get("INFERENCE_TENANT_MAX_CONCURRENT_BATCHES", "1"))
+INFERENCE_TENANT_WEIGHTS = os.environ.get("INFERENCE_TENANT_WEIGHTS", "")
+INFERENCE_TENANT_TOKEN_BUDGET = int(os.environ.get("INFERENCE_TENANT_TOKEN_BUDGET", "0"))
+INFERENCE_TENANT_BUDGET_WINDOW_SECONDS = float(os.environ.get("INFERENCE_TENANT_BUDGET_WINDOW_SECONDS", "60"))
+# At most this many recommendations are generated per upload (0 = no cap). Controls triggered by the most
+# HIGH findings go first; the rest get a placeholder. Cached and reused recommendations don't count.
+RECOMMENDATION_MAX_PER_UPLOAD = int(os.environ.get("RECOMMENDATION_MAX_PER_UPLOAD", "0"))
+inference_scheduler = InferenceScheduler(
+    max_concurrency=INFERENCE_MAX_CONCURRENT_BATCHES,
+    tenant_max_concurrency=INFERENCE_TENANT_MAX_CONCURRENT_BATCHES,
+    policy=INFERENCE_SCHEDULER_POLICY,
+    weights=parse_weights(INFERENCE_TENANT_WEIGHTS),
+    token_budget=INFERENCE_TENANT_TOKEN_BUDGET,
+    budget_window_seconds=INFERENCE_TENANT_BUDGET_WINDOW_SECONDS,
+)
+
+def load_reference_data():
+    # Read CMMCSchema.csv (building or loading its retrieval index) and the users CSV.
+    global cmmc_schema, users_df
+    logger.info("Loading reference data...")
+    try:
+        cmmc_schema = load_schema(CMMC_SCHEMA_PATH, RETRIEVAL_INDEX_DIR)
+    except Exception as e:
+        logger.exception("Error building CMMC Schema snapshot: %s", e)
+    users_df = load_csv(USERS_ROWS_PATH, "Users Rows")
+    logger.info("Reference data loading complete.")
 
 # --- Lifespan Management (Load models, reference data, and init Supabase client) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load reference data
-    global cmmc_schema_df, users_df
-    print("Loading reference data...")
-    cmmc_schema_df = load_csv(CMMC_SCHEMA_PATH, "CMMC Schema")
-    users_df = load_csv(USERS_ROWS_PATH, "Users Rows")
-    print("Reference data loading complete.")
-
-    # Load the model and pipeline on startup
-    global tokenizer, model, rag_pipeline
-    print("Loading model and tokenizer...")
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, token=HF_TOKEN)
-        model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, token=HF_TOKEN)
-        rag_pipeline = pipeline("text-generation", model=model, tokenizer=tokenizer)
-        print("Model and pipeline loaded successfully.")
-    except Exception as e:
-        print(f"Error loading model/pipeline: {e}")
+    if INFERENCE_MODE == "shared" and not INFERENCE_SERVER_AUTHKEY:
+        raise RuntimeError("INFERENCE_MODE is 'shared' but INFERENCE_SERVER_AUTHKEY is not set.")
+
+    # Load reference data off the startup path; /readyz reports when it is available
+    reference_data_task = asyncio.create_task(asyncio.to_thread(load_reference_data))
+
+    # Load the model and pipeline in the background, retrying failed loads
+    global model_loader
+    if INFERENCE_MODE == "shared":
+        model_loader = InferenceClient(
+            MODEL_NAME, INFERENCE_SERVER_ADDRESS, INFERENCE_SERVER_AUTHKEY, timeout_seconds=INFERENCE_TIMEOUT_SECONDS,
+            connect_timeout_seconds=INFERENCE_CONNECT_TIMEOUT_SECONDS,
+        )
+        logger.info("Using the shared inference server at %s for model %s.", INFERENCE_SERVER_ADDRESS, MODEL_NAME)
+    else:
+        model_loader = ModelLoader(
+            MODEL_NAME, token=HF_TOKEN, model_dir=MODEL_DIR, snapshot_path=MODEL_SNAPSHOT_PATH,
+            retry_seconds=MODEL_LOAD_RETRY_SECONDS, max_attempts=MODEL_LOAD_MAX_ATTEMPTS, warmup=MODEL_WARMUP,
+        )
+        if MODEL_LOADING != "lazy":
+            model_loader.start()
 
     # --- Initialize Supabase client ---
     global supabase
-    print("Initializing Supabase client...")
+    logger.info("Initializing Supabase client...")
     try:
         # Check if the VITE_ prefixed variables were loaded correctly
         if SUPABASE_URL == "NOT_SET" or SUPABASE_KEY == "NOT_SET":
-             print("Warning: VITE_SUPABASE_URL or VITE_SUPABASE_KEY not found in environment variables or .env file. Supabase integration will be disabled.")
+             logger.warning("VITE_SUPABASE_URL or VITE_SUPABASE_KEY not found in environment variables or .env file. Supabase integration will be disabled.")
         else:
              supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-             print("Supabase client initialized successfully.")
+             logger.info("Supabase client initialized successfully.")
     except Exception as e:
-        print(f"Error initializing Supabase client: {e}")
-        # Optionally print URL to check if it looks correct (DO NOT print the key)
-        print(f"Attempted to use Supabase URL: {SUPABASE_URL}")
+        # Log the URL to check if it looks correct (DO NOT log the key)
+        logger.error("Error initializing Supabase client: %s (Supabase URL: %s)", e, SUPABASE_URL)
     # --- End Supabase initialization ---
 
+    # --- Initialize storage backend and write-behind queue ---
+    global storage_backend, write_behind_queue
+    try:
+        storage_backend = create_storage(STORAGE_BACKEND, supabase_client=supabase, path=STORAGE_PATH)
+        if storage_backend is None:
+            logger.warning("Storage backend '%s' is not available. Results will not be stored.", STORAGE_BACKEND)
+        elif PERSISTENCE_MODE == "write_behind":
+            write_behind_queue = WriteBehindQueue(
+                WRITE_BEHIND_JOURNAL_PATH, storage_backend,
+                chunk_rows=FINDINGS_INSERT_BATCH_SIZE, max_concurrency=FINDINGS_INSERT_CONCURRENCY,
+                lease_seconds=WRITE_BEHIND_LEASE_SECONDS, max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+            )
+            write_behind_queue.start() # Also resumes entries left over from a previous run
+            logger.info("Write-behind queue started for '%s' storage, journal at %s.", STORAGE_BACKEND, WRITE_BEHIND_JOURNAL_PATH)
+        else:
+            logger.info("Storing results synchronously in '%s' storage.", STORAGE_BACKEND)
+    except Exception as e:
+        logger.exception("Error initializing storage backend '%s': %s", STORAGE_BACKEND, e)
+
+    global recommendation_cache
+    try:
+        recommendation_cache = RecommendationCache(
+            max_entries=RECOMMENDATION_CACHE_SIZE,
+            ttl_seconds=RECOMMENDATION_CACHE_TTL_SECONDS,
+            db_path=RECOMMENDATION_CACHE_PATH,
+            max_disk_entries=RECOMMENDATION_CACHE_MAX_DISK_ENTRIES,
+        )
+    except Exception as e:
+        logger.error("Error opening recommendation cache at %s, using memory only: %s", RECOMMENDATION_CACHE_PATH, e)
+        recommendation_cache = RecommendationCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL_SECONDS)
+
+    global finding_state
+    try:
+        finding_state = FindingStateStore(INCREMENTAL_STATE_PATH, lease_seconds=INCREMENTAL_LEASE_SECONDS)
+    except Exception as e:
+        logger.error("Error opening incremental analysis state at %s: %s", INCREMENTAL_STATE_PATH, e)
+
+    global analysis_pool
+    analysis_pool = AnalysisPool(ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE)
+    logger.info("Analysis pool started with %d workers and a queue of %d.", ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE)
+
+    schema_watcher = None
+    if CMMC_SCHEMA_POLL_SECONDS > 0:
+        schema_watcher = asyncio.create_task(watch_cmmc_schema())
+
     yield
     # Clean up resources if needed on shutdown (optional)
-    print("Shutting down...")
+    logger.info("Shutting down...")
+    model_loader.stop()
+    if not reference_data_task.done():
+        reference_data_task.cancel()
+    if schema_watcher:
+        schema_watcher.cancel()
+    # Drain the pool before closing the stores its analyses write to
+    drained = await asyncio.to_thread(analysis_pool.shutdown, True, ANALYSIS_SHUTDOWN_TIMEOUT_SECONDS)
+    if not drained:
+        # Leave the stores open for the analyses still running; they are closed at exit
+        logger.error("Analyses still running after %.0fs; not closing the result stores.", ANALYSIS_SHUTDOWN_TIMEOUT_SECONDS)
+        return
+    recommendation_cache.close()
+    if finding_state:
+        finding_state.close()
+    if write_behind_queue:
+        write_behind_queue.stop()
 
 # --- FastAPI App Initialization ---
 app = FastAPI(lifespan=lifespan) # Use the lifespan manager
@@ -114,57 +386,193 @@ app.add_middleware(
 async def read_root():
     return {"message": "RAG Backend is running!"}
 
-# --- Modified Upload and Analyze Endpoint ---
-@app.post("/upload_csv/") # Renamed for clarity, or keep /upload_csv/ if preferred
-async def upload_csv(file: UploadFile = File(...), user_id: str = Form(...)):
-    # This endpoint now handles upload, analysis, and storing results to Supabase.
-    global cmmc_schema_df, users_df, rag_pipeline, supabase # Add supabase
-
-    # --- Initial Checks ---
-    if cmmc_schema_df is None:
-        raise HTTPException(status_code=503, detail="CMMC schema data not loaded on server.")
-    if rag_pipeline is None:
-         raise HTTPException(status_code=503, detail="LLM Pipeline not available on server.")
-    # --- Check if Supabase client is available ---
-    if supabase is None:
-         print("Warning: Supabase client not initialized. Results will not be stored.")
-         # Decide if you want to raise an error or just proceed without storing
-         # raise HTTPException(status_code=503, detail="Supabase connection not available.")
-
-    findings_df = None
+# Liveness: the process is up and serving requests
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: reference data and the model are loaded, so uploads can be analyzed
+@app.get("/readyz")
+async def readyz():
+    model_loader.start() # Starts a lazy load on the first probe
+    # In shared inference mode these ask the inference server, so keep them off the event loop
+    model_ready, model_status = await run_in_threadpool(lambda: (model_loader.ready, model_loader.status()))
+    checks = {
+        "cmmc_schema": cmmc_schema is not None,
+        "model": model_ready,
+        "analysis_pool": analysis_pool is not None,
+    }
+    body = {"ready": all(checks.values()), "checks": checks, "model": model_status}
+    return JSONResponse(status_code=200 if body["ready"] else 503, content=body)
+
+# --- Analysis Pipeline (runs on the worker pool, off the event loop) ---
+def ingest_findings(file_obj, filename, user_id, schema, timings=None, baseline=None, reuse_matches=False):
+    # Stream the uploaded findings (CSV, compressed CSV, Parquet or Arrow; see ingest.py) in chunks,
+    # keeping only the columns the analysis and persistence use.
+    # HIGH severity rows are matched to controls chunk by chunk, raising HTTPException(400) on bad input.
+    # Time spent parsing, filtering and matching is added to timings (stage -> seconds) if given.
+    # With a baseline (incremental analysis) every row is fingerprinted, and with reuse_matches HIGH rows
+    # already in the baseline keep the controls they matched then instead of being matched again.
+    timings = {} if timings is None else timings
     try:
-        # Read the uploaded file into a DataFrame
-        # Keep a copy of the original file bytes in case stream is consumed
-        file_content = await file.read()
-        await file.seek(0) # Reset stream position if needed by pd.read_csv
-
-        # Try reading with default comma delimiter
-        try:
-            findings_df = pd.read_csv(file.file)
-        except pd.errors.ParserError:
-            print("Failed reading CSV with comma delimiter, trying semicolon...")
-            await file.seek(0) # Reset stream again
-            try:
-                 findings_df = pd.read_csv(file.file, delimiter=';')
-            except Exception as e_delim:
-                 print(f"Failed reading CSV with semicolon delimiter as well: {e_delim}")
-                 raise HTTPException(status_code=400, detail="Failed to parse CSV file. Check delimiter (comma or semicolon) and format.")
-        except Exception as e_read:
-             print(f"Error reading CSV file: {e_read}")
-             raise HTTPException(status_code=400, detail=f"Failed to process CSV file: {e_read}")
-
-        print(f"Successfully read uploaded file: {file.filename} for user_id: {user_id}")
-        print(f"CSV Columns: {findings_df.columns.tolist()}") # Log columns for debugging
-
-    except HTTPException as http_exc:
-        raise http_exc # Re-raise specific HTTP exceptions
+        with timed(timings, "parse"):
+            upload = FindingsUpload(file_obj)
+            columns = upload.columns
+    except UnsupportedUploadFormat as e_format:
+        logger.warning("Unsupported upload format for %s: %s", filename, e_format)
+        raise HTTPException(status_code=415, detail=str(e_format))
+    except Exception as e_read:
+        logger.warning("Error reading uploaded file: %s", e_read)
+        raise HTTPException(status_code=400, detail=f"Failed to process uploaded file: {e_read}")
+    logger.info(
+        "Read uploaded file header: %s for user_id: %s (%s, delimiter %r)",
+        filename, user_id, upload.format_name, upload.delimiter,
+    )
+    logger.debug("Columns: %s", columns)
+
+    # Check for severity column existence (or an alternative common name)
+    severity_column = resolve_severity_column(columns)
+    if severity_column is None:
+        raise HTTPException(status_code=400, detail=f"Severity column ('{SEVERITY_COLUMN}' or similar) not found in uploaded findings. Found columns: {columns}")
+    if DESCRIPTION_COLUMN not in columns:
+         # Handle missing description column if necessary
+         logger.warning("Description column '%s' not found. Keyword matching might be affected.", DESCRIPTION_COLUMN)
+
+    usecols = select_columns(columns, severity_column)
+    # Each distinct normalized description is matched once, then expanded back to its rows
+    matcher = DeduplicatingMatcher(select_matcher(schema))
+    finding_chunks = []
+    high_severity_chunks = []
+    fingerprint_chunks = []
+    gap_to_findings_map = {}
+    try:
+        chunks = upload.iter_chunks(usecols, INGEST_CHUNK_ROWS)
+        while True:
+            with timed(timings, "parse"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            if baseline is not None:
+                with timed(timings, "incremental"):
+                    fingerprints = fingerprint_rows(chunk, usecols)
+                fingerprint_chunks.append(fingerprints)
+            with timed(timings, "severity_filter"):
+                # Ensure severity column is string type before comparison
+                chunk[severity_column] = chunk[severity_column].astype(str)
+                high_chunk = chunk[chunk[severity_column].str.upper() == 'HIGH']
+            # Match high severity findings, grouped by normalized description
+            if not high_chunk.empty and DESCRIPTION_COLUMN in high_chunk.columns:
+                with timed(timings, "control_matching"):
+                    unmatched_chunk = high_chunk
+                    if reuse_matches:
+                        # Rows seen in the previous analysis keep the controls they matched then
+                        high_fingerprints = fingerprints.loc[high_chunk.index].to_numpy()
+                        known = baseline.known(high_fingerprints)
+                        for index, fingerprint in zip(high_chunk.index[known], high_fingerprints[known].tolist()):
+                            for control_id in baseline.matches[fingerprint]:
+                                gap_to_findings_map.setdefault(control_id, []).append(index)
+                        unmatched_chunk = high_chunk[~known]
+                    finding_descs = normalize_descriptions(unmatched_chunk[DESCRIPTION_COLUMN])
+                    matcher.build_gap_map(zip(finding_descs.index, finding_descs), gap_to_findings_map)
+            finding_chunks.append(chunk)
+            high_severity_chunks.append(high_chunk)
+    except pd.errors.ParserError as e_parse:
+        logger.warning("Failed parsing %s with delimiter %r: %s", upload.format_name, upload.delimiter, e_parse)
+        raise HTTPException(status_code=400, detail="Failed to parse CSV file. Check delimiter (comma or semicolon) and format.")
+    except UnsupportedUploadFormat as e_format:
+        raise HTTPException(status_code=415, detail=str(e_format))
     except Exception as e:
-        print(f"Error processing uploaded file for user_id {user_id}: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=400, detail=f"Failed to process CSV file: {e}")
-    finally:
-        # Ensure the file stream is closed
-        await file.close()
+        logger.exception("Error processing uploaded file for user_id %s: %s", user_id, e)
+        raise HTTPException(status_code=400, detail=f"Failed to process {upload.format_name} file: {e}")
+
+    with timed(timings, "parse"):
+        if finding_chunks:
+            findings_df = pd.concat(finding_chunks)
+            high_severity_findings = pd.concat(high_severity_chunks)
+        else:
+            findings_df = pd.DataFrame(columns=usecols)
+            high_severity_findings = findings_df
+    fingerprints = None
+    if baseline is not None:
+        fingerprints = pd.concat(fingerprint_chunks) if fingerprint_chunks else pd.Series([], dtype="uint64")
+        if reuse_matches:
+            for finding_indices in gap_to_findings_map.values():
+                finding_indices.sort() # Reused and newly matched rows were added separately
+            gap_to_findings_map = order_like_single_pass(gap_to_findings_map, matcher, high_severity_findings)
+    logger.info(
+        "Matched %d high severity findings via %d unique descriptions",
+        len(high_severity_findings), matcher.unique_descriptions,
+    )
+    return findings_df, high_severity_findings, gap_to_findings_map, columns, matcher.unique_descriptions, fingerprints
+
+def order_like_single_pass(gap_to_findings_map, matcher, high_severity_findings):
+    # Reorder the controls of a map built partly from reused matches the way one matching pass over the rows
+    # adds them (the order the analysis output follows): by the first row that matched each control, then by
+    # the matcher's order for that row. Row indexes increase across chunks, so the first row is the smallest.
+    first_rows = {}
+    for control_id, finding_indices in gap_to_findings_map.items():
+        first_rows.setdefault(finding_indices[0], []).append(control_id)
+    ranks = {}
+    for finding_index, control_ids in first_rows.items():
+        if len(control_ids) > 1:
+            desc = normalize_descriptions(high_severity_findings.loc[[finding_index], DESCRIPTION_COLUMN]).iloc[0]
+            ranks.update((control_id, rank) for rank, control_id in enumerate(matcher.match(desc)))
+    ordered = sorted(gap_to_findings_map, key=lambda control_id: (gap_to_findings_map[control_id][0], ranks.get(control_id, 0)))
+    return {control_id: gap_to_findings_map[control_id] for control_id in ordered}
+
+def match_version_for(schema):
+    # Stored matches are reused by incremental analyses only while this is unchanged
+    return f"{MATCHING_MODE}:{RETRIEVAL_TOP_K}:{RETRIEVAL_THRESHOLD}:{schema.mtime}"
+
+def prompt_version_for(schema, match_version, control_id):
+    # A previous recommendation is reused only if its prompt would be built from the same inputs
+    requirement = schema.requirements.get(control_id, {}).get(REQUIREMENT_COLUMN, "")
+    return f"{match_version}:{RETRIEVAL_PROMPT_RELATED}\x00{requirement}"
+
+def analyze_and_store(file_obj, filename, user_id, schema, pipe, storage, on_event=None, timings=None, incremental=False):
+    # Match findings to CMMC controls, generate recommendations and store the results
+    # (queued on the write-behind journal, or directly in storage in sync mode).
+    # on_event(event, data), if given, is called with progress as soon as each part is ready.
+    # Per-stage seconds are reported to STAGE_SECONDS and also collected in timings if given.
+    # incremental compares the upload with the user's previous incremental analysis (see incremental.py);
+    # it is rejected with a 409 while another incremental analysis of the same user is in progress.
+    if not incremental:
+        return analyze_upload(file_obj, filename, user_id, schema, pipe, storage, on_event, timings)
+    if finding_state is None:
+        raise HTTPException(status_code=503, detail="Incremental analysis state not available on server.")
+    timings = {} if timings is None else timings
+    try:
+        with finding_state.user_lease(user_id) as lease_owner:
+            with timed(timings, "incremental"):
+                baseline = finding_state.load(user_id)
+            return analyze_upload(file_obj, filename, user_id, schema, pipe, storage, on_event, timings, baseline, lease_owner)
+    except UserBusy as e: # Only raised when taking the lease
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": str(ANALYSIS_RETRY_AFTER_SECONDS)})
+
+def analyze_upload(file_obj, filename, user_id, schema, pipe, storage, on_event=None, timings=None, baseline=None,
+                   lease_owner=None):
+    emit = on_event or (lambda event, data: None)
+    timings = {} if timings is None else timings
+    match_version = match_version_for(schema)
+    reuse_matches = baseline is not None and baseline.match_version == match_version
+    findings_df, high_severity_findings, gap_to_findings_map, columns, unique_descriptions, fingerprints = ingest_findings(
+        file_obj, filename, user_id, schema, timings, baseline=baseline, reuse_matches=reuse_matches,
+    )
+    ROWS_TOTAL.inc(len(findings_df))
+    HIGH_FINDINGS_TOTAL.inc(len(high_severity_findings))
+    delta = None
+    context_hashes = {}
+    if baseline is not None:
+        with timed(timings, "incremental"):
+            keys = row_keys(findings_df).to_numpy()
+            delta = FindingDelta(baseline, fingerprints.to_numpy(), keys)
+            context_hashes = {
+                control_id: context_hash(
+                    MODEL_NAME, control_id, fingerprints.loc[finding_indices].to_numpy(),
+                    prompt_version_for(schema, match_version, control_id),
+                )
+                for control_id, finding_indices in gap_to_findings_map.items()
+            }
 
     # --- Start Analysis Logic ---
     try:
@@ -175,87 +583,28 @@ async def upload_csv(file: UploadFile = File(...), user_id: str = Form(...)):
         }
 
         # Define expected columns (adjust based on your actual CSVs)
-        severity_column = 'finding.severity' # Adjust if your column name is different
-        category_column = 'finding.category' # Example
-        description_column = 'finding.description' # Example
-        resource_name_column = 'resource.display_name' # Example
-        resource_type_column = 'resource.type' # Example
-
-        # Check for severity column existence
-        if severity_column not in findings_df.columns:
-             # Try alternative common names if needed
-             alt_severity_column = 'Severity'
-             if alt_severity_column in findings_df.columns:
-                 severity_column = alt_severity_column
-             else:
-                 raise HTTPException(status_code=400, detail=f"Severity column ('{severity_column}' or similar) not found in uploaded findings. Found columns: {findings_df.columns.tolist()}")
-
-        # Ensure severity column is string type before comparison
-        findings_df[severity_column] = findings_df[severity_column].astype(str)
-        high_severity_findings = findings_df[findings_df[severity_column].str.upper() == 'HIGH']
-
-        identified_gaps_set = set()
-        gap_to_findings_map = {}
+        category_column = CATEGORY_COLUMN
+        description_column = DESCRIPTION_COLUMN
+        resource_name_column = RESOURCE_NAME_COLUMN
+        resource_type_column = RESOURCE_TYPE_COLUMN
+
+        emit("parse_summary", {
+            "filename": filename,
+            "rows": len(findings_df),
+            "columns": columns,
+            "high_severity_findings": len(high_severity_findings),
+            "unique_high_severity_descriptions": unique_descriptions,
+        })
+        if high_severity_findings.empty:
+            emit("non_compliant_controls", [])
+
+        identified_gaps_set = set(gap_to_findings_map.keys())
         results["recommendations"] = []
 
         if not high_severity_findings.empty:
-            control_id_column = 'Requirement ID'
-            requirement_column = 'Requirement Statement'
-            # Use the description_column defined earlier
-            if description_column not in findings_df.columns:
-                 # Handle missing description column if necessary
-                 print(f"Warning: Description column '{description_column}' not found. Keyword matching might be affected.")
-                 # Optionally, try an alternative or raise an error
-                 # raise HTTPException(status_code=400, detail=f"Description column '{description_column}' not found.")
-
-            stop_words = {
-                "a", "an", "and", "are", "as", "at", "be", "but", "by",
-                "for", "if", "in", "into", "is", "it", "no", "not", "of",
-                "on", "or", "such", "that", "the", "their", "then", "there",
-                "these", "they", "this", "to", "was", "will", "with", "you",
-                "your", "all", "any", "has", "have", "from", "out", "use",
-                "ensure", "implement", "provide", "define", "control", "system",
-                "information", "security", "access", "organizational", "organization"
-            }
-            control_keywords = {}
-            if cmmc_schema_df is not None and control_id_column in cmmc_schema_df.columns and requirement_column in cmmc_schema_df.columns:
-                for _, control in cmmc_schema_df.iterrows():
-                    control_id = control[control_id_column]
-                    req_statement = str(control[requirement_column]).lower()
-                    keywords = {
-                        word.strip('.,:;()[]{}')
-                        for word in req_statement.split()
-                        if len(word.strip('.,:;()[]{}')) > 4 and word.strip('.,:;()[]{}') not in stop_words
-                    }
-                    control_keywords[control_id] = keywords
-            else:
-                print("Warning: CMMC Schema DF or required columns not available for keyword generation.")
-
-
-            # Iterate through each high severity finding
-            for finding_index, finding in high_severity_findings.iterrows():
-                # Use .get() for safety in case description column is missing
-                finding_desc = str(finding.get(description_column, '')).lower()
-                if not finding_desc: continue
-
-                for control_id, keywords in control_keywords.items():
-                    matched_keyword = None
-                    for keyword in keywords:
-                         import re
-                         # Use word boundaries to match whole words
-                         if re.search(r'\b' + re.escape(keyword) + r'\b', finding_desc):
-                             matched_keyword = keyword
-                             break
-                    if matched_keyword:
-                        identified_gaps_set.add(control_id)
-                        if control_id not in gap_to_findings_map:
-                            gap_to_findings_map[control_id] = []
-                        # Store the original DataFrame index
-                        if finding_index not in gap_to_findings_map[control_id]:
-                            gap_to_findings_map[control_id].append(finding_index)
-            # --- End Keyword Matching ---
-
             results["non_compliant_controls"] = sorted(list(identified_gaps_set))
+            MATCHED_CONTROLS_TOTAL.inc(len(results["non_compliant_controls"]))
+            emit("non_compliant_controls", results["non_compliant_controls"])
 
             # --- Generate Recommendations ---
             relevant_finding_columns = [
@@ -264,212 +613,373 @@ async def upload_csv(file: UploadFile = File(...), user_id: str = Form(...)):
             ]
             # Filter relevant_finding_columns to only include those present in the DataFrame
             relevant_finding_columns = [col for col in relevant_finding_columns if col in high_severity_findings.columns]
-            print(f"--- Columns used for recommendation context: {relevant_finding_columns} ---") # Log relevant columns
-
-            for control_id in results["non_compliant_controls"]:
-                print(f"--- Generating recommendation for Control ID: {control_id} ---")
-                # Ensure cmmc_schema_df and control_id_column are checked for existence
-                if cmmc_schema_df is None or control_id_column not in cmmc_schema_df.columns:
-                    print(f"Skipping recommendation for {control_id} due to missing CMMC schema data.")
-                    results["recommendations"].append({"control_id": control_id, "recommendation": "Error: CMMC Schema data unavailable."})
-                    continue
-
-                control_info_rows = cmmc_schema_df[cmmc_schema_df[control_id_column] == control_id]
-                if control_info_rows.empty:
-                     print(f"Warning: Control ID {control_id} not found in CMMC Schema.")
-                     results["recommendations"].append({"control_id": control_id, "recommendation": "Error: Control ID not found in CMMC Schema."})
-                     continue
-                control_info = control_info_rows.iloc[0]
-
-                finding_context = "Multiple findings triggered this gap."
-                if control_id in gap_to_findings_map and gap_to_findings_map[control_id]:
-                    first_triggering_finding_index = gap_to_findings_map[control_id][0]
-                    # Check if the index exists in the high_severity_findings DataFrame
-                    if first_triggering_finding_index in high_severity_findings.index:
-                        triggering_finding = high_severity_findings.loc[first_triggering_finding_index]
-                        # Use .get() for safety when accessing finding columns
-                        context_parts = []
-                        for col in relevant_finding_columns:
-                             # Ensure column exists before trying to get value
-                             if col in triggering_finding.index:
-                                 context_parts.append(f"{col}: {triggering_finding.get(col, 'N/A')}")
-                             else:
-                                 context_parts.append(f"{col}: [Column Not Found in Finding]")
-                        finding_context = "\n".join(context_parts)
-
+            logger.debug("Columns used for recommendation context: %s", relevant_finding_columns)
+
+            # Build every prompt first, then generate recommendations in batches.
+            # Slots keep recommendations in the same order as non_compliant_controls.
+            recommendation_slots = []
+            pending_slots = []
+            pending_prompts = []
+            # Successful recommendations by control, kept as the baseline of incremental analyses
+            gap_recommendations = {}
+            with timed(timings, "prompt_build"):
+                for control_id in results["non_compliant_controls"]:
+                    # Ensure the schema has a control ID column to look controls up by
+                    if not schema.has_control_ids:
+                        logger.warning("Skipping recommendation for %s due to missing CMMC schema data.", control_id)
+                        recommendation_slots.append({"control_id": control_id, "recommendation": "Error: CMMC Schema data unavailable."})
+                        emit("recommendation", recommendation_slots[-1])
+                        continue
+
+                    control_info = schema.requirements.get(control_id)
+                    if control_info is None:
+                         logger.warning("Control ID %s not found in CMMC Schema.", control_id)
+                         recommendation_slots.append({"control_id": control_id, "recommendation": "Error: Control ID not found in CMMC Schema."})
+                         emit("recommendation", recommendation_slots[-1])
+                         continue
+
+                    if baseline is not None:
+                        # Same triggering findings as last time: reuse that recommendation without building a prompt
+                        previous_hash, previous_recommendation = baseline.gaps.get(control_id, (None, None))
+                        if previous_recommendation is not None and previous_hash == context_hashes.get(control_id):
+                            RECOMMENDATIONS_TOTAL.inc(source="previous")
+                            gap_recommendations[control_id] = previous_recommendation
+                            recommendation_slots.append({"control_id": control_id, "recommendation": previous_recommendation})
+                            emit("recommendation", recommendation_slots[-1])
+                            continue
+
+                    finding_context = "Multiple findings triggered this gap."
+                    related_requirements = []
+                    if control_id in gap_to_findings_map and gap_to_findings_map[control_id]:
+                        # Summarize every finding that triggered this gap, not just the first one
+                        triggering_findings = high_severity_findings.loc[gap_to_findings_map[control_id]]
+                        finding_context = summarize_findings(triggering_findings, relevant_finding_columns, description_column)
+                        if description_column in triggering_findings.columns:
+                            related_requirements = related_requirements_for(
+                                schema, control_id, str(triggering_findings[description_column].iloc[0])
+                            )
                     else:
-                        finding_context = f"Finding data (index {first_triggering_finding_index}) not found in high severity findings."
-                else:
-                     finding_context = "No specific finding details linked to this gap." # Handle case where map is empty
-
-                max_context_len = 1000 # Limit context length for the prompt
-                if len(finding_context) > max_context_len: finding_context = finding_context[:max_context_len] + "..."
-
-                # Ensure requirement_column exists before accessing
-                req_statement_for_prompt = control_info.get(requirement_column, 'N/A')
-                if req_statement_for_prompt == 'N/A':
-                    print(f"Warning: Requirement statement not found for Control ID {control_id}")
-
-                prompt = (
-                    f"Context:\nCMMC Control Requirement ({control_info.get(control_id_column, 'N/A')}): {req_statement_for_prompt}\n" # Use .get() for safety
-                    f"Related Finding Detail:\n{finding_context}\n\n"
-                    f"Question: Based on the finding detail, provide a brief, actionable recommendation to meet the CMMC control requirement.\n\nRecommendation:"
+                         finding_context = "No specific finding details linked to this gap." # Handle case where map is empty
+
+                    prompt = build_prompt(control_info, finding_context, related_requirements)
+                    key = cache_key(MODEL_NAME, control_id, prompt)
+                    cached_recommendation = recommendation_cache.get(key) if recommendation_cache else None
+                    if cached_recommendation is not None:
+                        RECOMMENDATIONS_TOTAL.inc(source="cache")
+                        gap_recommendations[control_id] = cached_recommendation
+                        recommendation_slots.append({"control_id": control_id, "recommendation": cached_recommendation})
+                        emit("recommendation", recommendation_slots[-1])
+                        continue
+
+                    recommendation_slots.append({"control_id": control_id, "recommendation": "Error: Recommendation generation failed."})
+                    pending_slots.append((len(recommendation_slots) - 1, key))
+                    pending_prompts.append(prompt)
+
+            if RECOMMENDATION_MAX_PER_UPLOAD and len(pending_prompts) > RECOMMENDATION_MAX_PER_UPLOAD:
+                # Generate for the controls triggered by the most HIGH findings; the rest get a placeholder
+                def triggering_count(position):
+                    return len(gap_to_findings_map.get(recommendation_slots[pending_slots[position][0]]["control_id"], ()))
+                ranked = sorted(range(len(pending_prompts)), key=lambda position: (-triggering_count(position), position))
+                for position in ranked[RECOMMENDATION_MAX_PER_UPLOAD:]:
+                    slot = recommendation_slots[pending_slots[position][0]]
+                    slot["recommendation"] = (
+                        f"Skipped: limit of {RECOMMENDATION_MAX_PER_UPLOAD} generated recommendations per upload reached "
+                        f"({triggering_count(position)} HIGH findings triggered this control)."
+                    )
+                    RECOMMENDATIONS_TOTAL.inc(source="skipped")
+                    emit("recommendation", slot)
+                kept = sorted(ranked[:RECOMMENDATION_MAX_PER_UPLOAD])
+                logger.info("Skipping %d recommendations over the per-upload limit of %d.", len(ranked) - len(kept), RECOMMENDATION_MAX_PER_UPLOAD)
+                pending_slots = [pending_slots[position] for position in kept]
+                pending_prompts = [pending_prompts[position] for position in kept]
+
+            if pending_prompts:
+                logger.info(
+                    "Generating %d recommendations in batches of %d (%d from cache or skipped)",
+                    len(pending_prompts), RAG_BATCH_SIZE, len(recommendation_slots) - len(pending_prompts),
                 )
-                recommendation_text = "Error: Recommendation generation failed." # Default error message
-                try:
-                    if rag_pipeline:
-                         print(f"--- Calling RAG pipeline for {control_id} ---")
-                         # Add truncation=True to prevent overly long inputs potentially causing issues
-                         output = rag_pipeline(prompt, max_new_tokens=100, num_return_sequences=1, truncation=True)
-                         print(f"--- RAG pipeline output for {control_id}: {output} ---") # Log raw output
-                         if output and isinstance(output, list) and output[0] and 'generated_text' in output[0]:
-                             # Attempt to isolate the recommendation text more robustly
-                             full_text = output[0]['generated_text']
-                             rec_marker = "Recommendation:"
-                             rec_start_index = full_text.rfind(rec_marker) # Find the last occurrence
-                             if rec_start_index != -1:
-                                 recommendation_text = full_text[rec_start_index + len(rec_marker):].strip()
-                                 if not recommendation_text: # Handle case where marker is present but text is empty
-                                     recommendation_text = "Generated recommendation was empty."
-                             else:
-                                 # Fallback if marker not found - maybe model didn't follow format
-                                 # Try to remove the prompt part if possible
-                                 prompt_end_marker = "Recommendation:" # The end of the prompt itself
-                                 prompt_end_index = prompt.rfind(prompt_end_marker)
-                                 if prompt_end_index != -1:
-                                      potential_answer = full_text[prompt_end_index + len(prompt_end_marker):].strip()
-                                      if potential_answer:
-                                          recommendation_text = potential_answer
-                                      else:
-                                          recommendation_text = "Failed to isolate recommendation from model output."
-                                 else:
-                                      recommendation_text = "Failed to isolate recommendation (marker not found)."
-
-                         else:
-                             recommendation_text = "Failed to generate recommendation (invalid output format)."
-                             print(f"!!! Invalid RAG output format for {control_id}")
-                    else:
-                         recommendation_text = "Recommendation generation skipped: Pipeline not loaded."
-                         print(f"!!! RAG pipeline not loaded, skipping recommendation for {control_id}")
-
-                    results["recommendations"].append({"control_id": control_id, "recommendation": recommendation_text})
-                    print(f"--- Generated recommendation for {control_id}: {recommendation_text[:100]}... ---")
-
-                except Exception as e_inner:
-                     print(f"!!! Error during RAG pipeline call or processing for {control_id}: {e_inner}")
-                     traceback.print_exc() # Print traceback for detailed debugging
-                     results["recommendations"].append({"control_id": control_id, "recommendation": f"Error generating recommendation: {e_inner}"})
+                with timed(timings, "generation"):
+                    for position, recommendation_text, ok in inference_scheduler.generate(user_id, pipe, pending_prompts, RAG_BATCH_SIZE):
+                        slot_index, key = pending_slots[position]
+                        slot = recommendation_slots[slot_index]
+                        slot["recommendation"] = recommendation_text
+                        RECOMMENDATIONS_TOTAL.inc(source="generated" if ok else "error")
+                        if ok:
+                            gap_recommendations[slot["control_id"]] = recommendation_text
+                        if ok and recommendation_cache:
+                            recommendation_cache.put(key, recommendation_text)
+                        logger.debug("Generated recommendation for %s: %.100s", slot['control_id'], recommendation_text)
+                        emit("recommendation", slot)
+
+            results["recommendations"] = recommendation_slots
             # --- End Recommendation Generation ---
+        else:
+            gap_recommendations = {}
 
 
         # Update summary message
-        results["summary"] = f"Analyzed '{file.filename}'. Found {len(high_severity_findings)} high severity findings. Identified {len(results['non_compliant_controls'])} potential control gaps."
-        print(f"--- Analysis Summary: {results['summary']} ---")
+        results["summary"] = f"Analyzed '{filename}'. Found {len(high_severity_findings)} high severity findings. Identified {len(results['non_compliant_controls'])} potential control gaps."
+        logger.info("Analysis summary: %s", results["summary"])
 
-        # --- Store results in Supabase ---
-        supabase_record_id = None
-        if supabase: # Only proceed if Supabase client is initialized
-            # 1. Insert the summary analysis record
+        # --- Store results ---
+        persisted = False
+        if storage: # Only proceed if a storage backend is configured
             try:
-                data_to_insert = {
-                    "uploaded_filename": file.filename,
-                    "user_id": user_id,
-                    "analysis_summary": results["summary"],
-                    "non_compliant_controls": results["non_compliant_controls"],
-                    "recommendations": results["recommendations"]
-                }
-                print(f"Attempting to insert summary into Supabase table 'rag_analysis_results': {data_to_insert}")
-                response = supabase.table("rag_analysis_results").insert(data_to_insert).execute()
-                print(f"Supabase summary insert response: {response}")
-
-                if response.data and len(response.data) > 0:
-                    supabase_record_id = response.data[0].get('id')
-                    print(f"Successfully stored analysis summary. Record ID: {supabase_record_id}")
-
-                    # 2. Prepare and insert individual findings (if summary insert was successful)
-                    if supabase_record_id:
-                        individual_findings_data = []
-                        # Define mapping from DataFrame columns (keys) to DB columns (values)
-                        # Ensure these CSV column names EXACTLY match your input CSV
-                        # Ensure these DB column names EXACTLY match your Supabase table 'individual_findings'
-                        column_mapping = {
-                            'finding.category': 'finding_category',
-                            'finding.severity': 'finding_severity',
-                            'finding.description': 'finding_description',
-                            'resource.display_name': 'resource_display_name',
-                            'resource.type': 'resource_type',
-                            # Add other columns from your CSV that you want to store
-                            # Example: 'vulnerability.cve.id': 'cve_id', # If these columns exist in CSV and DB
-                        }
-                        print(f"--- Preparing individual findings using mapping: {column_mapping} ---")
-                        print(f"--- Available columns in uploaded CSV: {findings_df.columns.tolist()} ---")
-
-                        # Iterate through the original findings DataFrame (all rows)
-                        for index, row in findings_df.iterrows():
-                            finding_record = {
-                                "analysis_id": supabase_record_id, # Link to the summary record
-                                "uploaded_filename": file.filename,
-                                "user_id": user_id
-                                # Add finding_id if you have a unique ID per finding in the CSV
-                                # 'finding_id_from_csv': row.get('finding.id', None) # Example
-                            }
-                            # Map columns safely using .get() on the row Series
-                            for csv_col, db_col in column_mapping.items():
-                                # *** Check if the column exists in the DataFrame ***
-                                if csv_col in findings_df.columns:
-                                     value = row.get(csv_col)
-                                     # Handle potential NaN values, convert to None (null in DB)
-                                     if pd.isna(value):
-                                         finding_record[db_col] = None
-                                     else:
-                                         # Ensure value is a basic type (str, int, float, bool)
-                                         # This handles numpy types that Supabase might reject
-                                         if hasattr(value, 'item'):
-                                             finding_record[db_col] = value.item()
-                                         elif isinstance(value, (str, int, float, bool)):
-                                             finding_record[db_col] = value
-                                         else:
-                                             # Fallback: convert other types to string
-                                             finding_record[db_col] = str(value)
-                                else:
-                                     # Log if a mapped column is missing in the CSV
-                                     # print(f"--- Warning: Column '{csv_col}' not found in CSV for row {index}, skipping mapping to '{db_col}'. ---")
-                                     # Optionally set the DB column to None or a placeholder if the column is mandatory in DB
-                                     finding_record[db_col] = None # Set to NULL if missing
-
-                            individual_findings_data.append(finding_record)
-
-                        # Batch insert individual findings
-                        if individual_findings_data:
-                            print(f"--- Attempting to batch insert {len(individual_findings_data)} individual findings into Supabase table 'individual_findings' ---")
-                            # print(f"--- Sample individual finding data: {individual_findings_data[0]} ---") # Log first record for debugging
-                            response_individual = supabase.table("individual_findings").insert(individual_findings_data).execute()
-                            print(f"Supabase individual findings insert response: {response_individual}")
-                            if response_individual.data:
-                                print(f"Successfully stored {len(response_individual.data)} individual findings.")
-                            else:
-                                print(f"!!! Failed to store individual findings. Response: {response_individual.error or 'No data returned'}")
+                with timed(timings, "persistence"):
+                    data_to_insert = {
+                        "uploaded_filename": filename,
+                        "user_id": user_id,
+                        "analysis_summary": results["summary"],
+                        "non_compliant_controls": results["non_compliant_controls"],
+                        "recommendations": results["recommendations"]
+                    }
+                    column_mapping = INDIVIDUAL_FINDINGS_COLUMN_MAPPING
+                    findings_to_store = findings_df
+                    resolved_fingerprints = []
+                    if delta is not None:
+                        # Unchanged rows are already stored; store added and changed rows with their fingerprint
+                        column_mapping = dict(column_mapping, finding_fingerprint="finding_fingerprint")
+                        findings_to_store = findings_df[delta.new_mask].assign(
+                            finding_fingerprint=fingerprint_hex(fingerprints[delta.new_mask])
+                        )
+                        resolved_fingerprints = fingerprint_hex(delta.removed_fingerprints)
+                    logger.debug("Preparing individual findings from columns %s", findings_to_store.columns.tolist())
+                    # Records are built one insert batch at a time, never for the whole upload at once;
+                    # analysis_id is added to each row once the summary record has been stored
+                    finding_batches = iter_finding_records(
+                        findings_to_store, column_mapping, FINDINGS_INSERT_BATCH_SIZE,
+                        uploaded_filename=filename, user_id=user_id,
+                    )
+
+                    if write_behind_queue is not None:
+                        entry_id = write_behind_queue.enqueue(data_to_insert, finding_batches, resolved_fingerprints)
+                        results["individual_findings"] = {"total_rows": len(findings_to_store), "status": "queued"}
+                        persisted = True
+                        logger.info("Queued analysis summary and %d individual findings as write-behind entry %s.", len(findings_to_store), entry_id)
+                    else:
+                        analysis_id, write_result = store_analysis(
+                            storage, data_to_insert, finding_batches,
+                            max_concurrency=FINDINGS_INSERT_CONCURRENCY,
+                            max_retries=FINDINGS_INSERT_RETRIES,
+                            resolved_fingerprints=resolved_fingerprints,
+                        )
+                        logger.info("Stored analysis summary in '%s' storage. Record ID: %s", storage.name, analysis_id)
+                        results["individual_findings"] = dict(write_result.as_dict(), status="stored" if write_result.complete else "partial")
+                        persisted = write_result.complete
+                        if write_result.complete:
+                            logger.info("Stored %d individual findings.", write_result.stored_rows)
                         else:
-                            print("--- No individual findings data prepared for insertion. ---")
+                            logger.error(
+                                "Stored %d of %d individual findings; %d batches failed.",
+                                write_result.stored_rows, write_result.total_rows, len(write_result.failed_batches),
+                            )
 
-            except Exception as e_supabase:
-                print(f"!!! Error during Supabase operation: {e_supabase}")
-                traceback.print_exc()
+            except Exception as e_storage:
+                logger.exception("Error during storage operation: %s", e_storage)
                 # Don't raise HTTPException here, just log the error and return the summary if possible
         else:
-            print("--- Supabase client not available, skipping database storage. ---")
+            logger.warning("Storage backend not available, skipping database storage.")
+
+        if baseline is not None:
+            results["delta"] = {"findings": delta.counts, "gaps": gap_delta(baseline, context_hashes)}
+            # A failed store keeps the old baseline, so the next upload stores these rows again
+            if storage is None or persisted:
+                with timed(timings, "incremental"):
+                    stored_mask = delta.new_mask if reuse_matches else np.ones(len(findings_df), dtype=bool)
+                    committed = finding_state.commit(
+                        user_id,
+                        fingerprints.to_numpy()[stored_mask],
+                        keys[stored_mask],
+                        row_controls(gap_to_findings_map, findings_df.index[stored_mask]),
+                        delta.removed_fingerprints,
+                        {
+                            control_id: (digest, gap_recommendations.get(control_id))
+                            for control_id, digest in context_hashes.items()
+                        },
+                        match_version,
+                        owner=lease_owner,
+                    )
+                if not committed:
+                    logger.warning("Lost the incremental analysis lease for user %s; not updating its state.", user_id)
+            else:
+                logger.warning("Storing the analysis for user %s failed; keeping the previous incremental state.", user_id)
+
 
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        logger.info(
+            "Analysis of '%s' complete", filename,
+            extra={
+                "user_id": user_id, "rows": len(findings_df), "high_findings": len(high_severity_findings),
+                "matched_controls": len(results["non_compliant_controls"]),
+                "stage_seconds": {stage: round(seconds, 4) for stage, seconds in timings.items()},
+            },
+        )
 
         # Return the analysis results (even if Supabase failed)
         return results
 
     except HTTPException as http_exc:
-         print(f"!!! Caught HTTPException: {http_exc.status_code} - {http_exc.detail}")
+         logger.warning("Caught HTTPException: %s - %s", http_exc.status_code, http_exc.detail)
          raise http_exc # Re-raise HTTP exceptions
     except Exception as e_outer:
-        print(f"!!! Unhandled error during analysis for user {user_id}: {e_outer}")
-        traceback.print_exc()
+        logger.exception("Unhandled error during analysis for user %s: %s", user_id, e_outer)
         raise HTTPException(status_code=500, detail=f"An internal error occurred during analysis: {str(e_outer)}")
 
+def run_analysis(file_obj, filename, user_id, schema, pipe, storage, on_event=None, incremental=False):
+    try:
+        results = analyze_and_store(file_obj, filename, user_id, schema, pipe, storage, on_event=on_event, incremental=incremental)
+    except HTTPException as http_exc:
+        ANALYSES_TOTAL.inc(outcome="rejected" if http_exc.status_code < 500 else "error")
+        raise
+    except Exception:
+        ANALYSES_TOTAL.inc(outcome="error")
+        raise
+    ANALYSES_TOTAL.inc(outcome="success")
+    return results
+
+def run_analysis_job(job, file_obj, schema, pipe, storage, incremental=False):
+    # Worker-side body of an analysis job: progress and the final results go to the job's event log.
+    job.mark_running()
+    try:
+        results = run_analysis(
+            file_obj, job.filename, job.user_id, schema, pipe, storage, on_event=job.publish, incremental=incremental,
+        )
+        job.publish("result", results)
+    except HTTPException as http_exc:
+        job.publish("error", {"status_code": http_exc.status_code, "detail": http_exc.detail})
+    except Exception as e:
+        logger.exception("Unhandled error in analysis job %s: %s", job.id, e)
+        job.publish("error", {"status_code": 500, "detail": f"An internal error occurred during analysis: {e}"})
+    finally:
+        file_obj.close()
+
+def check_analysis_ready():
+    # Return the current schema snapshot and pipeline, or raise 503 if the server can't analyze uploads yet.
+    schema = cmmc_schema # Use one schema snapshot for the whole request
+    if schema is None:
+        raise HTTPException(status_code=503, detail="CMMC schema data not loaded on server.")
+    model_loader.start() # Starts a lazy load on first use
+    if not model_loader.ready:
+         raise HTTPException(
+             status_code=503,
+             detail=f"LLM Pipeline not available on server (model {model_loader.state}).",
+             headers={"Retry-After": str(ANALYSIS_RETRY_AFTER_SECONDS)},
+         )
+    # --- Check if a storage backend is available ---
+    if storage_backend is None:
+         logger.warning("Storage backend not initialized. Results will not be stored.")
+         # Decide if you want to raise an error or just proceed without storing
+         # raise HTTPException(status_code=503, detail="Supabase connection not available.")
+    return schema, model_loader.pipeline
+
+def pool_saturated_error(user_id, e):
+    logger.warning("Rejecting upload from user %s: %s", user_id, e)
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy analyzing other uploads. Please retry shortly.",
+        headers={"Retry-After": str(ANALYSIS_RETRY_AFTER_SECONDS)},
+    )
+
+# --- Modified Upload and Analyze Endpoint ---
+@app.post("/upload_csv/") # Renamed for clarity, or keep /upload_csv/ if preferred
+async def upload_csv(file: UploadFile = File(...), user_id: str = Form(...), incremental: bool = Form(False)):
+    # This endpoint now handles upload, analysis, and storing results to Supabase.
+    # The CPU-bound work runs on the analysis worker pool so the event loop stays responsive.
+    try:
+        # In shared mode the readiness check asks the inference server, so keep it off the event loop
+        schema, pipe = await run_in_threadpool(check_analysis_ready)
+        try:
+            return await analysis_pool.run(
+                run_analysis, file.file, file.filename, user_id, schema, pipe, storage_backend, incremental=incremental
+            )
+        except PoolSaturated as e:
+            raise pool_saturated_error(user_id, e)
+    finally:
+        # Ensure the file stream is closed
+        await file.close()
+
+@app.get("/storage/stats")
+async def storage_stats():
+    if write_behind_queue is None:
+        return {"backend": storage_backend.name if storage_backend else None, "mode": "sync"}
+    return dict(await run_in_threadpool(write_behind_queue.stats), mode="write_behind")
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format
+    if analysis_pool is not None:
+        ANALYSES_IN_FLIGHT.set(analysis_pool.stats()["in_flight"])
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/inference_scheduler/stats")
+async def inference_scheduler_stats():
+    # Queue depth and wait times per tenant group (weighted tenants, then "other"), for tuning the scheduling limits
+    return inference_scheduler.stats()
+
+@app.get("/recommendation_cache/stats")
+async def recommendation_cache_stats():
+    if recommendation_cache is None:
+        raise HTTPException(status_code=503, detail="Recommendation cache not initialized.")
+    return await run_in_threadpool(recommendation_cache.stats)
+
+# --- Asynchronous Analysis Job Endpoints ---
+@app.post("/analysis_jobs/", status_code=202)
+async def submit_analysis_job(file: UploadFile = File(...), user_id: str = Form(...), incremental: bool = Form(False)):
+    # Queue an analysis and return its job ID immediately; follow it via the status or events endpoint.
+    try:
+        # In shared mode the readiness check asks the inference server, so keep it off the event loop
+        schema, pipe = await run_in_threadpool(check_analysis_ready)
+        # The upload is closed when this request ends, so the job gets its own copy
+        job_file = tempfile.TemporaryFile()
+        await run_in_threadpool(shutil.copyfileobj, file.file, job_file)
+    finally:
+        await file.close()
+
+    job = job_store.create(user_id, file.filename)
+    try:
+        analysis_pool.submit(run_analysis_job, job, job_file, schema, pipe, storage_backend, incremental=incremental)
+    except PoolSaturated as e:
+        job_store.discard(job.id)
+        job_file.close()
+        raise pool_saturated_error(user_id, e)
+
+    logger.info("Queued analysis job %s for '%s' (user_id: %s)", job.id, file.filename, user_id)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/analysis_jobs/{job.id}",
+        "events_url": f"/analysis_jobs/{job.id}/events",
+    }
+
+@app.get("/analysis_jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Analysis job not found.")
+    return job.describe()
+
+@app.get("/analysis_jobs/{job_id}/events")
+async def stream_analysis_job(job_id: str, last_event_id: int = Header(0)):
+    # Server-Sent Events: parse_summary, non_compliant_controls, one recommendation per control,
+    # then either result (the same payload /upload_csv/ returns) or error.
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Analysis job not found.")
+
+    async def event_source():
+        async for entry in job.stream(after=last_event_id, keepalive_seconds=ANALYSIS_JOB_KEEPALIVE_SECONDS):
+            if entry is None:
+                yield ": keep-alive\n\n"
+                continue
+            sequence, event, data = entry
+            yield f"id: {sequence}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- Add uvicorn runner if needed ---
 # ... (uvicorn runner remains the same) ...
\ No newline at end of file
@@ -0,0 +1,189 @@
+# --- Pipeline Metrics ---
+# Minimal Prometheus-style counters, gauges and histograms for the analysis
+# pipeline, rendered in the text exposition format by the /metrics endpoint.
+# Kept dependency-free; every metric is safe to update from worker threads.
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][position] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_sample(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def timed(timings, stage):
+    """Add the wall time of the block to timings[stage]; used to total a stage across upload chunks."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+# --- Analysis pipeline metrics ---
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds",
+    "Time spent per upload in each analysis stage (parse, incremental, severity_filter, control_matching, prompt_build, generation, persistence).",
+    labelnames=("stage",),
+)
+GENERATION_SECONDS = REGISTRY.histogram(
+    "rag_generation_call_duration_seconds", "Duration of each rag_pipeline call (one padded batch).",
+)
+GENERATED_TOKENS = REGISTRY.histogram(
+    "rag_generation_tokens", "Tokens generated per rag_pipeline call.",
+    buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+STORAGE_INSERT_SECONDS = REGISTRY.histogram(
+    "rag_storage_insert_duration_seconds", "Duration of each storage insert call.", labelnames=("backend", "table"),
+)
+ROWS_TOTAL = REGISTRY.counter("rag_rows_total", "Finding rows read from uploads.")
+HIGH_FINDINGS_TOTAL = REGISTRY.counter("rag_high_findings_total", "HIGH severity findings read from uploads.")
+MATCHED_CONTROLS_TOTAL = REGISTRY.counter("rag_matched_controls_total", "Non-compliant controls identified across uploads.")
+RECOMMENDATIONS_TOTAL = REGISTRY.counter(
+    "rag_recommendations_total", "Recommendations produced, by source (generated, cache, previous, skipped, error).", labelnames=("source",),
+)
+ANALYSES_TOTAL = REGISTRY.counter("rag_analyses_total", "Completed analyses by outcome.", labelnames=("outcome",))
+ANALYSES_IN_FLIGHT = REGISTRY.gauge("rag_analyses_in_flight", "Analyses currently running or queued on the worker pool.")
+SCHEDULER_QUEUE_DEPTH = REGISTRY.gauge(
+    "rag_scheduler_queue_depth", "Generation batches waiting for a turn in the inference scheduler, per weighted tenant or 'other'.", labelnames=("tenant",),
+)
+SCHEDULER_WAIT_SECONDS = REGISTRY.histogram(
+    "rag_scheduler_wait_seconds", "Time each generation batch waited for its turn, per weighted tenant or 'other'.", labelnames=("tenant",),
+)
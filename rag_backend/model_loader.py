@@ -0,0 +1,212 @@
+# --- Model Loading ---
+# Loads the text-generation pipeline on a background thread so the server starts
+# (and answers /healthz) immediately. Failed loads are retried with capped
+# exponential backoff, and a short warmup generation runs before the model is
+# reported ready, so the first real request doesn't pay first-call overhead.
+#
+# Sources, tried in order:
+#   1. snapshot_path: a torch.save() snapshot of the loaded model and tokenizer,
+#      the fastest way to start. Written after the first successful load from 2/3.
+#      Snapshots are pickles: only point this at files this service wrote.
+#   2. model_dir: a save_pretrained() directory, loaded without network access.
+#      If it doesn't exist yet, the model is downloaded once and saved there.
+#   3. model_name from the Hugging Face Hub (or its local cache).
+# transformers (and torch) are imported only when a load starts.
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from generation import prepare_for_batching
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PROMPT = "Context:\nCMMC Control Requirement: Limit system access to authorized users.\n\nRecommendation:"
+
+
+class ModelLoader:
+    def __init__(self, model_name, token=None, model_dir=None, snapshot_path=None,
+                 retry_seconds=10.0, max_retry_seconds=300.0, max_attempts=0, warmup=True):
+        self.model_name = model_name
+        self.token = token or None
+        self.model_dir = model_dir
+        self.snapshot_path = snapshot_path
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.max_attempts = max_attempts # 0 retries forever
+        self.warmup = warmup
+        self.state = "idle" # idle -> loading -> ready, or failed (retrying unless attempts ran out)
+        self.pipeline = None
+        self.source = None
+        self.attempts = 0
+        self.last_error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._ready = threading.Event()
+        self._finished = threading.Event() # Set once loading succeeded, gave up or was stopped
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        """Start loading in the background; calling it again while loading or loaded does nothing."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.state = "loading"
+            self._thread = threading.Thread(target=self._run, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def wait_ready(self, timeout=None):
+        """Wait until the model is ready or loading has stopped; returns whether it is ready."""
+        self._finished.wait(timeout)
+        return self.ready
+
+    def status(self):
+        return {
+            "model_name": self.model_name,
+            "state": self.state,
+            "source": self.source,
+            "attempts": self.attempts,
+            "load_seconds": self.load_seconds,
+            "last_error": self.last_error,
+        }
+
+    def _run(self):
+        try:
+            self._load_with_retries()
+        finally:
+            self._finished.set()
+
+    def _load_with_retries(self):
+        while not self._stopping.is_set():
+            self.attempts += 1
+            self.state = "loading"
+            started = time.perf_counter()
+            try:
+                pipe, source = self._load()
+                if self.warmup:
+                    self._warmup(pipe)
+            except Exception as e:
+                self.last_error = str(e)
+                self.state = "failed"
+                if self.max_attempts and self.attempts >= self.max_attempts:
+                    logger.error("Error loading model %s (attempt %d), giving up: %s", self.model_name, self.attempts, e)
+                    return
+                delay = min(self.retry_seconds * (2 ** (self.attempts - 1)), self.max_retry_seconds)
+                logger.error("Error loading model %s (attempt %d), retrying in %.1fs: %s", self.model_name, self.attempts, delay, e)
+                self._stopping.wait(delay)
+                continue
+
+            self.pipeline = pipe
+            self.source = source
+            self.load_seconds = round(time.perf_counter() - started, 3)
+            self.last_error = None
+            self.state = "ready"
+            self._ready.set()
+            logger.info("Model %s ready from %s in %.1fs.", self.model_name, source, self.load_seconds)
+            return
+
+    # --- Loading ---
+    def _load(self):
+        from transformers import pipeline
+
+        model, tokenizer, source = self._load_from_snapshot()
+        if model is None:
+            model, tokenizer, source = self._load_pretrained()
+        prepare_for_batching(tokenizer, model)
+        return pipeline("text-generation", model=model, tokenizer=tokenizer), source
+
+    def _load_from_snapshot(self):
+        if not (self.snapshot_path and os.path.exists(self.snapshot_path)):
+            return None, None, None
+        import torch
+        import transformers
+
+        try:
+            snapshot = torch.load(self.snapshot_path, weights_only=False)
+        except Exception as e:
+            logger.warning("Error reading model snapshot %s, loading from source instead: %s", self.snapshot_path, e)
+            return None, None, None
+        if (snapshot.get("model_name"), snapshot.get("transformers_version")) != (self.model_name, transformers.__version__):
+            logger.warning(
+                "Model snapshot %s was written for %s with transformers %s; loading from source instead.",
+                self.snapshot_path, snapshot.get("model_name"), snapshot.get("transformers_version"),
+            )
+            return None, None, None
+        return snapshot["model"], snapshot["tokenizer"], "snapshot"
+
+    def _load_pretrained(self):
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
+        if self.model_dir and os.path.isdir(self.model_dir):
+            logger.info("Loading model from local directory %s...", self.model_dir)
+            tokenizer = AutoTokenizer.from_pretrained(self.model_dir, local_files_only=True)
+            model = AutoModelForCausalLM.from_pretrained(self.model_dir, local_files_only=True)
+            source = "directory"
+        else:
+            logger.info("Loading model %s...", self.model_name)
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name, token=self.token)
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, token=self.token)
+            source = "hub"
+            if self.model_dir:
+                self._save_directory(model, tokenizer)
+        if self.snapshot_path:
+            self._save_snapshot(model, tokenizer)
+        return model, tokenizer, source
+
+    def _save_directory(self, model, tokenizer):
+        # Save next to model_dir and rename, so a failed save never leaves a partial directory behind.
+        # The temporary directory is unique, so workers loading at the same time don't write into each other's.
+        model_dir = self.model_dir.rstrip("/\\")
+        tmp_dir = None
+        try:
+            parent = os.path.dirname(os.path.abspath(model_dir))
+            os.makedirs(parent, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=parent, prefix=f".{os.path.basename(model_dir)}-", suffix=".tmp")
+            tokenizer.save_pretrained(tmp_dir)
+            model.save_pretrained(tmp_dir)
+            os.replace(tmp_dir, self.model_dir)
+            logger.info("Saved model %s to %s for faster startup.", self.model_name, self.model_dir)
+        except Exception as e:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            if os.path.isdir(self.model_dir):
+                logger.info("Model directory %s was saved by another process.", self.model_dir)
+            else:
+                logger.warning("Error saving model to %s: %s", self.model_dir, e)
+
+    def _save_snapshot(self, model, tokenizer):
+        import torch
+        import transformers
+
+        tmp_path = None
+        try:
+            directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(self.snapshot_path)}-", suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmp_file:
+                torch.save({
+                    "model_name": self.model_name,
+                    "transformers_version": transformers.__version__,
+                    "model": model,
+                    "tokenizer": tokenizer,
+                }, tmp_file)
+            os.replace(tmp_path, self.snapshot_path)
+            logger.info("Wrote model snapshot %s.", self.snapshot_path)
+        except Exception as e:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            logger.warning("Error writing model snapshot %s: %s", self.snapshot_path, e)
+
+    def _warmup(self, pipe):
+        started = time.perf_counter()
+        pipe([WARMUP_PROMPT], batch_size=1, max_new_tokens=4, num_return_sequences=1, truncation=True)
+        logger.info("Model warmup generation took %.2fs.", time.perf_counter() - started)
@@ -0,0 +1,328 @@
+# --- Findings Persistence ---
+# Vectorized conversion of the findings DataFrame into 'individual_findings' rows,
+# a bulk writer that inserts them in batches with bounded concurrency and retries,
+# and the pluggable storage backends those rows are written to.
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from metrics import STORAGE_INSERT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Define mapping from DataFrame columns (keys) to DB columns (values)
+# Ensure these CSV column names EXACTLY match your input CSV
+# Ensure these DB column names EXACTLY match your Supabase table 'individual_findings'
+INDIVIDUAL_FINDINGS_COLUMN_MAPPING = {
+    'finding.category': 'finding_category',
+    'finding.severity': 'finding_severity',
+    'finding.description': 'finding_description',
+    'resource.display_name': 'resource_display_name',
+    'resource.type': 'resource_type',
+    # Add other columns from your CSV that you want to store
+    # Example: 'vulnerability.cve.id': 'cve_id', # If these columns exist in CSV and DB
+}
+# Rows converted to records at a time when streaming them to storage
+RECORD_SLICE_ROWS = 50_000
+# Fingerprints per update request when marking findings resolved (they go in the request URL)
+RESOLVE_BATCH_SIZE = 200
+
+
+def build_finding_records(findings_df, column_mapping, **constant_fields):
+    """
+    Convert every row of findings_df into a DB record in one vectorized pass.
+    Mapped columns missing from the CSV become None, NaN becomes None, and numpy
+    scalars become plain Python values. constant_fields (e.g. analysis_id) are added to every record.
+    """
+    frame = findings_df.reindex(columns=list(column_mapping)).rename(columns=column_mapping)
+    frame = frame.astype(object).where(frame.notna(), None)
+    for position, (field, value) in enumerate(constant_fields.items()):
+        frame.insert(position, field, value)
+    return frame.to_dict('records')
+
+
+def iter_finding_records(findings_df, column_mapping, batch_size=1000, **constant_fields):
+    """
+    Yield the records of findings_df in lists of batch_size. Records are built a slice of
+    RECORD_SLICE_ROWS rows at a time (large enough to keep the vectorized conversion fast), so
+    memory stays bounded however large the upload is.
+    """
+    batch_size = max(1, batch_size)
+    slice_rows = max(batch_size, RECORD_SLICE_ROWS // batch_size * batch_size)
+    for slice_start in range(0, len(findings_df), slice_rows):
+        records = build_finding_records(findings_df.iloc[slice_start:slice_start + slice_rows], column_mapping, **constant_fields)
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+
+
+class BulkWriteResult:
+    def __init__(self, total_rows):
+        self.total_rows = total_rows
+        self.stored_rows = 0
+        self.failed_batches = [] # (first_row, row_count, error)
+
+    @property
+    def failed_rows(self):
+        return sum(row_count for _, row_count, _ in self.failed_batches)
+
+    @property
+    def complete(self):
+        return not self.failed_batches
+
+    def as_dict(self):
+        return {
+            "total_rows": self.total_rows,
+            "stored_rows": self.stored_rows,
+            "failed_rows": self.failed_rows,
+            "failed_batches": [
+                {"first_row": first_row, "row_count": row_count, "error": error}
+                for first_row, row_count, error in self.failed_batches
+            ],
+        }
+
+
+def bulk_insert(insert_batch, rows, batch_size=1000, max_concurrency=4, max_retries=3, backoff_seconds=0.5):
+    """
+    Insert rows in batches of batch_size using up to max_concurrency threads.
+    insert_batch(batch) must insert the batch and return the number of rows stored, or raise.
+    Each failing batch is retried max_retries times with exponential backoff; batches that still
+    fail are reported in the result instead of aborting the others.
+    """
+    batch_size = max(1, batch_size)
+    return bulk_insert_batches(
+        insert_batch, (rows[start:start + batch_size] for start in range(0, len(rows), batch_size)),
+        max_concurrency=max_concurrency, max_retries=max_retries, backoff_seconds=backoff_seconds,
+    )
+
+
+def bulk_insert_batches(insert_batch, batches, max_concurrency=4, max_retries=3, backoff_seconds=0.5):
+    """
+    Like bulk_insert(), for an iterable of ready-made batches. Batches are consumed as writers free up
+    (at most 2 x max_concurrency are in flight), so a generator never has to be materialized.
+    """
+    max_concurrency = max(1, max_concurrency)
+    result = BulkWriteResult(0)
+
+    def write(start, batch):
+        attempt = 0
+        while True:
+            try:
+                return insert_batch(batch)
+            except Exception as e:
+                if attempt >= max_retries:
+                    logger.exception("Insert of rows %d-%d failed after %d attempts: %s", start, start + len(batch) - 1, attempt + 1, e)
+                    raise
+                time.sleep(backoff_seconds * (2 ** attempt))
+                attempt += 1
+
+    def collect(start, row_count, future):
+        try:
+            result.stored_rows += future.result()
+        except Exception as e:
+            result.failed_batches.append((start, row_count, str(e)))
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for batch in batches:
+            if not batch:
+                continue
+            if len(pending) >= 2 * max_concurrency:
+                collect(*pending.popleft())
+            pending.append((result.total_rows, len(batch), executor.submit(write, result.total_rows, batch)))
+            result.total_rows += len(batch)
+        while pending:
+            collect(*pending.popleft())
+    return result
+
+
+def supabase_inserter(supabase_client, table):
+    """insert_batch callable for bulk_insert that writes to a Supabase table."""
+    def insert_batch(batch):
+        response = supabase_client.table(table).insert(batch).execute()
+        if not response.data:
+            raise RuntimeError(f"No data returned inserting {len(batch)} rows into '{table}'")
+        return len(response.data)
+    return insert_batch
+
+
+def store_analysis(storage, summary_record, finding_batches, max_concurrency=4, max_retries=3,
+                   resolved_fingerprints=()):
+    """
+    Synchronously store one analysis: the summary record first, then its findings (an iterable of
+    row batches, e.g. from iter_finding_records()) linked by analysis_id, then (incremental analyses)
+    mark the user's findings with resolved_fingerprints as resolved.
+    Returns (analysis_id, BulkWriteResult).
+    """
+    analysis_id = storage.insert_analysis(summary_record)
+    write_result = bulk_insert_batches(
+        storage.insert_findings,
+        ([{"analysis_id": analysis_id, **row} for row in batch] for batch in finding_batches),
+        max_concurrency=max_concurrency, max_retries=max_retries,
+    )
+    if resolved_fingerprints:
+        storage.resolve_findings(summary_record["user_id"], list(resolved_fingerprints))
+    return analysis_id, write_result
+
+
+# --- Storage Backends ---
+# Every backend provides insert_analysis(record) -> analysis_id, insert_findings(rows) -> rows stored and
+# resolve_findings(user_id, fingerprints) -> None, which marks the user's stored findings with those
+# finding_fingerprint values as resolved (incremental analyses).
+# Supabase is the production backend; the SQLite and JSON-lines backends keep everything local,
+# for tests and benchmarks without network access.
+class SupabaseStorage:
+    name = "supabase"
+
+    def __init__(self, supabase_client):
+        self.client = supabase_client
+        self._insert_findings = supabase_inserter(supabase_client, "individual_findings")
+
+    def insert_analysis(self, record):
+        response = self.client.table("rag_analysis_results").insert(record).execute()
+        if not response.data or not response.data[0].get('id'):
+            raise RuntimeError("No record ID returned inserting into 'rag_analysis_results'")
+        return response.data[0]['id']
+
+    def insert_findings(self, rows):
+        return self._insert_findings(rows)
+
+    def resolve_findings(self, user_id, fingerprints):
+        # Needs finding_fingerprint and resolved_at columns on 'individual_findings'
+        resolved_at = datetime.now(timezone.utc).isoformat()
+        for start in range(0, len(fingerprints), RESOLVE_BATCH_SIZE):
+            batch = fingerprints[start:start + RESOLVE_BATCH_SIZE]
+            (
+                self.client.table("individual_findings")
+                .update({"resolved_at": resolved_at})
+                .eq("user_id", user_id)
+                .in_("finding_fingerprint", batch)
+                .is_("resolved_at", "null")
+                .execute()
+            )
+
+
+class SQLiteStorage:
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rag_analysis_results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, record TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS individual_findings ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, analysis_id INTEGER, record TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS resolved_findings ("
+            "user_id TEXT NOT NULL, finding_fingerprint TEXT NOT NULL, resolved_at REAL NOT NULL, "
+            "PRIMARY KEY (user_id, finding_fingerprint))"
+        )
+        self._db.commit()
+
+    def insert_analysis(self, record):
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO rag_analysis_results (created_at, record) VALUES (?, ?)",
+                (time.time(), json.dumps(record, default=str)),
+            )
+            self._db.commit()
+            return cursor.lastrowid
+
+    def insert_findings(self, rows):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO individual_findings (analysis_id, record) VALUES (?, ?)",
+                [(row.get("analysis_id"), json.dumps(row, default=str)) for row in rows],
+            )
+            self._db.commit()
+        return len(rows)
+
+    def resolve_findings(self, user_id, fingerprints):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO resolved_findings (user_id, finding_fingerprint, resolved_at) VALUES (?, ?, ?)",
+                [(user_id, fingerprint, time.time()) for fingerprint in fingerprints],
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JsonLinesStorage:
+    name = "jsonl"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._analysis_path = os.path.join(directory, "rag_analysis_results.jsonl")
+        self._findings_path = os.path.join(directory, "individual_findings.jsonl")
+        self._resolved_path = os.path.join(directory, "resolved_findings.jsonl")
+
+    def insert_analysis(self, record):
+        analysis_id = uuid.uuid4().hex
+        self._append(self._analysis_path, [{"id": analysis_id, **record}])
+        return analysis_id
+
+    def insert_findings(self, rows):
+        self._append(self._findings_path, rows)
+        return len(rows)
+
+    def resolve_findings(self, user_id, fingerprints):
+        resolved_at = datetime.now(timezone.utc).isoformat()
+        self._append(self._resolved_path, [
+            {"user_id": user_id, "finding_fingerprint": fingerprint, "resolved_at": resolved_at}
+            for fingerprint in fingerprints
+        ])
+
+    def _append(self, path, rows):
+        lines = "".join(json.dumps(row, default=str) + "\n" for row in rows)
+        with self._lock, open(path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+class InstrumentedStorage:
+    """Wraps a storage backend to record the duration of every insert in STORAGE_INSERT_SECONDS."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.name = storage.name
+
+    def insert_analysis(self, record):
+        with STORAGE_INSERT_SECONDS.time(backend=self.name, table="rag_analysis_results"):
+            return self.storage.insert_analysis(record)
+
+    def insert_findings(self, rows):
+        with STORAGE_INSERT_SECONDS.time(backend=self.name, table="individual_findings"):
+            return self.storage.insert_findings(rows)
+
+    def resolve_findings(self, user_id, fingerprints):
+        with STORAGE_INSERT_SECONDS.time(backend=self.name, table="resolved_findings"):
+            return self.storage.resolve_findings(user_id, fingerprints)
+
+
+def create_storage(kind, supabase_client=None, path=None):
+    """Build the storage backend named by kind ('supabase', 'sqlite' or 'jsonl'); None if unavailable."""
+    if kind == "supabase":
+        storage = SupabaseStorage(supabase_client) if supabase_client else None
+    elif kind == "sqlite":
+        storage = SQLiteStorage(path or "analysis_results.sqlite3")
+    elif kind == "jsonl":
+        storage = JsonLinesStorage(path or "analysis_results")
+    else:
+        raise ValueError(f"Unknown storage backend '{kind}'. Expected 'supabase', 'sqlite' or 'jsonl'.")
+    return InstrumentedStorage(storage) if storage is not None else None
@@ -0,0 +1,114 @@
+# --- Recommendation Cache ---
+# Two-tier cache for generated recommendations: an in-memory LRU in front of an
+# SQLite table that survives restarts. Keys hash the model name, control ID and
+# the exact prompt, so a different model or any change in finding context is a miss.
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(model_name, control_id, prompt):
+    return hashlib.sha256(json.dumps([model_name, str(control_id), prompt]).encode("utf-8")).hexdigest()
+
+
+class RecommendationCache:
+    def __init__(self, max_entries=1024, ttl_seconds=0, db_path=None, max_disk_entries=100000):
+        # ttl_seconds <= 0 means entries never expire; db_path None/"" disables the disk tier
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path or None
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> (recommendation, created_at)
+        self._counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+        self._puts_since_prune = 0
+        self._db = None
+        if self.db_path:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS recommendations ("
+                "key TEXT PRIMARY KEY, recommendation TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _expired(self, created_at, now):
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """Return the cached recommendation for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self._counts["memory_hits"] += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT recommendation, created_at FROM recommendations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._remember(key, row[0], row[1])
+                    self._counts["disk_hits"] += 1
+                    return row[0]
+
+            self._counts["misses"] += 1
+            return None
+
+    def put(self, key, recommendation):
+        now = time.time()
+        with self._lock:
+            self._remember(key, recommendation, now)
+            self._counts["stores"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO recommendations (key, recommendation, created_at) VALUES (?, ?, ?)",
+                    (key, recommendation, now),
+                )
+                self._puts_since_prune += 1
+                if self._puts_since_prune >= 100:
+                    self._prune_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, recommendation, created_at):
+        if self.max_entries == 0:
+            return
+        self._memory[key] = (recommendation, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self, now):
+        # Drop expired rows, then the oldest rows beyond max_disk_entries
+        self._puts_since_prune = 0
+        if self.ttl_seconds > 0:
+            self._db.execute("DELETE FROM recommendations WHERE created_at < ?", (now - self.ttl_seconds,))
+        if self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM recommendations WHERE key IN ("
+                "SELECT key FROM recommendations ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_disk_entries,),
+            )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["memory_entries"] = len(self._memory)
+            if self._db is not None:
+                stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM recommendations").fetchone()[0]
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,156 @@
+# --- CMMC Requirement Retrieval Index ---
+# A NumPy TF-IDF index over the CMMC Requirement Statements. Findings are scored
+# against every control with one matrix multiplication per batch, and only the
+# top-k controls above a similarity threshold count as matches. This replaces the
+# "any long keyword in common" heuristic, which matched far too many controls.
+#
+# The index is saved under a hash of the schema contents and build parameters,
+# so restarts (and unchanged hot reloads) load it from disk instead of rebuilding.
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text, stop_words):
+    """Lowercased word tokens longer than two characters, without stop words or bare numbers."""
+    return [
+        token for token in TOKEN_RE.findall(str(text).lower())
+        if len(token) > 2 and not token.isdigit() and token not in stop_words
+    ]
+
+
+class RetrievalIndex:
+    def __init__(self, control_ids, statements, vocabulary, idf, matrix, stop_words):
+        self.control_ids = list(control_ids)
+        self.statements = list(statements) # Requirement text per control, aligned with control_ids
+        self.vocabulary = vocabulary # token -> column
+        self.idf = idf
+        self.matrix = matrix # (controls x vocabulary), rows L2-normalized
+        self.stop_words = stop_words
+        self._position = {control_id: position for position, control_id in enumerate(self.control_ids)}
+
+    # --- Building and persistence ---
+    @staticmethod
+    def fingerprint(control_ids, statements, stop_words):
+        payload = json.dumps(
+            [INDEX_VERSION, sorted(stop_words), [[str(c), str(s)] for c, s in zip(control_ids, statements)]]
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def build(cls, control_ids, statements, stop_words):
+        documents = [tokenize(statement, stop_words) for statement in statements]
+        document_frequency = Counter(token for tokens in documents for token in set(tokens))
+        vocabulary = {token: column for column, token in enumerate(sorted(document_frequency))}
+        n_documents = len(documents)
+        idf = np.zeros(len(vocabulary), dtype=np.float32)
+        for token, column in vocabulary.items():
+            # Smoothed IDF, as in scikit-learn's TfidfVectorizer
+            idf[column] = math.log((1 + n_documents) / (1 + document_frequency[token])) + 1.0
+        index = cls(control_ids, statements, vocabulary, idf, None, stop_words)
+        index.matrix = index._vectorize_tokens(documents)
+        return index
+
+    @classmethod
+    def load_or_build(cls, control_ids, statements, stop_words, cache_dir=None):
+        """Load the index for these statements from cache_dir if present, otherwise build and save it."""
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, f"tfidf-{cls.fingerprint(control_ids, statements, stop_words)[:32]}.npz")
+            if os.path.exists(path):
+                try:
+                    with np.load(path, allow_pickle=False) as data:
+                        vocabulary = {str(token): column for column, token in enumerate(data["vocabulary"])}
+                        index = cls(control_ids, statements, vocabulary, data["idf"], data["matrix"], stop_words)
+                    logger.info("Loaded retrieval index from %s", path)
+                    return index
+                except Exception as e:
+                    logger.warning("Error loading retrieval index from %s, rebuilding: %s", path, e)
+
+        index = cls.build(control_ids, statements, stop_words)
+        logger.info("Built retrieval index: %d controls, %d terms", len(index.control_ids), len(index.vocabulary))
+        if path:
+            tmp_path = None
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # A unique temporary name, so processes building the same index at once don't clobber each other
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tfidf-", suffix=".npz")
+                with os.fdopen(fd, "wb") as tmp_file:
+                    np.savez(
+                        tmp_file,
+                        vocabulary=np.array(sorted(index.vocabulary, key=index.vocabulary.get), dtype=str),
+                        idf=index.idf, matrix=index.matrix,
+                    )
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning("Error saving retrieval index to %s: %s", path, e)
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return index
+
+    # --- Scoring ---
+    def _vectorize_tokens(self, token_lists):
+        vectors = np.zeros((len(token_lists), len(self.vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(token_lists):
+            counts = Counter(token for token in tokens if token in self.vocabulary)
+            if not counts:
+                continue
+            columns = np.fromiter((self.vocabulary[token] for token in counts), dtype=np.int64, count=len(counts))
+            # Sublinear term frequency
+            frequencies = np.fromiter((1.0 + math.log(count) for count in counts.values()), dtype=np.float32, count=len(counts))
+            vectors[row, columns] = frequencies * self.idf[columns]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def search(self, texts, top_k=3, threshold=0.0, batch_size=1024):
+        """For each text, return [(control_id, score), ...] for the top_k controls scoring at least threshold."""
+        results = []
+        top_k = max(1, min(top_k, len(self.control_ids)))
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            queries = self._vectorize_tokens([tokenize(text, self.stop_words) for text in batch])
+            scores = queries @ self.matrix.T # Cosine similarity: both sides are L2-normalized
+            if top_k < scores.shape[1]:
+                candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            else:
+                candidates = np.tile(np.arange(scores.shape[1]), (len(batch), 1))
+            for row, columns in enumerate(candidates):
+                row_scores = scores[row, columns]
+                order = np.argsort(-row_scores)
+                results.append([
+                    (self.control_ids[columns[i]], float(row_scores[i]))
+                    for i in order if row_scores[i] > 0 and row_scores[i] >= threshold
+                ])
+        return results
+
+    def statement(self, control_id):
+        position = self._position.get(control_id)
+        return None if position is None else self.statements[position]
+
+
+class RetrievalMatcher:
+    """Adapts a RetrievalIndex to the match_many() interface DeduplicatingMatcher wraps."""
+
+    def __init__(self, index, top_k, threshold, batch_size=1024):
+        self.index = index
+        self.top_k = top_k
+        self.threshold = threshold
+        self.batch_size = batch_size
+
+    def match_many(self, finding_descs):
+        """Matched control IDs for each description, best score first, scored in batched matrix products."""
+        matches = self.index.search(list(finding_descs), self.top_k, self.threshold, self.batch_size)
+        return [[control_id for control_id, _ in matched] for matched in matches]
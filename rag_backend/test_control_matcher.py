@@ -0,0 +1,116 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from cmmc_schema import extract_keywords
+from control_matcher import ControlMatcher, DeduplicatingMatcher, normalize_descriptions
+
+DESCRIPTION_COLUMN = "finding.description"
+
+CONTROL_KEYWORDS = {
+    "AC.L2-3.1.1": {"multi-factor", "authentication"},
+    "AC.L2-3.1.2": {"(foo", "firewall"},
+    "AU.L2-3.3.1": {"logging", "audit"},
+    "IA.L2-3.5.3": {"multi-factor"},
+    "SC.L2-3.13.1": {"e.g.", "boundary", "firewall"},
+    "SI.L2-3.14.1": {"patches"},
+}
+
+DESCRIPTIONS = [
+    "Firewall rule allows ingress from 0.0.0.0/0",
+    "Multi-factor authentication is disabled for the root account",
+    "multi factor is not the same keyword",
+    "Audit LOGGING disabled on bucket",
+    np.nan,
+    "",
+    None,
+    "call(foo) reaches the boundary",
+    "(foo) at the start has no word boundary before the parenthesis",
+    "prefixmulti-factor is not a whole word",
+    "Missing patches, e.g. for the kernel",
+    "firewall   and\taudit,  separated by odd whitespace",
+    "Nothing relevant here",
+    "Missing patches, e.g. for the kernel",
+]
+
+
+def reference_gap_map(findings_df, control_keywords, description_column=DESCRIPTION_COLUMN):
+    """The original nested loop over findings, controls and keywords."""
+    gap_to_findings_map = {}
+    for finding_index, finding in findings_df.iterrows():
+        finding_desc = str(finding.get(description_column, '')).lower()
+        if not finding_desc: continue
+
+        for control_id, keywords in control_keywords.items():
+            matched_keyword = None
+            for keyword in keywords:
+                if re.search(r'\b' + re.escape(keyword) + r'\b', finding_desc):
+                    matched_keyword = keyword
+                    break
+            if matched_keyword:
+                if control_id not in gap_to_findings_map:
+                    gap_to_findings_map[control_id] = []
+                if finding_index not in gap_to_findings_map[control_id]:
+                    gap_to_findings_map[control_id].append(finding_index)
+    return gap_to_findings_map
+
+
+def assert_same_map(actual, expected):
+    # Equal dicts can still differ in key order, which the analysis output depends on
+    assert list(actual.items()) == list(expected.items())
+
+
+def findings(descriptions=DESCRIPTIONS, index=None):
+    return pd.DataFrame({DESCRIPTION_COLUMN: descriptions}, index=index)
+
+
+def test_build_gap_map_matches_original_loop():
+    df = findings()
+    matcher = ControlMatcher(CONTROL_KEYWORDS)
+    pairs = ((index, str(desc).lower()) for index, desc in df[DESCRIPTION_COLUMN].items())
+    actual = matcher.build_gap_map(pairs)
+    expected = reference_gap_map(df, CONTROL_KEYWORDS)
+    assert_same_map(actual, expected)
+    assert actual["AC.L2-3.1.2"] == [0, 7, 11]
+    assert actual["IA.L2-3.5.3"] == [1]
+
+
+def test_build_gap_map_extends_across_chunks():
+    df = findings(index=range(100, 100 + len(DESCRIPTIONS)))
+    matcher = ControlMatcher(CONTROL_KEYWORDS)
+    gap_to_findings_map = {}
+    for start in range(0, len(df), 4):
+        chunk = df.iloc[start:start + 4]
+        descs = normalize_descriptions(chunk[DESCRIPTION_COLUMN])
+        matcher.build_gap_map(zip(descs.index, descs), gap_to_findings_map)
+    assert_same_map(gap_to_findings_map, reference_gap_map(df, CONTROL_KEYWORDS))
+
+
+def test_deduplicating_matcher_handles_missing_descriptions():
+    df = findings()
+    descs = normalize_descriptions(df[DESCRIPTION_COLUMN])
+    assert descs[4] == "" and descs[5] == "" and descs[6] == ""
+    matcher = DeduplicatingMatcher(ControlMatcher(CONTROL_KEYWORDS))
+    actual = matcher.build_gap_map(zip(descs.index, descs))
+    assert_same_map(actual, reference_gap_map(df, CONTROL_KEYWORDS))
+    assert matcher.unique_descriptions == len(set(descs) - {""})
+
+
+def test_match_accepts_non_string_descriptions():
+    matcher = ControlMatcher(CONTROL_KEYWORDS)
+    assert matcher.match(np.nan) == []
+    assert matcher.match(None) == []
+
+
+def test_schema_keywords_match_original_loop():
+    requirements = {
+        "AC.L2-3.1.1": "Limit system access to authorized users (including multi-factor authentication).",
+        "AU.L2-3.3.1": "Create and retain system audit logs and records: logging, monitoring [review].",
+        "SC.L2-3.13.1": "Monitor, control, and protect communications at external boundaries.",
+    }
+    control_keywords = {control_id: extract_keywords(statement) for control_id, statement in requirements.items()}
+    df = findings(DESCRIPTIONS + ["Users authorized without multi-factor", "external communications monitoring"])
+    matcher = ControlMatcher(control_keywords)
+    pairs = ((index, str(desc).lower()) for index, desc in df[DESCRIPTION_COLUMN].items())
+    assert_same_map(matcher.build_gap_map(pairs), reference_gap_map(df, control_keywords))
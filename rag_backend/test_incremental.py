@@ -0,0 +1,109 @@
+import io
+import time
+
+import pandas as pd
+import pytest
+
+from cmmc_schema import CMMCSchema
+from incremental import FindingDelta, FindingStateStore, UserBusy, fingerprint_rows, row_controls, row_keys
+from ingest import CATEGORY_COLUMN, DESCRIPTION_COLUMN, RESOURCE_NAME_COLUMN, SEVERITY_COLUMN
+from main import ingest_findings
+
+COLUMNS = [SEVERITY_COLUMN, CATEGORY_COLUMN, DESCRIPTION_COLUMN, RESOURCE_NAME_COLUMN]
+
+ROWS = [
+    ("HIGH", "OPEN_FIREWALL", "Firewall rule allows ingress from 0.0.0.0/0", "fw-1"),
+    ("HIGH", "MFA_DISABLED", "Multi-factor authentication is disabled for the root account", "account-1"),
+    ("HIGH", "AUDIT_LOGGING_DISABLED", "Audit logging disabled on bucket, missing patches", "bucket-1"),
+    ("LOW", "AUDIT_LOGGING_DISABLED", "Audit logging disabled on bucket", "bucket-2"),
+    ("HIGH", "OS_VULNERABILITY", "Missing patches for the kernel", "vm-1"),
+    ("HIGH", "OPEN_FIREWALL", "Firewall rule allows ingress on port 22", "fw-2"),
+]
+
+SCHEMA = CMMCSchema(pd.DataFrame({
+    # Not in ID order, so matches reused from the stored (sorted) controls must be put back in schema order
+    "Requirement ID": ["AC.L2-3.1.1", "SI.L2-3.14.1", "AU.L2-3.3.1", "SC.L2-3.13.1"],
+    "Requirement Statement": [
+        "Limit system access to authorized users, including multi-factor authentication.",
+        "Identify system flaws and install patches in a timely manner.",
+        "Create and retain system audit logs and records: logging, monitoring.",
+        "Monitor communications at external boundaries with a firewall.",
+    ],
+}))
+
+
+def findings(rows):
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def modified(rows):
+    """The rows re-exported with the first one gone, the second one changed and a new one added."""
+    rows = list(rows[1:])
+    rows[0] = rows[0][:2] + ("Multi-factor authentication is disabled for 3 admin accounts",) + rows[0][3:]
+    return rows + [("HIGH", "OPEN_FIREWALL", "Firewall rule allows ingress on port 3389", "fw-3")]
+
+
+def upload(rows):
+    return io.BytesIO(findings(rows).to_csv(index=False).encode("utf-8"))
+
+
+def commit_baseline(store, user_id, df, gap_to_findings_map=None, owner=None):
+    fingerprints = fingerprint_rows(df, COLUMNS).to_numpy()
+    controls = row_controls(gap_to_findings_map or {}, df.index)
+    return store.commit(user_id, fingerprints, row_keys(df).to_numpy(), controls, [], {}, "v1", owner=owner)
+
+
+def test_delta_counts_added_changed_unchanged_and_resolved_rows(tmp_path):
+    store = FindingStateStore(str(tmp_path / "state.sqlite3"))
+    commit_baseline(store, "u1", findings(ROWS))
+    df = findings(modified(ROWS))
+    delta = FindingDelta(store.load("u1"), fingerprint_rows(df, COLUMNS).to_numpy(), row_keys(df).to_numpy())
+    # The changed row's old version is resolved along with the dropped row
+    assert delta.counts == {"added": 1, "changed": 1, "unchanged": 4, "resolved": 2}
+    assert delta.new_mask.tolist() == [True, False, False, False, False, True]
+    store.close()
+
+
+def test_reused_matches_equal_a_fresh_matching_pass(tmp_path):
+    store = FindingStateStore(str(tmp_path / "state.sqlite3"))
+    findings_df, _, gap_to_findings_map, _, _, _ = ingest_findings(upload(ROWS), "f1.csv", "u1", SCHEMA, baseline=store.load("u1"))
+    commit_baseline(store, "u1", findings_df, gap_to_findings_map)
+
+    rows = modified(ROWS)
+    _, _, reused, _, reused_descriptions, _ = ingest_findings(
+        upload(rows), "f2.csv", "u1", SCHEMA, baseline=store.load("u1"), reuse_matches=True,
+    )
+    _, _, fresh, _, fresh_descriptions, _ = ingest_findings(upload(rows), "f2.csv", "u1", SCHEMA)
+    assert fresh["SI.L2-3.14.1"][0] == fresh["AU.L2-3.3.1"][0] # Both first matched by the same unchanged row
+    assert list(reused.items()) == list(fresh.items())
+    assert reused_descriptions < fresh_descriptions # Only the added and changed rows were matched again
+    store.close()
+
+
+def test_commit_fails_after_the_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    store = FindingStateStore(path, lease_seconds=0.2)
+    other = FindingStateStore(path, lease_seconds=0.2)
+    with store.user_lease("u1") as owner:
+        time.sleep(0.3)
+        with other.user_lease("u1"):
+            assert commit_baseline(store, "u1", findings(ROWS), owner=owner) is False
+    assert len(store.load("u1").fingerprints) == 0
+    store.close()
+    other.close()
+
+
+def test_second_lease_for_the_same_user_is_rejected(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    store = FindingStateStore(path)
+    other = FindingStateStore(path)
+    with store.user_lease("u1"):
+        with pytest.raises(UserBusy):
+            with other.user_lease("u1"):
+                pass
+        with other.user_lease("u2"):
+            pass
+    with other.user_lease("u1"): # Released when the first analysis finished
+        pass
+    store.close()
+    other.close()
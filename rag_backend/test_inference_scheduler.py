@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from inference_scheduler import InferenceScheduler
+
+
+class RecordingPipe:
+    """Stands in for the transformers pipeline and records which tenant each batch came from."""
+
+    tokenizer = None
+
+    def __init__(self):
+        self.order = []
+
+    def __call__(self, prompts, **kwargs):
+        self.order.append(prompts[0].split(":")[0])
+        return [[{"generated_text": prompt + " Recommendation: ok"}] for prompt in prompts]
+
+
+class BlockingPipe(RecordingPipe):
+    """Holds its batch's turn until released."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, prompts, **kwargs):
+        self.started.set()
+        assert self.release.wait(5), "held turn was never released"
+        return super().__call__(prompts, **kwargs)
+
+
+@contextmanager
+def holding_turn(scheduler, tenant="holder"):
+    """Run a one-batch analysis for tenant that holds its turn for the duration of the block."""
+    pipe = BlockingPipe()
+    thread = threading.Thread(target=lambda: list(scheduler.generate(tenant, pipe, [f"{tenant}:0"], 1)))
+    thread.start()
+    assert pipe.started.wait(5), "held turn was never granted"
+    try:
+        yield
+    finally:
+        pipe.release.set()
+        thread.join(5)
+
+
+def run_contended(scheduler, batches):
+    """Run one analysis per tenant with every tenant's batches queued before any of them is dispatched."""
+    pipe = RecordingPipe()
+    results = {}
+
+    def analyze(tenant, count):
+        prompts = [f"{tenant}:{i}" for i in range(count)]
+        results[tenant] = [position for position, _, _ in scheduler.generate(tenant, pipe, prompts, 1)]
+
+    threads = [threading.Thread(target=analyze, args=item) for item in batches.items()]
+    # Hold the only turn until every analysis has queued its batches, so the start order doesn't matter
+    with holding_turn(scheduler):
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while scheduler.stats()["queued_batches"] < sum(batches.values()):
+            assert time.monotonic() < deadline, "analyses did not queue their batches"
+            time.sleep(0.01)
+    for thread in threads:
+        thread.join(5)
+    for tenant, count in batches.items():
+        assert results[tenant] == list(range(count))
+    return pipe.order
+
+
+def test_weighted_policy_shares_turns_by_weight():
+    scheduler = InferenceScheduler(policy="weighted", weights={"a": 2, "b": 1}, poll_seconds=0.05)
+    order = run_contended(scheduler, {"a": 60, "b": 60})
+    contended = order[:len(order) - order[::-1].index("a")] # Until a's last batch, both tenants had work queued
+    share = contended.count("a") / contended.count("b")
+    assert 1.8 <= share <= 2.2, "".join(order)
+
+
+def test_round_robin_alternates_tenants():
+    scheduler = InferenceScheduler(policy="round_robin", poll_seconds=0.05)
+    order = run_contended(scheduler, {"a": 10, "b": 10})
+    assert order == ["a", "b"] * 10
+
+
+def test_tenant_batches_run_one_at_a_time():
+    scheduler = InferenceScheduler(max_concurrency=4, tenant_max_concurrency=4, poll_seconds=0.05)
+    running = []
+    peak = []
+
+    class SlowPipe(RecordingPipe):
+        def __call__(self, prompts, **kwargs):
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+            return super().__call__(prompts, **kwargs)
+
+    positions = [position for position, _, _ in scheduler.generate("a", SlowPipe(), [f"a:{i}" for i in range(6)], 2)]
+    assert positions == list(range(6))
+    assert max(peak) == 1
+
+
+def test_closing_generation_early_releases_queued_batches():
+    scheduler = InferenceScheduler(poll_seconds=0.05)
+    generation = scheduler.generate("a", RecordingPipe(), [f"a:{i}" for i in range(10)], 1)
+    next(generation)
+    stats = scheduler.stats()
+    # The second batch was granted when the first one finished
+    assert stats["queued_batches"] == 8 and stats["running_batches"] == 1
+    generation.close()
+    stats = scheduler.stats()
+    assert stats["queued_batches"] == 0 and stats["running_batches"] == 0
+    with holding_turn(scheduler, "b"):
+        assert scheduler.stats()["running_batches"] == 1
+
+
+def test_idle_tenants_are_forgotten_and_stats_group_unweighted_tenants():
+    scheduler = InferenceScheduler(policy="weighted", weights={"a": 2}, poll_seconds=0.05)
+    run_contended(scheduler, {"a": 3, "user-1": 2, "user-2": 2})
+    stats = scheduler.stats()
+    assert stats["tracked_tenants"] == 0
+    assert set(stats["groups"]) == {"a", "other"}
+    assert stats["groups"]["a"]["batches"] == 3
+    assert stats["groups"]["other"]["batches"] == 5 # Including run_contended's holder
+
+
+def test_tenant_is_kept_until_its_token_budget_refills():
+    scheduler = InferenceScheduler(token_budget=100, budget_window_seconds=0.2, max_new_tokens=10, poll_seconds=0.05)
+    assert list(scheduler.generate("a", RecordingPipe(), ["a:0", "a:1"], 1)) == [(0, "ok", True), (1, "ok", True)]
+    assert scheduler.stats()["tracked_tenants"] == 1
+    time.sleep(0.3)
+    assert scheduler.stats()["tracked_tenants"] == 0
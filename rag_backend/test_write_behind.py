@@ -0,0 +1,113 @@
+import json
+import time
+
+from persistence import create_storage
+from write_behind import WriteBehindQueue
+
+SUMMARY = {"user_id": "u1", "uploaded_filename": "findings.csv"}
+
+
+class FlakyStorage:
+    """Wraps a storage backend and fails the calls it is told to, once each."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.name = storage.name
+        self.fail_findings = set() # Values of "n" whose chunk fails once
+        self.fail_findings_once = False
+        self.fail_resolve_once = False
+        self.analyses_inserted = 0
+        self.findings_sent = []
+
+    def insert_analysis(self, record):
+        self.analyses_inserted += 1
+        return self.storage.insert_analysis(record)
+
+    def insert_findings(self, rows):
+        values = [row["n"] for row in rows]
+        self.findings_sent.extend(values)
+        if self.fail_findings_once:
+            self.fail_findings_once = False
+            raise ConnectionError("storage unavailable")
+        failing = self.fail_findings.intersection(values)
+        if failing:
+            self.fail_findings -= failing
+            raise ConnectionError(f"chunk with {sorted(failing)} failed")
+        return self.storage.insert_findings(rows)
+
+    def resolve_findings(self, user_id, fingerprints):
+        if self.fail_resolve_once:
+            self.fail_resolve_once = False
+            raise ConnectionError("storage unavailable")
+        return self.storage.resolve_findings(user_id, fingerprints)
+
+
+def stored(storage):
+    db = storage.storage.storage._db # FlakyStorage -> InstrumentedStorage -> SQLiteStorage
+    analyses = db.execute("SELECT COUNT(*) FROM rag_analysis_results").fetchone()[0]
+    findings = sorted(json.loads(record)["n"] for (record,) in db.execute("SELECT record FROM individual_findings"))
+    return analyses, findings
+
+
+def make_queue(tmp_path, storage, **kwargs):
+    kwargs = {"chunk_rows": 2, "max_concurrency": 1, "backoff_seconds": 0.0, **kwargs}
+    return WriteBehindQueue(str(tmp_path / "journal.sqlite3"), storage, **kwargs)
+
+
+def test_stored_summary_is_not_inserted_again_on_retry(tmp_path):
+    storage = FlakyStorage(create_storage("sqlite", path=str(tmp_path / "results.sqlite3")))
+    storage.fail_resolve_once = True
+    queue = make_queue(tmp_path, storage)
+    queue.enqueue(SUMMARY, [[{"n": n} for n in range(4)]], resolved_fingerprints=["00ff"])
+    assert queue.flush_due() == 0
+    assert queue.stats()["retrying_entries"] == 1
+    assert queue.flush_due() == 1
+    assert storage.analyses_inserted == 1
+    assert stored(storage) == (1, [0, 1, 2, 3])
+    assert queue.stats()["pending_entries"] == 0
+    queue.stop()
+
+
+def test_failed_chunk_is_retried_without_resending_stored_chunks(tmp_path):
+    storage = FlakyStorage(create_storage("sqlite", path=str(tmp_path / "results.sqlite3")))
+    storage.fail_findings = {2}
+    queue = make_queue(tmp_path, storage)
+    queue.enqueue(SUMMARY, [[{"n": n} for n in range(3)], [{"n": n} for n in range(3, 6)]])
+    assert queue.flush_due() == 0
+    assert queue.stats()["pending_finding_chunks"] == 1
+    assert queue.flush_due() == 1
+    # Chunks of 2 rows per batch: [0, 1], [2], [3, 4], [5]; only [2] is sent twice
+    assert sorted(storage.findings_sent) == [0, 1, 2, 2, 3, 4, 5]
+    assert stored(storage) == (1, list(range(6)))
+    queue.stop()
+
+
+def test_entry_leased_by_another_queue_is_skipped(tmp_path):
+    storage = FlakyStorage(create_storage("sqlite", path=str(tmp_path / "results.sqlite3")))
+    queue = make_queue(tmp_path, storage, lease_seconds=0.2)
+    other = make_queue(tmp_path, storage, lease_seconds=0.2)
+    entry_id = queue.enqueue(SUMMARY, [[{"n": 0}]])
+    assert other._claim(entry_id) is not None
+    assert queue.flush_due() == 0
+    assert stored(storage) == (0, [])
+    time.sleep(0.3) # The other queue's lease expires, e.g. because its process died
+    assert queue.flush_due() == 1
+    assert stored(storage) == (1, [0])
+    queue.stop()
+    other.stop()
+
+
+def test_entry_is_parked_after_max_attempts(tmp_path):
+    storage = FlakyStorage(create_storage("sqlite", path=str(tmp_path / "results.sqlite3")))
+    queue = make_queue(tmp_path, storage, max_attempts=2)
+    queue.enqueue(SUMMARY, [[{"n": 0}]])
+    for _ in range(2):
+        storage.fail_findings_once = True
+        assert queue.flush_due() == 0
+    assert queue.flush_due() == 0 # No longer due
+    stats = queue.stats()
+    assert stats["pending_entries"] == 0
+    [failed] = stats["failed_entries"]
+    assert failed["attempts"] == 2 and failed["last_error"].endswith("storage unavailable")
+    assert storage.analyses_inserted == 1
+    queue.stop()
@@ -0,0 +1,84 @@
+# --- Bounded Analysis Worker Pool ---
+# Runs CPU-bound analysis (CSV parsing, matching, inference, persistence) off the
+# asyncio event loop. Admission is bounded: at most max_workers jobs run and at most
+# max_queue more wait; anything beyond that is rejected immediately so the caller
+# can answer 503 instead of letting latency grow without limit.
+import asyncio
+import concurrent.futures
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturated(Exception):
+    """Raised when the pool has no free worker and its wait queue is full."""
+
+
+class AnalysisPool:
+    def __init__(self, max_workers, max_queue, thread_name_prefix="analysis"):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=thread_name_prefix)
+        self._lock = threading.Lock()
+        self._in_flight = 0 # Running + queued jobs
+        self._futures = set()
+
+    @property
+    def capacity(self):
+        return self.max_workers + self.max_queue
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit a job and return its concurrent.futures.Future, or raise PoolSaturated."""
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                raise PoolSaturated(f"{self._in_flight} analyses in flight (capacity {self.capacity})")
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a job on the pool and await its result from the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._release()
+
+    def stats(self):
+        with self._lock:
+            in_flight = self._in_flight
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": in_flight,
+            "running": min(in_flight, self.max_workers),
+            "queued": max(0, in_flight - self.max_workers),
+        }
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop accepting jobs. With wait, let queued and running jobs finish; after timeout seconds
+        the jobs still queued are cancelled. Returns True if no job is left running.
+        """
+        if not wait:
+            self._executor.shutdown(wait=False)
+            return not self._futures
+        if timeout is None:
+            self._executor.shutdown(wait=True)
+            return True
+        with self._lock:
+            pending = set(self._futures)
+        _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        return all(future.done() for future in not_done)
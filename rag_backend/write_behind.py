@@ -0,0 +1,272 @@
+# --- Write-Behind Persistence Queue ---
+# Analyses are committed to a local SQLite journal before the response is sent
+# and flushed to the storage backend by a background thread, so storage latency
+# never adds to request latency. Entries stay in the journal until every part is
+# stored, which lets the flusher retry with backoff and resume after a restart.
+#
+# An entry is flushed in two steps: the summary record (its backend ID is saved in
+# the journal so a retry never inserts it twice), then the finding chunks, each
+# deleted from the journal as soon as it is stored. Incremental analyses also journal
+# the fingerprints of findings that disappeared; they are marked resolved last.
+#
+# Several processes (e.g. uvicorn workers) may share one journal. A flusher claims an
+# entry by taking a lease on it with a single conditional UPDATE, renews the lease as
+# chunks are stored, and other flushers skip the entry until the lease is released or
+# expires (e.g. because its owner crashed), so no entry is stored twice.
+#
+# An entry that still fails after max_attempts is parked: it stays in the journal with
+# failed_at set, is no longer retried and is counted in stats(). Clearing failed_at
+# (and attempts) in the journal puts it back in the queue.
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    """Another flusher took over an entry after this one's lease on it expired."""
+
+
+class WriteBehindQueue:
+    def __init__(self, journal_path, storage, chunk_rows=1000, max_concurrency=4,
+                 backoff_seconds=1.0, max_backoff_seconds=300.0, lease_seconds=60.0, max_attempts=10):
+        self.journal_path = journal_path
+        self.storage = storage
+        self.chunk_rows = max(1, chunk_rows)
+        self.max_concurrency = max(1, max_concurrency)
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.lease_seconds = lease_seconds # Renewed after every stored chunk
+        self.max_attempts = max_attempts # 0 retries forever
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._db = sqlite3.connect(journal_path, timeout=30.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, created_at REAL NOT NULL, summary TEXT NOT NULL, "
+            "analysis_id TEXT, attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at REAL NOT NULL DEFAULT 0, "
+            "last_error TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entry_findings ("
+            "entry_id INTEGER NOT NULL, seq INTEGER NOT NULL, rows TEXT NOT NULL, PRIMARY KEY (entry_id, seq))"
+        )
+        entry_columns = {row[1] for row in self._db.execute("PRAGMA table_info(entries)")}
+        if "resolved" not in entry_columns: # Journals written before incremental analyses
+            self._db.execute("ALTER TABLE entries ADD COLUMN resolved TEXT")
+        if "owner" not in entry_columns: # Journals written before leases
+            self._db.execute("ALTER TABLE entries ADD COLUMN owner TEXT")
+            self._db.execute("ALTER TABLE entries ADD COLUMN lease_until REAL")
+        if "failed_at" not in entry_columns: # Journals written before entries could be parked
+            self._db.execute("ALTER TABLE entries ADD COLUMN failed_at REAL")
+        self._db.commit()
+
+    # --- Producer side ---
+    def enqueue(self, summary_record, finding_batches, resolved_fingerprints=()):
+        """
+        Durably journal an analysis, its finding rows (an iterable of row batches, encoded one at a time)
+        and the fingerprints of the user's findings to mark resolved; returns the journal entry ID.
+        """
+        def chunks():
+            for batch in finding_batches:
+                for start in range(0, len(batch), self.chunk_rows):
+                    yield json.dumps(batch[start:start + self.chunk_rows], default=str)
+
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO entries (created_at, summary, resolved) VALUES (?, ?, ?)",
+                (
+                    time.time(), json.dumps(summary_record, default=str),
+                    json.dumps(list(resolved_fingerprints)) if resolved_fingerprints else None,
+                ),
+            )
+            entry_id = cursor.lastrowid
+            self._db.executemany(
+                "INSERT INTO entry_findings (entry_id, seq, rows) VALUES (?, ?, ?)",
+                ((entry_id, seq, chunk) for seq, chunk in enumerate(chunks())),
+            )
+            self._db.commit()
+        self._wakeup.set()
+        return entry_id
+
+    # --- Flusher side ---
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._lock:
+            self._db.close()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                flushed = self.flush_due()
+            except Exception as e:
+                logger.exception("Write-behind flusher error: %s", e)
+                flushed = 0
+            if not flushed:
+                self._wakeup.wait(self._seconds_until_next_attempt())
+                self._wakeup.clear()
+
+    def _seconds_until_next_attempt(self):
+        with self._lock:
+            # Entries leased by another flusher become due again when the lease expires
+            row = self._db.execute(
+                "SELECT MIN(MAX(next_attempt_at, COALESCE(lease_until, 0))) FROM entries WHERE failed_at IS NULL"
+            ).fetchone()
+        if row[0] is None:
+            return None # Nothing pending; sleep until enqueue() wakes us
+        return max(0.0, min(row[0] - time.time(), self.max_backoff_seconds))
+
+    def flush_due(self):
+        """Flush every due entry that no other flusher holds. Returns the number of entries fully stored."""
+        now = time.time()
+        with self._lock:
+            due = [row[0] for row in self._db.execute(
+                "SELECT id FROM entries WHERE failed_at IS NULL AND next_attempt_at <= ? "
+                "AND (lease_until IS NULL OR lease_until < ?) ORDER BY id",
+                (now, now),
+            )]
+        flushed = 0
+        for entry_id in due:
+            if self._stopping.is_set():
+                break
+            entry = self._claim(entry_id)
+            if entry is None:
+                continue # Claimed (or already stored) by another flusher
+            summary, analysis_id, resolved, attempts = entry
+            try:
+                self._flush_entry(entry_id, summary, analysis_id, resolved)
+                flushed += 1
+            except LeaseLost as e:
+                logger.warning("Write-behind entry %s: %s", entry_id, e)
+            except Exception as e:
+                failed_at = None
+                delay = min(self.backoff_seconds * (2 ** attempts), self.max_backoff_seconds)
+                if self.max_attempts and attempts + 1 >= self.max_attempts:
+                    failed_at = time.time()
+                    logger.error("Write-behind entry %s failed %d times, giving up on it: %s", entry_id, attempts + 1, e)
+                else:
+                    logger.warning("Write-behind entry %s failed (attempt %d), retrying in %.0fs: %s", entry_id, attempts + 1, delay, e)
+                with self._lock:
+                    self._db.execute(
+                        "UPDATE entries SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, failed_at = ?, "
+                        "owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?",
+                        (time.time() + delay, str(e), failed_at, entry_id, self.owner),
+                    )
+                    self._db.commit()
+        return flushed
+
+    def _claim(self, entry_id):
+        """Lease an entry for this flusher; returns (summary, analysis_id, resolved, attempts), or None if it's taken."""
+        now = time.time()
+        with self._lock:
+            # A single UPDATE is atomic across processes sharing the journal, so only one claim succeeds
+            cursor = self._db.execute(
+                "UPDATE entries SET owner = ?, lease_until = ? WHERE id = ? AND failed_at IS NULL AND next_attempt_at <= ? "
+                "AND (lease_until IS NULL OR lease_until < ? OR owner = ?)",
+                (self.owner, now + self.lease_seconds, entry_id, now, now, self.owner),
+            )
+            self._db.commit()
+            if cursor.rowcount != 1:
+                return None
+            # Re-read after claiming: a previous owner may have stored the summary in the meantime
+            return self._db.execute(
+                "SELECT summary, analysis_id, resolved, attempts FROM entries WHERE id = ?", (entry_id,)
+            ).fetchone()
+
+    def _renew_lease(self, entry_id):
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE entries SET lease_until = ? WHERE id = ? AND owner = ?",
+                (time.time() + self.lease_seconds, entry_id, self.owner),
+            )
+            self._db.commit()
+        if cursor.rowcount != 1:
+            raise LeaseLost("lease expired and the entry was taken over by another flusher")
+
+    def _flush_entry(self, entry_id, summary, analysis_id, resolved):
+        if analysis_id is None:
+            analysis_id = self.storage.insert_analysis(json.loads(summary))
+            with self._lock:
+                self._db.execute(
+                    "UPDATE entries SET analysis_id = ?, lease_until = ? WHERE id = ?",
+                    (json.dumps(analysis_id), time.time() + self.lease_seconds, entry_id),
+                )
+                self._db.commit()
+        else:
+            analysis_id = json.loads(analysis_id)
+
+        with self._lock:
+            chunks = self._db.execute(
+                "SELECT seq, rows FROM entry_findings WHERE entry_id = ? ORDER BY seq", (entry_id,)
+            ).fetchall()
+
+        def store_chunk(seq, rows):
+            self._renew_lease(entry_id)
+            self.storage.insert_findings([{"analysis_id": analysis_id, **row} for row in json.loads(rows)])
+            with self._lock:
+                self._db.execute("DELETE FROM entry_findings WHERE entry_id = ? AND seq = ?", (entry_id, seq))
+                self._db.commit()
+
+        errors = []
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(chunks))) as executor:
+                futures = [executor.submit(store_chunk, seq, rows) for seq, rows in chunks]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(chunks)} finding chunks failed: {errors[0]}")
+
+        if resolved:
+            self._renew_lease(entry_id)
+            # Marking findings resolved is idempotent, so a retry can simply repeat it
+            self.storage.resolve_findings(json.loads(summary)["user_id"], json.loads(resolved))
+
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE id = ?", (entry_id,))
+            self._db.commit()
+        logger.info("Write-behind entry %s stored as analysis %s (%d finding chunks).", entry_id, analysis_id, len(chunks))
+
+    def stats(self):
+        with self._lock:
+            entries, retrying = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0) FROM entries WHERE failed_at IS NULL"
+            ).fetchone()
+            chunks = self._db.execute(
+                "SELECT COUNT(*) FROM entry_findings WHERE entry_id IN (SELECT id FROM entries WHERE failed_at IS NULL)"
+            ).fetchone()[0]
+            failed = self._db.execute(
+                "SELECT id, attempts, failed_at, last_error FROM entries WHERE failed_at IS NOT NULL ORDER BY id"
+            ).fetchall()
+        return {
+            "backend": getattr(self.storage, "name", type(self.storage).__name__),
+            "pending_entries": entries,
+            "retrying_entries": retrying,
+            "pending_finding_chunks": chunks,
+            "failed_entries": [
+                {"id": entry_id, "attempts": attempts, "failed_at": failed_at, "last_error": last_error}
+                for entry_id, attempts, failed_at, last_error in failed
+            ],
+        }